@@ -0,0 +1,123 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from candle_stick_ananly import get_low_and_high
+from comprehensive_selection import (BENCHMARK_INDEX, HISTORY_DAYS, init_database,
+                                     run_selection_pipeline, save_low_and_high,
+                                     save_to_database)
+from market_data import (BAR_FIELDS, DEFAULT_CACHE_DIR, LocalBarStore, get_provider,
+                         set_provider)
+
+
+def init_backfill_progress(conn):
+    """创建回填进度表，记录已经完成的交易日"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            trade_date TEXT PRIMARY KEY,  -- 交易日
+            stock_count INTEGER,          -- 选中股票数量
+            finished_at TIMESTAMP         -- 完成时间
+        )
+    ''')
+    conn.commit()
+
+
+def get_finished_dates(conn):
+    """已经完成回填的交易日集合"""
+    cursor = conn.execute('SELECT trade_date FROM backfill_progress')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _init_worker(cache_dir):
+    # 子进程只读本地日线缓存，不向上游请求日线，也不写缓存
+    set_provider(LocalBarStore(cache_dir))
+
+
+def _process_date(date):
+    """子进程中执行：某个交易日的选股和入场价格计算"""
+    result = run_selection_pipeline(date)
+    codes = result.selected['code'].tolist()
+    levels = get_low_and_high(date, codes) if codes else None
+    return date, result.selected, levels
+
+
+def prepare_cache(start_date, end_date):
+    """
+    在主进程中把回填区间（含均线预热窗口）的日线补齐到本地缓存
+
+    Returns:
+    --------
+    list
+        缓存中已有完整日线的交易日
+    """
+    provider = get_provider()
+    dates = provider.get_trade_days(start_date=start_date, end_date=end_date)
+    if not dates:
+        return []
+    window = provider.get_trade_days(end_date=dates[-1], count=len(dates) + HISTORY_DAYS - 1)
+    all_stocks = get_all_securities(types=['stock']).index.tolist()
+    provider.get_bars(all_stocks + [BENCHMARK_INDEX], window[0], window[-1], BAR_FIELDS)
+    cached = set(LocalBarStore(DEFAULT_CACHE_DIR).dates)
+    return [date for date in dates if date in cached]
+
+
+def run_backfill(start_date, end_date, workers=None):
+    """
+    多进程回填一段时间内的选股结果和入场价格
+
+    交易日分发到进程池并行计算，各子进程以只读方式共享本地日线缓存；
+    结果由主进程统一写入 daily_rs/stock_selection.db。每完成一个交易日就记录进度，
+    中断后重新运行会跳过已完成的交易日。
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    workers : int, optional
+        进程数，默认为CPU核数
+
+    Returns:
+    --------
+    list
+        本次运行中失败的交易日，可以再次运行补齐
+    """
+    os.makedirs('daily_rs', exist_ok=True)
+    conn = init_database()
+    init_backfill_progress(conn)
+    finished = get_finished_dates(conn)
+
+    dates = prepare_cache(start_date, end_date)
+    pending = [date for date in dates if date not in finished]
+    print(f"回填区间共 {len(dates)} 个交易日，已完成 {len(dates) - len(pending)} 个，"
+          f"待处理 {len(pending)} 个")
+
+    failed = []
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(DEFAULT_CACHE_DIR,)) as pool:
+        futures = {pool.submit(_process_date, date): date for date in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            date = futures[future]
+            try:
+                date, selected, levels = future.result()
+            except Exception as e:
+                failed.append(date)
+                print(f"{date} 回填失败: {e!r}")
+                continue
+
+            # 单一写入者：只有主进程写数据库
+            save_to_database(conn, selected, date)
+            if levels is not None:
+                save_low_and_high(conn, levels, date)
+            conn.execute('INSERT OR REPLACE INTO backfill_progress VALUES (?, ?, ?)',
+                         (date, len(selected), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+            print(f"[{i}/{len(pending)}] {date} 选中 {len(selected)} 只，"
+                  f"累计耗时 {time.time() - start_time:.1f} 秒")
+
+    return sorted(failed)
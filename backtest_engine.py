@@ -0,0 +1,454 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from candle_stick_ananly import get_low_and_high
+from market_data import get_provider
+from selection_db import get_entry_levels, get_selections_between
+from stock_backtesting import PerformanceTracker
+
+# 买入后第几个交易日清仓
+HOLD_DAYS = 5
+# 目标价相对买入价的最低涨幅
+TARGET_RATE = 1.05
+# 清仓日开盘价不高于买入价时的止损比例
+STOP_RATE = 0.98
+
+# 回测读取的日线字段
+BAR_COLUMNS = ['open', 'close', 'high', 'low', 'factor']
+
+# 检查点中成交记录和每日账户的列
+TRADE_COLUMNS = ['date', 'code', 'side', 'price', 'shares', 'reason', 'profit_rate']
+EQUITY_COLUMNS = ['date', 'cash', 'market_value', 'total_assets', 'holdings']
+
+
+class BacktestResult(object):
+    def __init__(self, trades, equity, init_cash, tracker=None, stopped_at=None):
+        """
+        回测结果
+
+        Parameters:
+        -----------
+        trades : DataFrame
+            成交记录：date, code, side('buy'/'sell'), price, shares, reason, profit_rate
+        equity : DataFrame
+            以交易日为index的每日账户：cash, market_value, total_assets, holdings
+        init_cash : float
+            初始资金
+        tracker : PerformanceTracker, optional
+            回测过程中增量维护的绩效统计
+        stopped_at : str, optional
+            提前终止时的交易日，完整跑完时为None
+        """
+        self.trades = trades
+        self.equity = equity
+        self.init_cash = init_cash
+        self.tracker = tracker or PerformanceTracker(init_cash)
+        self.stopped_at = stopped_at
+
+    def metrics(self):
+        """绩效指标，见 PerformanceTracker.metrics"""
+        return self.tracker.metrics()
+
+    def summary_status(self):
+        """账户最终状态摘要，格式同 StockBacktesting.summary_status"""
+        if self.equity.empty:
+            cash, market_value = self.init_cash, 0.0
+        else:
+            cash, market_value = self.equity.iloc[-1][['cash', 'market_value']]
+        total_assets = cash + market_value
+        metrics = self.metrics()
+        return (
+            "\n=== 账户状态 ===\n"
+            f"总资产: ¥{total_assets:,.2f}\n"
+            f"现金余额: ¥{cash:,.2f}\n"
+            f"持仓市值: ¥{market_value:,.2f}\n"
+            f"收益率: {(total_assets / self.init_cash - 1) * 100:.2f}%\n"
+            f"资金空置率: {cash / total_assets * 100:.2f}%\n"
+            f"最大回撤: {metrics['max_drawdown'] * 100:.2f}%\n"
+            f"年化收益率: {metrics['annualized_return'] * 100:.2f}%\n"
+            f"夏普比率: {metrics['sharpe']:.2f}\n"
+            f"胜率: {metrics['win_rate'] * 100:.2f}%"
+        )
+
+
+class BacktestEngine(object):
+    def __init__(self, init_cash=1000000, max_stock_num=5, hold_days=HOLD_DAYS,
+                 limit_fill=False, target_rate=TARGET_RATE, stop_rate=STOP_RATE, ledger=None):
+        """
+        数组化的事件驱动回测引擎，默认规则与 StockBacktesting 的多日回测一致
+
+        持仓以定长数组保存(每个槽位一只股票)，每个交易日对全部持仓和候选股票
+        只做一次价格矩阵的行读取；目标价卖出、清仓日卖出、限价买入成交都是
+        对持仓数组的向量化布尔掩码。
+
+        Parameters:
+        -----------
+        init_cash : float
+            初始资金，默认1000000
+        max_stock_num : int
+            最大持仓数量，默认5只
+        hold_days : int
+            买入后第几个交易日清仓
+        limit_fill : bool
+            默认False，与 StockBacktesting 的多日回测相同，次日直接按入场价(la)成交；
+            True时采用更严格的规则，只有次日最低价不高于入场价才成交
+        target_rate : float
+            目标价相对买入价的最低倍数，默认1.05
+        stop_rate : float
+            清仓日开盘价不高于买入价时的止损倍数，默认0.98
+        ledger : TradeLedger, optional
+            同时把成交、拒绝和每日快照写入交易台账
+        """
+        self.init_cash = init_cash
+        self.max_stock_num = max_stock_num
+        self.max_single_position = init_cash / max_stock_num
+        self.hold_days = hold_days
+        self.limit_fill = limit_fill
+        self.target_rate = target_rate
+        self.stop_rate = stop_rate
+        self.ledger = ledger
+
+    def params(self):
+        """影响回测结果的参数，检查点只能在参数相同的回测中恢复"""
+        return {'init_cash': self.init_cash, 'max_stock_num': self.max_stock_num,
+                'hold_days': self.hold_days, 'limit_fill': self.limit_fill,
+                'target_rate': self.target_rate, 'stop_rate': self.stop_rate}
+
+    def run(self, days, selections, levels, bars, stop=None, checkpoint=None,
+            checkpoint_every=20):
+        """
+        执行回测
+
+        第i个交易日收盘后的选股结果在第i+1个交易日以入场价买入；持仓在每个交易日
+        先检查是否达到目标价，再检查是否到达清仓日。
+
+        Parameters:
+        -----------
+        days : list
+            交易日列表，格式为'%Y-%m-%d'
+        selections : dict
+            {交易日: 按优先级排序的股票代码列表}
+        levels : DataFrame
+            交易日×股票 的入场价(la)矩阵，与bars使用同一复权基准
+        bars : dict
+            {'open','close','high','low': DataFrame} 交易日×股票 的价格矩阵
+        stop : callable, optional
+            stop(tracker) -> bool，每个交易日收盘后调用，返回True时提前终止回测
+        checkpoint : str, optional
+            检查点文件路径。文件存在时从中恢复并跳过已经处理的交易日，结果与不中断运行
+            完全相同；运行中每checkpoint_every个交易日及结束时写入。延长days后用同一
+            检查点再次运行，只处理新增的交易日
+        checkpoint_every : int
+            写入检查点的交易日间隔
+
+        Returns:
+        --------
+        BacktestResult
+        """
+        codes = list(bars['close'].columns)
+        code_pos = {code: i for i, code in enumerate(codes)}
+        index = pd.DatetimeIndex(days)
+        o, c, h, l = [bars[field].reindex(index=index, columns=codes).to_numpy(dtype=float)
+                      for field in ['open', 'close', 'high', 'low']]
+        la = levels.reindex(index=index, columns=codes).to_numpy(dtype=float)
+
+        # 持仓数组，slot_code为-1表示空槽位
+        slots = self.max_stock_num
+        slot_code = np.full(slots, -1)
+        slot_price = np.zeros(slots)
+        slot_shares = np.zeros(slots)
+        slot_target = np.zeros(slots)
+        slot_clear = np.zeros(slots, dtype=int)
+        slot_open = np.zeros(slots, dtype=int)
+        slot_market = np.zeros(slots)
+        cash = float(self.init_cash)
+        tracker = PerformanceTracker(self.init_cash)
+
+        trades = []
+        equity = []
+        stopped_at = None
+        start = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            meta, arrays = load_checkpoint(checkpoint)
+            if meta['params'] != self.params() or meta['first_day'] != days[0]:
+                raise ValueError(f"检查点 {checkpoint} 与当前回测的参数或起始日不一致")
+            if meta['cursor'] not in days:
+                raise ValueError(f"检查点的交易日 {meta['cursor']} 不在回测区间内")
+            start = days.index(meta['cursor'])
+            cash = meta['cash']
+            stopped_at = meta['stopped_at']
+            tracker.set_state(meta['tracker'], arrays['tracker_dates'].tolist(),
+                              arrays['tracker_values'].tolist())
+            for k, code in enumerate(arrays['slot_code'].tolist()):
+                if code and code not in code_pos:
+                    raise ValueError(f"检查点中的持仓 {code} 不在价格矩阵中")
+                slot_code[k] = code_pos[code] if code else -1
+            slot_price, slot_shares, slot_target, slot_market = [
+                arrays['slot_' + name].copy() for name in ['price', 'shares', 'target', 'market']]
+            slot_clear, slot_open = arrays['slot_clear'].copy(), arrays['slot_open'].copy()
+            trades = _records(arrays, 'trade', TRADE_COLUMNS)
+            equity = _records(arrays, 'equity', EQUITY_COLUMNS)
+
+        def save(cursor):
+            save_checkpoint(checkpoint, {
+                'params': self.params(), 'first_day': days[0], 'cursor': cursor,
+                'cash': cash, 'stopped_at': stopped_at, 'tracker': tracker.get_state()[0],
+            }, {
+                'tracker_dates': np.array(tracker.dates, dtype=str),
+                'tracker_values': np.array(tracker.values, dtype=float),
+                'slot_code': np.array([codes[k] if k >= 0 else '' for k in slot_code], dtype=str),
+                'slot_price': slot_price, 'slot_shares': slot_shares,
+                'slot_target': slot_target, 'slot_market': slot_market,
+                'slot_clear': slot_clear, 'slot_open': slot_open,
+            }, trades, equity)
+
+        for i in range(start, len(days) - 1):
+            if stopped_at is not None:
+                break
+            n = i + 1
+            active = slot_code >= 0
+            pos = np.where(active, slot_code, 0)
+            day_open, day_close, day_high = o[n, pos], c[n, pos], h[n, pos]
+            traded = active & ~np.isnan(day_close)
+            slot_market = np.where(traded, day_close, slot_market)
+
+            # 达到目标价按目标价卖出；否则到达清仓日时，开盘高于买入价按开盘价卖出，
+            # 否则按 min(买入价*0.98, 收盘价) 卖出
+            hit_target = traded & (day_high >= slot_target)
+            clear = traded & ~hit_target & (slot_clear <= n)
+            sell_price = np.where(hit_target, slot_target,
+                                  np.where(day_open > slot_price, day_open,
+                                           np.minimum(slot_price * self.stop_rate, day_close)))
+            sold = hit_target | clear
+            for slot in np.flatnonzero(sold):
+                income = sell_price[slot] * slot_shares[slot]
+                cash += income
+                tracker.record_trade(income)
+                tracker.record_close((sell_price[slot] / slot_price[slot] - 1) * 100,
+                                     n - slot_open[slot])
+                if self.ledger is not None:
+                    self.ledger.record_trade(days[n], codes[slot_code[slot]], 'sell',
+                                             sell_price[slot], slot_shares[slot],
+                                             (sell_price[slot] / slot_price[slot] - 1) * 100,
+                                             'target' if hit_target[slot] else 'clear')
+                trades.append({
+                    'date': days[n], 'code': codes[slot_code[slot]], 'side': 'sell',
+                    'price': sell_price[slot], 'shares': slot_shares[slot],
+                    'reason': 'target' if hit_target[slot] else 'clear',
+                    'profit_rate': (sell_price[slot] / slot_price[slot] - 1) * 100,
+                })
+            slot_code[sold] = -1
+
+            # 候选股票：不在持仓中、有入场价、次日有行情，限价模式下还要求次日最低价触及入场价
+            candidates = [code_pos[code] for code in selections.get(days[i], [])
+                          if code in code_pos]
+            if candidates:
+                cand = np.array(list(dict.fromkeys(candidates)), dtype=int)
+                price = la[i, cand]
+                fill = ~np.isin(cand, slot_code) & ~np.isnan(price) & ~np.isnan(c[n, cand])
+                if self.limit_fill:
+                    fill &= l[n, cand] <= price
+                for k in np.flatnonzero(fill):
+                    free = np.flatnonzero(slot_code < 0)
+                    if len(free) == 0:
+                        if self.ledger is not None:
+                            self.ledger.record_rejection(days[n], codes[cand[k]], 'max_holdings',
+                                                         price[k], max_stock_num=slots)
+                        break
+                    shares = (int(min(cash, self.max_single_position) / price[k]) // 100) * 100
+                    if shares == 0:
+                        if self.ledger is not None:
+                            self.ledger.record_rejection(days[n], codes[cand[k]], 'zero_shares',
+                                                         price[k])
+                        continue
+                    slot = free[0]
+                    slot_code[slot] = cand[k]
+                    slot_price[slot] = price[k]
+                    slot_shares[slot] = shares
+                    slot_target[slot] = max(price[k] * self.target_rate, h[n, cand[k]])
+                    slot_clear[slot] = n + self.hold_days
+                    slot_open[slot] = n
+                    slot_market[slot] = c[n, cand[k]]
+                    cash -= shares * price[k]
+                    tracker.record_trade(shares * price[k])
+                    if self.ledger is not None:
+                        self.ledger.record_trade(days[n], codes[cand[k]], 'buy', price[k], shares,
+                                                 reason='entry')
+                    trades.append({'date': days[n], 'code': codes[cand[k]], 'side': 'buy',
+                                   'price': price[k], 'shares': shares, 'reason': 'entry',
+                                   'profit_rate': np.nan})
+
+            active = slot_code >= 0
+            market_value = float((slot_market * slot_shares)[active].sum())
+            equity.append({'date': days[n], 'cash': cash, 'market_value': market_value,
+                           'total_assets': cash + market_value, 'holdings': int(active.sum())})
+            tracker.record_day(days[n], cash + market_value)
+            if self.ledger is not None:
+                self.ledger.record_snapshot(days[n], cash, market_value, int(active.sum()))
+            if stop is not None and stop(tracker):
+                stopped_at = days[n]
+            if checkpoint is not None and (stopped_at is not None or n == len(days) - 1
+                                           or (n - start) % checkpoint_every == 0):
+                save(days[n])
+
+        if self.ledger is not None:
+            self.ledger.flush()
+        trades = pd.DataFrame(trades, columns=['date', 'code', 'side', 'price', 'shares',
+                                               'reason', 'profit_rate'])
+        equity = pd.DataFrame(equity, columns=['date', 'cash', 'market_value', 'total_assets',
+                                               'holdings'])
+        return BacktestResult(trades, equity.set_index('date'), self.init_cash, tracker,
+                              stopped_at)
+
+
+def _records(arrays, prefix, columns):
+    # 检查点中按列保存的记录还原为dict列表
+    values = [arrays[f'{prefix}_{name}'].tolist() for name in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def save_checkpoint(path, meta, arrays, trades, equity):
+    """
+    把回测状态写入检查点(.npz)，先写临时文件再替换，中断时不会损坏已有的检查点
+
+    Parameters:
+    -----------
+    path : str
+        检查点文件路径
+    meta : dict
+        标量状态(参数、游标、现金、统计量)，以JSON保存
+    arrays : dict
+        {名称: ndarray} 持仓数组和资金曲线
+    trades, equity : list
+        成交记录和每日账户，按列保存
+    """
+    columns = {}
+    for prefix, records, names in [('trade', trades, TRADE_COLUMNS),
+                                   ('equity', equity, EQUITY_COLUMNS)]:
+        for name in names:
+            columns[f'{prefix}_{name}'] = np.array([record[name] for record in records])
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, meta=np.array(json.dumps(meta)), **arrays, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """读取检查点，返回 (meta, {名称: ndarray})"""
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    return json.loads(str(arrays.pop('meta'))), arrays
+
+
+def load_backtest_bars(codes, days, provider=None):
+    """
+    读取回测用的价格矩阵，以每只股票在回测区间内的第一个交易日为复权基准
+
+    基准不随结束日期变化，延长回测区间时已有交易日的价格保持不变，检查点可以续跑。
+
+    Returns:
+    --------
+    dict
+        {'open','close','high','low': DataFrame, 'factor': 相对基准日的复权因子}
+    """
+    provider = provider or get_provider()
+    bars = provider.history_range(codes, days[0], days[-1], BAR_COLUMNS, fq='post')
+    factor = bars['factor'].ffill()
+    base = factor.bfill().iloc[0]
+    result = {field: bars[field] / base for field in ['open', 'close', 'high', 'low']}
+    result['factor'] = factor / base
+    return result
+
+
+def load_entry_prices(selections, factor):
+    """
+    读取每个交易日选中股票的入场价(la)，换算到回测价格的复权基准
+
+    优先使用 entry_levels 表中预先计算的结果，缺失的交易日调用 get_low_and_high 补算。
+
+    Parameters:
+    -----------
+    selections : dict
+        {交易日: 股票代码列表}
+    factor : DataFrame
+        交易日×股票 的复权因子（当日复权因子/基准日复权因子）
+
+    Returns:
+    --------
+    DataFrame
+        交易日×股票 的入场价矩阵
+    """
+    dates = sorted(selections)
+    la = pd.DataFrame(np.nan, index=factor.index, columns=factor.columns)
+    if not dates:
+        return la
+    saved = get_entry_levels(dates[0], dates[-1])['la'].unstack()
+    saved.index = pd.DatetimeIndex(saved.index)
+    for date in dates:
+        codes = selections[date]
+        day = pd.Timestamp(date)
+        row = saved.loc[day].reindex(codes) if day in saved.index else pd.Series(index=codes, dtype=float)
+        missing = row.index[row.isna()].tolist()
+        if missing:
+            row.update(get_low_and_high(date, missing)['la'])
+        la.loc[day, codes] = row.to_numpy(dtype=float)
+    # get_low_and_high 的价格以当日为基准，乘以当日相对回测基准的复权因子换算
+    return la * factor
+
+
+def backtest_days(start_date, end_date):
+    """回测使用的交易日：end_date的选股结果在下一个交易日成交，该交易日已有行情时一并包含"""
+    provider = get_provider()
+    days = provider.get_trade_days(start_date=start_date, end_date=end_date)
+    following = provider.get_trade_days(start_date=days[-1], count=2) if days else []
+    if len(following) == 2 and following[1] < pd.Timestamp.now().strftime('%Y-%m-%d'):
+        days.append(following[1])
+    return days
+
+
+def run_selection_backtest(start_date, end_date, init_cash=1000000, max_stock_num=5,
+                           top_k=None, limit_fill=False, checkpoint=None):
+    """
+    对数据库中保存的选股结果做多日回测
+
+    全部价格一次读取为 交易日×股票 矩阵，以回测首日为复权基准。
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    init_cash : float
+        初始资金
+    max_stock_num : int
+        最大持仓数量
+    top_k : int, optional
+        每个交易日只考虑总分最高的前K只
+    limit_fill : bool
+        是否要求次日最低价触及入场价才成交，默认False与 StockBacktesting 的多日回测一致
+    checkpoint : str, optional
+        检查点文件路径，见 BacktestEngine.run；同一start_date延长end_date时从检查点续跑
+
+    Returns:
+    --------
+    BacktestResult
+    """
+    start_time = time.time()
+    days = backtest_days(start_date, end_date)
+    selections = get_selections_between(start_date, end_date, top_k)
+    codes = sorted({code for codes in selections.values() for code in codes})
+    bars = load_backtest_bars(codes, days)
+    levels = load_entry_prices(selections, bars['factor'])
+
+    engine = BacktestEngine(init_cash, max_stock_num, limit_fill=limit_fill)
+    result = engine.run(days, selections, levels, bars, checkpoint=checkpoint)
+    print(f"回测 {days[0]} ~ {days[-1]} 共 {len(days)} 个交易日，成交 {len(result.trades)} 笔，"
+          f"耗时 {time.time() - start_time:.2f} 秒")
+    return result
@@ -2,72 +2,185 @@
 from jqdata import *
 from enum import Enum
 
+import numpy as np
 import pandas as pd
 
+from market_data import get_provider
+from minute_store import MINUTES_PER_DAY, get_minute_store
+from profiling import add_rows, profiled
+
+LEVEL_COLUMNS = ['p_close','open','close','high','low','low_after_high', 'high_after_low',
+                 'hc','hd','hx','ha','lc','ld','lx','la',
+                 'no']
+
 # 前一个开盘日期，用以提取历史数据
 def get_previous_trade_day(trade_day):
     trade_days = get_trade_days(end_date=trade_day,count=2)
     return(trade_days[0])
 
 
-# 根据历史数据获取对应的最低价格区间&最高价格区间
-def get_low_and_high(end_date, security_list):
-    cols = ['p_close','open','close','high','low','low_after_high', 'high_after_low',
-            'hc','hd','hx','ha','lc','ld','lx','la',
-            'no']
-    rs = pd.DataFrame({}, columns = cols, index = security_list,dtype=float)
-    rs = rs.fillna(0)
-    rs.index.name = 'security'
-    drop_list = []
-    for security in security_list:
-        line = rs.loc[security]
-        
-        #获取到截止日期T-N交易日的数据
-        df = get_price(security, count=2, end_date= end_date, 
-                   frequency='daily', fields=['open','close','high','low']) 
-
-        #最后一个交易日K线中的最高价后的对低价，最低价后的最高价
-        td = get_price(security, count = 240 ,end_date=str("%s 16:00:00" % end_date),
-                   frequency='minute',fields=['high','low'])
-        #实际分钟K线的最高&最低价格
-        high = max(td.high)
-        low = min(td.low)
-
-        #最高&最低的分钟位置
-        #如果有多个最高价或最低价，则选择最后一个
-        high_line = (td[td.high == high]).tail(1)
-        low_line = (td[td.low == low]).tail(1)
-        
-        if np.isnan(high) or np.isnan(low):
-            drop_list.append(security)
-            continue
-        
-        high_after_low = max(td.loc[low_line.index[0]:, 'high'])
-        low_after_high = min(td.loc[high_line.index[0]:,'low'])
-        
-        c = df.tail(1) #当日数据
-        p = df.head(1) #前一个交易日数据
-        
-        line.p_close = p.close[0] 
-        line.open, line.close, line.high, line.low = c.open, c.close, high, low
-        line.low_after_high = low_after_high
-        line.high_after_low = high_after_low
-
-        hc = (c.high[0]/p.close[0]) * c.close[0]
-        hd = (c.high[0]/c.open[0]) * c.close[0]
+# 把 get_price(panel=False) 的长表转换为 时间×股票 矩阵
+def pivot_panel(df, fields, security_list):
+    return {field: df.pivot(index='time', columns='code', values=field)
+                     .reindex(columns=security_list).astype(float)
+            for field in fields}
+
+
+# 入场/离场价格核心计算，全部输入按列对齐，一列一只股票(或一个股票交易日)
+# p_close/day_open/close/day_high/day_low: 长度N的日线数组
+# minute_high/minute_low: (分钟数, N) 的分钟线数组
+def compute_levels(p_close, day_open, close, day_high, day_low, minute_high, minute_low):
+    # 停牌等无分钟数据的列不参与计算
+    valid = ~(np.isnan(minute_high).all(axis=0) | np.isnan(minute_low).all(axis=0))
+    mh = np.where(np.isnan(minute_high), -np.inf, minute_high)
+    ml = np.where(np.isnan(minute_low), np.inf, minute_low)
+    n_minutes, n = mh.shape
+    cols = np.arange(n)
+
+    #实际分钟K线的最高&最低价格
+    high = mh.max(axis=0)
+    low = ml.min(axis=0)
+
+    #最高&最低的分钟位置
+    #如果有多个最高价或最低价，则选择最后一个
+    high_idx = n_minutes - 1 - np.argmax((mh == high)[::-1], axis=0)
+    low_idx = n_minutes - 1 - np.argmax((ml == low)[::-1], axis=0)
+
+    #最低价后的最高价 = 自最低分钟起的反向累计最大值；最高价后的最低价同理
+    high_after_low = np.maximum.accumulate(mh[::-1], axis=0)[::-1][low_idx, cols]
+    low_after_high = np.minimum.accumulate(ml[::-1], axis=0)[::-1][high_idx, cols]
+
+    values = levels_from_extremes(p_close, day_open, close, day_high, day_low,
+                                  high_after_low, low_after_high)
+    values.update({'high': high, 'low': low})
+    return values, valid
+
+
+# 由当日极值计算入场/离场价格，输入可以是标量或等长数组
+def levels_from_extremes(p_close, day_open, close, day_high, day_low, high_after_low, low_after_high):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hc = (day_high/p_close) * close
+        hd = (day_high/day_open) * close
         # hx =  (最低价后高点/最低价) * 当日收盘
-        hx = (high_after_low/c.low[0]) * c.close[0]
+        hx = (high_after_low/day_low) * close
         ha = (hc+hd+hx)/3
-        
 
-        lc = (c.low[0]/ c.open[0]) * c.close[0]
-        ld = (c.low[0]/ p.close[0]) * c.close[0]
+        lc = (day_low/day_open) * close
+        ld = (day_low/p_close) * close
         #lx =  (最高价后低点/当日最高) * 当日收盘
-        lx = (low_after_high/c.high[0] ) * c.close[0] 
+        lx = (low_after_high/day_high) * close
         la = (lc+ld+lx)/3
-        #print('lc:¥ %.2f, ld: ¥%.2f, lx:¥%.2f, la:¥ %.2f' % (lc, ld, lx, la))
-        line.hc, line.hd, line.hx, line.ha = round(hc,2), round(hd,2), round(hx,2), round(ha,2)
-        line.lc, line.ld, line.lx, line.la = round(lc,2), round(ld,2), round(lx,2), round(la,2)     
-        line.no = round((line.open/line.p_close)* line.close,2)
-    rs = rs.drop(index=drop_list)
-    return(rs)
\ No newline at end of file
+        no = (day_open/p_close) * close
+
+    values = {
+        'p_close': p_close, 'open': day_open, 'close': close, 'high': day_high, 'low': day_low,
+        'low_after_high': low_after_high, 'high_after_low': high_after_low,
+        'hc': hc, 'hd': hd, 'hx': hx, 'ha': ha, 'lc': lc, 'ld': ld, 'lx': lx, 'la': la,
+        'no': no,
+    }
+    for col in ['hc','hd','hx','ha','lc','ld','lx','la','no']:
+        values[col] = np.round(values[col], 2)
+    return values
+
+
+class IntradayLevelEstimator:
+    def __init__(self, p_close, day_open=None):
+        """
+        单只股票的盘中入场/离场价格估计器
+
+        按分钟逐根输入K线，每根K线O(1)更新当日最高/最低价、最低价后的最高价、
+        最高价后的最低价，任意时刻都可以给出临时的lc/ld/lx/la和hc/hd/hx/ha。
+        收盘后输入全部240根分钟线的结果与 get_low_and_high 一致（日线高低点取分钟线极值）。
+
+        Parameters:
+        -----------
+        p_close : float
+            前一交易日收盘价
+        day_open : float, optional
+            当日开盘价，默认取第一根分钟线的开盘价
+        """
+        self.p_close = p_close
+        self.day_open = day_open
+        self.high = -np.inf
+        self.low = np.inf
+        self.high_after_low = np.nan
+        self.low_after_high = np.nan
+        self.close = np.nan
+        self.bars = 0
+
+    def update(self, high, low, close, open=None):
+        """
+        输入一根分钟K线，停牌等缺失数据的K线会被忽略
+
+        Parameters:
+        -----------
+        high, low, close : float
+            分钟线最高价、最低价、收盘价
+        open : float, optional
+            分钟线开盘价，用于确定当日开盘价
+        """
+        if np.isnan(high) or np.isnan(low):
+            return
+        if self.day_open is None:
+            self.day_open = open if open is not None else close
+
+        #有多个最低价时取最后一个，最低价后的最高价从这根K线重新累计
+        if low <= self.low:
+            self.low = low
+            self.high_after_low = high
+        else:
+            self.high_after_low = max(self.high_after_low, high)
+
+        if high >= self.high:
+            self.high = high
+            self.low_after_high = low
+        else:
+            self.low_after_high = min(self.low_after_high, low)
+
+        self.close = close
+        self.bars += 1
+
+    def levels(self):
+        """
+        当前时刻的临时价格区间
+
+        Returns:
+        --------
+        dict
+            与 get_low_and_high 结果列相同的字典；尚未输入K线时返回None
+        """
+        if self.bars == 0:
+            return None
+        return levels_from_extremes(self.p_close, self.day_open, self.close, self.high, self.low,
+                                    self.high_after_low, self.low_after_high)
+
+
+# 由2日日线矩阵和当日分钟线矩阵计算价格区间，返回以股票代码为index的DataFrame
+def low_and_high_from_bars(daily, minute, security_list):
+    c = {field: daily[field].iloc[-1].to_numpy(dtype=float) for field in daily} #当日数据
+    p_close = daily['close'].iloc[0].to_numpy(dtype=float) #前一个交易日收盘
+    values, valid = compute_levels(p_close, c['open'], c['close'], c['high'], c['low'],
+                                   minute['high'].to_numpy(dtype=float),
+                                   minute['low'].to_numpy(dtype=float))
+    rs = pd.DataFrame(values, index=list(security_list), columns=LEVEL_COLUMNS, dtype=float)
+    rs.index.name = 'security'
+    #无分钟数据的股票直接剔除
+    return rs[valid]
+
+
+# 根据历史数据获取对应的最低价格区间&最高价格区间
+# 所有股票的日线和分钟线各只请求一次
+@profiled()
+def get_low_and_high(end_date, security_list):
+    security_list = list(security_list)
+    if not security_list:
+        rs = pd.DataFrame({}, columns=LEVEL_COLUMNS, dtype=float)
+        rs.index.name = 'security'
+        return rs
+    #截止日期T-N交易日的日线，前复权基准为end_date，当日价格即实际价格
+    daily = get_provider().history(security_list, end_date, 2, ['open','close','high','low'])
+    #最后一个交易日的分钟K线，从本地分钟线缓存读取，使用不复权价格与日线保持一致
+    store = get_minute_store()
+    minute = {field: store.window(security_list, end_date, field) for field in ['high','low']}
+    add_rows('get_low_and_high', len(security_list) * (2 + MINUTES_PER_DAY))
+    return(low_and_high_from_bars(daily, minute, security_list))
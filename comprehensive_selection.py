@@ -2,356 +2,541 @@
 from jqdata import *
 import pandas as pd
 import os
-from datetime import datetime
-import sqlite3
+import time
 
+from market_data import get_provider
+from profiling import get_profiler, profiled
+from selection_db import (init_database, save_low_and_high, save_to_database,
+                          get_recent_selections, get_stocks_by_date)
+from selection_scoring import score_candidates, top_k
+from selection_pipeline import Stage, run_pipeline, evaluate_masks, SNAPSHOT, BENCHMARK, HISTORY
 
-def init_database():
-    """初始化数据库"""
-    os.makedirs('daily_rs', exist_ok=True)
-    db_path = 'daily_rs/stock_selection.db'
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # 创建表（如果不存在）
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS comprehensive_selections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,           -- 股票代码
-            name TEXT,                    -- 股票名称
-            price REAL,                   -- 最新价
-            change_percent REAL,          -- 涨跌幅
-            turnover_rate REAL,           -- 换手率
-            volume_ratio REAL,            -- 量比
-            total_score REAL,             -- 总分
-            selection_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- 选股时间
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS outperform_stocks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,           -- 股票代码
-            selection_time TIMESTAMP,     -- 选股时间
-            lc REAL,                      -- LC值
-            ld REAL,                      -- LD值
-            lx REAL,                      -- LX值
-            la REAL,                      -- LA值
-            UNIQUE(code, selection_time)  -- 确保每个股票在同一天只有一条记录
-        )
-    ''')
-    
-    conn.commit()
-    return conn
 
-def save_low_and_high(conn, result_df, date=None):
+SNAPSHOT_PRICE_FIELDS = ['open', 'close', 'high', 'low', 'volume', 'money']
+
+# 跑赢大盘所对比的基准指数
+BENCHMARK_INDEX = '000300.XSHG'
+# 均线筛选所需的历史交易日数
+HISTORY_DAYS = 60
+# 超额收益因子的区间交易日数，须小于HISTORY_DAYS
+EXCESS_RETURN_DAYS = 20
+
+
+def fetch_valuation(securities, date):
     """
-    保存低位和高位数据到数据库
-    
+    一次查询取回指定日期的换手率和流通市值
+
+    Returns:
+    --------
+    DataFrame
+        index为股票代码，列为turnover_ratio, circulating_market_cap
+    """
+    fund_df = get_fundamentals(query(valuation.code,
+                                     valuation.turnover_ratio,
+                                     valuation.circulating_market_cap)
+                               .filter(valuation.code.in_(securities)), date=date)
+    return (fund_df.drop_duplicates('code').set_index('code')
+            [['turnover_ratio', 'circulating_market_cap']].astype('float64'))
+
+
+def snapshot_from_panel(panel, pos, valuation_df):
+    """
+    从后复权日线矩阵中取出第pos个交易日(pos>=1)的选股快照
+
+    涨幅、量比使用后复权数据计算，与复权基准无关；open/close/high/low/volume
+    换算回当日的实际价格和成交量。
+
     Parameters:
     -----------
-    conn : sqlite3.Connection
-        数据库连接对象
-    result_df : DataFrame
-        包含lc,ld,lx,la等数据的DataFrame
-    date : str, optional
-        指定的日期，格式为'%Y-%m-%d'。如果为None则使用当前日期
+    panel : dict
+        {字段: DataFrame}，后复权日线矩阵，须包含SNAPSHOT_PRICE_FIELDS和factor
+    pos : int
+        交易日在矩阵中的行号
+    valuation_df : DataFrame
+        fetch_valuation 的返回结果
+
+    Returns:
+    --------
+    DataFrame
+        每只股票一行，包含code, time, open, close, high, low, volume, money,
+        pre_close, pre_volume, increase(%), volume_ratio, turnover(%),
+        circulating_market_cap(亿元)
     """
-    # 获取日期
-    if date is None:
-        date = datetime.now().strftime('%Y-%m-%d')
-        
-    # 删除同一天的数据
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM outperform_stocks 
-        WHERE DATE(selection_time) = ?
-    ''', (date,))
-    
-    # 准备数据
-    data = []
-    for security in result_df.index:
-        row = result_df.loc[security]
-        data.append((
-            security,      # 股票代码
-            date,         # 选股时间
-            row['lc'],    # LC值
-            row['ld'],    # LD值
-            row['lx'],    # LX值
-            row['la']     # LA值
-        ))
-    
-    # 插入数据
-    cursor.executemany('''
-        INSERT INTO outperform_stocks
-        (code, selection_time, lc, ld, lx, la)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', data)
-    
-    conn.commit()
+    codes = panel['close'].columns
+    factor = panel['factor'].iloc[pos]
+    df = pd.DataFrame(index=codes)
+    df['time'] = panel['close'].index[pos]
+    for field in ['open', 'close', 'high', 'low']:
+        df[field] = panel[field].iloc[pos] / factor
+    df['volume'] = panel['volume'].iloc[pos] * factor
+    df['money'] = panel['money'].iloc[pos]
+    df['pre_close'] = panel['close'].iloc[pos - 1] / factor
+    df['pre_volume'] = panel['volume'].iloc[pos - 1] * factor
 
+    close, pre_close = panel['close'].iloc[pos], panel['close'].iloc[pos - 1]
+    volume, pre_volume = panel['volume'].iloc[pos], panel['volume'].iloc[pos - 1]
+    df['increase'] = (close - pre_close) / pre_close * 100
+    df['volume_ratio'] = volume / pre_volume
 
+    valuation_df = valuation_df.reindex(codes)
+    df['turnover'] = valuation_df['turnover_ratio']
+    df['circulating_market_cap'] = valuation_df['circulating_market_cap']
+    df.index.name = 'code'
+    return df.reset_index()
 
-def save_to_database(conn, result_df, date=None):
+
+def build_selection_snapshot(securities, date):
     """
-    保存结果到数据库
-    
+    构建选股前四步所需的行情快照
+
+    行情数据和估值数据各只请求一次：
+    - 最近2个交易日的日线（经由 market_data 数据源），当日一行用作行情，前一日一行用于计算涨幅和量比
+    - get_fundamentals 一次取回换手率和流通市值
+
     Parameters:
     -----------
-    conn : sqlite3.Connection
-        数据库连接对象
-    result_df : DataFrame
-        选股结果数据
-    date : str, optional
-        指定的日期，格式为'%Y-%m-%d'。如果为None则使用当前日期
+    securities : list
+        股票代码列表
+    date : str
+        交易日期，格式为'%Y-%m-%d'
+
+    Returns:
+    --------
+    DataFrame
+        同 snapshot_from_panel
     """
-    # 获取日期
-    if date is None:
-        date = datetime.now().strftime('%Y-%m-%d')
-    
-    # 删除同一天的数据
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM comprehensive_selections 
-        WHERE DATE(selection_time) = ?
-    ''', (date,))
-    
-    # 准备数据
-    data = []
-    for _, row in result_df.iterrows():
-        data.append((
-            row['code'],          # 股票代码
-            row.get('name', None),  # 股票名称
-            row['close'],         # 最新价
-            row['increase'],      # 涨跌幅
-            row['turnover'],      # 换手率
-            row['volume_ratio'],  # 量比
-            row.get('total_score', 0),  # 总分
-            date                  # 选股时间
-        ))
-    
-    # 插入数据
-    cursor.executemany('''
-        INSERT INTO comprehensive_selections 
-        (code, name, price, change_percent, turnover_rate, volume_ratio, total_score, selection_time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', data)
-    
-    conn.commit()
+    panel = get_provider().history(securities, date, 2, SNAPSHOT_PRICE_FIELDS + ['factor'],
+                                   fq='post')
+    return snapshot_from_panel(panel, -1, fetch_valuation(securities, date))
 
 
-def run_stock_selection(specified_date):
-    
+def get_history_panel(codes, end_date, count, fields):
+    """
+    一次性获取多只股票的日线历史数据（后复权），返回 日期×股票 矩阵
+
+    选股只使用比值和均线的相对大小，与复权基准无关；统一使用后复权，
+    单日和多日模式对同一交易日的计算结果完全一致。
+
+    Parameters:
+    -----------
+    codes : list
+        股票代码列表
+    end_date : str
+        截止日期，格式为'%Y-%m-%d'
+    count : int
+        交易日数量
+    fields : list
+        行情字段，如['close', 'volume']
+
+    Returns:
+    --------
+    dict
+        {字段: DataFrame}，DataFrame的index为日期(升序)，columns为股票代码
+    """
+    return get_provider().history(codes, end_date, count, fields, fq='post')
+
+
+def window_mean(frame, window):
+    """
+    截止每个日期最近window行的均值和有效值个数（忽略缺失值）
+
+    每个窗口独立求和，结果只取决于窗口内的数据，与前面的历史无关，
+    因此对同一交易日，单日和多日模式得到的均值逐位相同。
+
+    Parameters:
+    -----------
+    frame : DataFrame
+        日期×股票 矩阵，index为日期(升序)
+    window : int
+        窗口长度
+
+    Returns:
+    --------
+    tuple
+        (均值DataFrame, 有效值个数DataFrame)
+    """
+    values = frame.to_numpy(dtype='float64')
+    rows, cols = values.shape
+    padded = np.vstack([np.full((window - 1, cols), np.nan), values])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0)
+    valid = ~np.isnan(padded)
+    counts = np.lib.stride_tricks.sliding_window_view(valid, window, axis=0).sum(axis=-1)
+
+    sums = np.empty((rows, cols))
+    chunk = max(1, 4000000 // max(1, cols * window))
+    for lo in range(0, rows, chunk):
+        block = np.ascontiguousarray(windows[lo:lo + chunk])
+        sums[lo:lo + chunk] = np.nansum(block, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return (pd.DataFrame(means, index=frame.index, columns=frame.columns),
+            pd.DataFrame(counts, index=frame.index, columns=frame.columns))
+
+
+def volume_trend_mask(volume):
+    """
+    成交量趋势条件（第五步），在 日期×股票 的成交量矩阵上向量化计算
+
+    每个日期按截止当日的5日窗口判断：
+    1. 窗口内5日成交量完整
+    2. 当日成交量高于5日均量
+    3. 窗口内不存在"连续两天增长后第三天跌幅>5%"的形态
+
+    Parameters:
+    -----------
+    volume : DataFrame
+        成交量矩阵，index为日期(升序)，columns为股票代码
+
+    Returns:
+    --------
+    DataFrame
+        与volume同形状的布尔矩阵
+    """
+    sma5, count5 = window_mean(volume, 5)
+    complete = count5 == 5
+    trend_up = volume > sma5
+
+    prev = volume.shift(1)
+    up = volume > prev
+    # 第三天(j)：j-1日较j-2日增长、j日较j-1日增长、且j日较j-1日下跌超过5%
+    bad = up.shift(1, fill_value=False) & up & (volume < 0.95 * prev)
+    # 5日窗口内"第三天"只可能落在最后3天
+    has_bad_pattern = bad.astype(float).rolling(3, min_periods=1).max() > 0
+
+    return complete & trend_up & ~has_bad_pattern
+
+
+def ma_alignment_mask(close):
+    """
+    均线多头排列条件（第六步），在 日期×股票 的收盘价矩阵上向量化计算
+
+    MA5 > MA10 > MA20 > MA60，且当日收盘价高于全部四条均线。
+    均线按截止当日的最近N个交易日计算，缺失值不参与平均。
+
+    Parameters:
+    -----------
+    close : DataFrame
+        收盘价矩阵，index为日期(升序)，columns为股票代码
+
+    Returns:
+    --------
+    DataFrame
+        与close同形状的布尔矩阵
+    """
+    ma5, ma10, ma20, ma60 = [window_mean(close, n)[0] for n in (5, 10, 20, 60)]
+    aligned = (ma5 > ma10) & (ma10 > ma20) & (ma20 > ma60)
+    above = (close > ma5) & (close > ma10) & (close > ma20) & (close > ma60)
+    return aligned & above
+
+
+# 选股阈值，可在调用时整体或部分覆盖
+SELECTION_PARAMS = {
+    'increase_min': 3,          # 涨幅下限(%)
+    'increase_max': 5,          # 涨幅上限(%)
+    'volume_ratio_min': 1,      # 量比下限
+    'turnover_min': 5,          # 换手率下限(%)
+    'turnover_max': 10,         # 换手率上限(%)
+    'market_cap_min': 50,       # 流通市值下限(亿)
+    'market_cap_max': 200,      # 流通市值上限(亿)
+}
+
+
+def _increase_filter(data, params):
+    return (data['increase'] >= params['increase_min']) & (data['increase'] <= params['increase_max'])
+
+
+def _volume_ratio_filter(data, params):
+    return data['volume_ratio'] >= params['volume_ratio_min']
+
+
+def _turnover_filter(data, params):
+    return (data['turnover'] >= params['turnover_min']) & (data['turnover'] <= params['turnover_max'])
+
+
+def _market_cap_filter(data, params):
+    return ((data['circulating_market_cap'] >= params['market_cap_min']) &
+            (data['circulating_market_cap'] <= params['market_cap_max']))
+
+
+def _volume_trend_filter(data, params):
+    return volume_trend_mask(data['volume_history'])
+
+
+def _ma_alignment_filter(data, params):
+    return ma_alignment_mask(data['close_history'])
+
+
+def _outperform_filter(data, params):
+    return data['increase'] > data['benchmark_increase']
+
+
+# 选股条件，执行时按数据依赖的代价排序：先快照条件，再基准指数，最后历史数据
+SELECTION_STAGES = [
+    Stage('increase', '涨幅在 {increase_min}-{increase_max}% 之间的股票数量',
+          _increase_filter, SNAPSHOT, ('increase_min', 'increase_max')),
+    Stage('volume_ratio', '量比大于等于{volume_ratio_min}的股票数量',
+          _volume_ratio_filter, SNAPSHOT, ('volume_ratio_min',)),
+    Stage('turnover', '换手率在 {turnover_min}-{turnover_max}% 之间的股票数量',
+          _turnover_filter, SNAPSHOT, ('turnover_min', 'turnover_max')),
+    Stage('market_cap', '流通市值在 {market_cap_min}-{market_cap_max}亿 之间的股票数量',
+          _market_cap_filter, SNAPSHOT, ('market_cap_min', 'market_cap_max')),
+    Stage('volume_trend', '符合趋势条件且无异常波动的股票剩余',
+          _volume_trend_filter, HISTORY),
+    Stage('ma_alignment', '均线多头向上发散的股票数量',
+          _ma_alignment_filter, HISTORY),
+    Stage('outperform', '跑赢大盘的股票数量',
+          _outperform_filter, BENCHMARK),
+]
+
+
+def run_selection_pipeline(specified_date, params=None, stages=None):
+    """
+    对指定交易日执行选股流水线，不保存结果
+
+    Parameters:
+    -----------
+    specified_date : str
+        交易日期，格式为'%Y-%m-%d'
+    params : dict, optional
+        覆盖 SELECTION_PARAMS 中的部分阈值
+    stages : list, optional
+        选股条件，默认 SELECTION_STAGES
+
+    Returns:
+    --------
+    PipelineResult
+        selected为选中股票的快照行，metrics为各条件的行数、耗时和数据获取量
+    """
+    params = dict(SELECTION_PARAMS, **(params or {}))
+    stages = SELECTION_STAGES if stages is None else stages
+
+    start_time = time.time()
     # 获取所有股票的基本信息
     all_stocks = get_all_securities(types=['stock']).index.tolist()
+    # 获取交易日所有股票的行情快照（涨幅、量比、换手率、流通市值）
+    df = build_selection_snapshot(all_stocks, specified_date)
+    source = {'rows_in': len(all_stocks), 'seconds': time.time() - start_time,
+              'rows_fetched': len(all_stocks) * 3}
 
-    # 获取交易日所有股票的行情数据
-    df = get_price(all_stocks, end_date=specified_date, count=1, frequency='1d', 
-                   fields=['close', 'open', 'high', 'low', 'volume', 'money'], panel=False)
-    df = df.reset_index()
-
-    # 计算涨幅
-    pre_close_df = get_price(all_stocks, end_date=specified_date, count=2, frequency='1d', 
-                             fields=['close'], panel=False)
-    pre_close_df = pre_close_df.reset_index()
-    pre_close = pre_close_df.groupby('code')['close'].nth(0)
-    df['increase'] = (df['close'] - df['code'].map(pre_close)) / df['code'].map(pre_close) * 100
-
-    # 计算量比
-    prev_volume = get_price(all_stocks, end_date=specified_date, count=2, frequency='1d', 
-                            fields=['volume'], panel=False)
-    prev_volume = prev_volume.reset_index().groupby('code')['volume'].nth(0)
-    df['volume_ratio'] = df['volume'] / df['code'].map(prev_volume)
-
-    # 获取换手率
-    turnover_df = get_fundamentals(query(valuation.code, valuation.turnover_ratio).filter(valuation.code.in_(all_stocks)), 
-                                   date=specified_date)
-    turnover_dict = dict(zip(turnover_df['code'], turnover_df['turnover_ratio']))
-    df['turnover'] = df['code'].map(turnover_dict)
-
-    # 获取流通市值
-    cap_df = get_fundamentals(query(valuation.code, valuation.circulating_market_cap).filter(valuation.code.in_(all_stocks)), 
-                              date=specified_date)
-    cap_dict = dict(zip(cap_df['code'], cap_df['circulating_market_cap']))
-    df['circulating_market_cap'] = df['code'].map(cap_dict)
-
-    print(f"\n开始筛选，初始股票池数量: {len(df)} 只")
-
-    # 第一步：涨幅筛选
-    filtered_df1 = df[(df['increase'] >= 3) & (df['increase'] <= 5)]
-    print(f"1. 涨幅在 3-5% 之间的股票数量: {len(filtered_df1)} 只")
-
-    # 第二步：量比筛选
-    filtered_df2 = filtered_df1[filtered_df1['volume_ratio'] >= 1]
-    print(f"2. 量比大于等于1的股票数量: {len(filtered_df2)} 只")
-
-    # 第三步：换手率筛选
-    filtered_df3 = filtered_df2[(filtered_df2['turnover'] >= 5) & (filtered_df2['turnover'] <= 10)]
-    print(f"3. 换手率在 5-10% 之间的股票数量: {len(filtered_df3)} 只")
-
-    # 第四步：流通市值筛选
-    filtered_df4 = filtered_df3[(filtered_df3['circulating_market_cap'] >= 50) & 
-                               (filtered_df3['circulating_market_cap'] <= 200)]
-    print(f"4. 流通市值在 50-200亿 之间的股票数量: {len(filtered_df4)} 只")
-
-    # 第五步：成交量筛选
-    valid_stocks = []
-    for stock in filtered_df4['code'].tolist():
-        # 获取前5日成交量数据（保持原日期逻辑）
-        volumes_data = get_price(
-            stock, 
-            end_date=specified_date, 
-            count=5, 
-            frequency='1d', 
-            fields=['volume'], 
-            panel=False
-        )
-    
-        # 数据完整性检查
-        if volumes_data is None or len(volumes_data) != 5:
-            continue
-    
-        # 处理数据顺序（确保旧→新）
-        dates = volumes_data.index.tolist()
-        volumes = volumes_data['volume'].tolist()
-        if dates[0] > dates[-1]:  # 日期降序时反转
-            volumes = volumes[::-1]
-        
-        # 规则1：计算5日移动平均线判断整体趋势
-        sma5 = sum(volumes) / 5  # 简单移动平均
-        trend_up = volumes[-1] > sma5  # 最新成交量高于均线
-        
-        # 规则2：检查连续两天增长后第三天跌幅>5%的情况
-        has_bad_pattern = False
-        for i in range(len(volumes)-2):
-            # 连续两天增长
-            cond1 = (volumes[i+1] > volumes[i]) 
-            cond2 = (volumes[i+2] > volumes[i+1])
-            # 第三天跌幅超过5%
-            cond3 = (volumes[i+2] < 0.95 * volumes[i+1])
-            if cond1 and cond2 and cond3:
-                has_bad_pattern = True
-                break
-    
-        # 综合判断
-        if trend_up and not has_bad_pattern:
-            valid_stocks.append(stock)
-    # for stock in filtered_df4['code'].tolist():
-    #     volumes = get_price(stock, end_date=prev_trading_date, count=5, frequency='1d', 
-    #                        fields=['volume'], panel=False)['volume']
-    #     if all(volumes[i + 1] > volumes[i] for i in range(len(volumes) - 1)) == True:
-    #         valid_stocks.append(stock)
-
-    filtered_df5 = filtered_df4[filtered_df4['code'].isin(valid_stocks)]
-    print(f"5. 符合趋势条件且无异常波动的股票剩余: {len(filtered_df5)} 只")
-
-    # 第六步：均线及K线形态筛选
-    valid_stocks = []
-    for stock in filtered_df5['code'].tolist():
-        hist_data = get_price(stock, end_date=specified_date, count=60, frequency='1d', 
-                             fields=['close'], panel=False)
-        ma5 = hist_data['close'][-5:].mean()
-        ma10 = hist_data['close'][-10:].mean()
-        ma20 = hist_data['close'][-20:].mean()
-        ma60 = hist_data['close'][-60:].mean()
-        #print(stock, ma5,ma10,ma20,ma60)
-        if ma5 > ma10 > ma20 > ma60:
-            last_close = hist_data['close'][-1]
-            if last_close > ma5 and last_close > ma10 and last_close > ma20 and last_close > ma60:
-                valid_stocks.append(stock)
-
-    filtered_df6 = filtered_df5[filtered_df5['code'].isin(valid_stocks)]
-    print(f"6. 均线多头向上发散的股票数量: {len(filtered_df6)} 只")
-
-    # 第七步：分时图及热点题材筛选
-    benchmark_data = get_price('000300.XSHG', end_date=specified_date, count=1, frequency='1d', 
-                              fields=['close'], panel=False)
-    benchmark_pre_close = get_price('000300.XSHG', end_date=specified_date, count=2, frequency='1d', 
-                                   fields=['close'], panel=False)['close'][0]
-    benchmark_increase = (benchmark_data['close'][-1] - benchmark_pre_close) / benchmark_pre_close * 100
-
-    valid_stocks = []
-    for stock in filtered_df6['code'].tolist():
-        if filtered_df6[filtered_df6['code'] == stock]['increase'].values[0] > benchmark_increase:
-            valid_stocks.append(stock)
-
-    filtered_df7 = filtered_df6[filtered_df6['code'].isin(valid_stocks)]
-    print(f"7. 跑赢大盘的股票数量: {len(filtered_df7)} 只")
+    def load_history(codes):
+        hist = get_history_panel(codes, specified_date, HISTORY_DAYS, ['close', 'volume'])
+        return ({'close_history': hist['close'], 'volume_history': hist['volume']},
+                len(codes) * HISTORY_DAYS)
+
+    def load_benchmark(codes):
+        close = get_history_panel([BENCHMARK_INDEX], specified_date, EXCESS_RETURN_DAYS + 1,
+                                  ['close'])['close'][BENCHMARK_INDEX]
+        increase = (close.iloc[-1] - close.iloc[-2]) / close.iloc[-2] * 100
+        return ({'benchmark_increase': increase, 'benchmark_close': close},
+                EXCESS_RETURN_DAYS + 1)
+
+    loaders = {HISTORY: load_history, BENCHMARK: load_benchmark}
+    result = run_pipeline(stages, df, loaders, params, source=source)
+    if len(result.selected):
+        ma_spread = ma_spread_matrix(result.data['close_history']).iloc[-1]
+        excess_return = excess_return_matrix(result.data['close_history'],
+                                             result.data['benchmark_close']).iloc[-1]
+        result.selected = score_selection(result.selected, ma_spread, excess_return)
+    return result
+
+
+def ma_spread_matrix(close):
+    """均线发散程度 MA5/MA60-1，日期×股票 矩阵"""
+    return window_mean(close, 5)[0] / window_mean(close, 60)[0] - 1
+
+
+def excess_return_matrix(close, benchmark_close, days=EXCESS_RETURN_DAYS):
+    """
+    近days个交易日涨幅相对基准指数的超额收益(%)，日期×股票 矩阵
+
+    当日涨幅减去基准当日涨幅对同一交易日的全部股票平移相同的量，排名与涨幅因子相同；
+    区间收益因股票而异，作为独立的打分因子。
+
+    Parameters:
+    -----------
+    close : DataFrame
+        日期×股票 的收盘价（后复权）
+    benchmark_close : Series
+        基准指数收盘价，index须覆盖close中需要计算的交易日及其前days个交易日
+    days : int
+        区间交易日数
+    """
+    stock_return = (close / close.shift(days) - 1) * 100
+    benchmark_return = ((benchmark_close / benchmark_close.shift(days) - 1) * 100).reindex(close.index)
+    return stock_return.sub(benchmark_return, axis=0)
+
+
+def score_selection(df, ma_spread, excess_return):
+    """
+    为选中股票补充ma_spread、excess_return因子并计算总分，按总分从高到低排序
+
+    Parameters:
+    -----------
+    df : DataFrame
+        选中股票的快照行
+    ma_spread : Series
+        以股票代码为index的均线发散程度
+    excess_return : Series
+        以股票代码为index的区间超额收益，见 excess_return_matrix
+    """
+    df = df.copy()
+    df['ma_spread'] = df['code'].map(ma_spread)
+    df['excess_return'] = df['code'].map(excess_return)
+    df['total_score'] = score_candidates(df)
+    return top_k(df, None).reset_index(drop=True)
+
+
+@profiled()
+def run_stock_selection(specified_date, params=None):
+    """
+    执行选股并保存结果到数据库
+
+    Parameters:
+    -----------
+    specified_date : str
+        交易日期，格式为'%Y-%m-%d'
+    params : dict, optional
+        覆盖 SELECTION_PARAMS 中的部分阈值
+
+    Returns:
+    --------
+    list
+        选中的股票代码列表
+    """
+    result = run_selection_pipeline(specified_date, params)
+    profiler = get_profiler()
+    if profiler.enabled:
+        # 流水线已经记录了每个条件的耗时和数据获取量，直接记入统计
+        for row in result.metrics.itertuples():
+            profiler.record(f'selection.{row.stage}', row.seconds, row.rows_fetched)
+
+    print(f"\n开始筛选，初始股票池数量: {result.metrics['rows_out'].iloc[0]} 只")
+    print(result.summary())
     print("\n筛选完成！")
 
     # 保存结果到数据库
     os.makedirs('daily_rs', exist_ok=True)
     conn = init_database()
-    save_to_database(conn, filtered_df7, specified_date)
-    conn.close()
+    save_to_database(conn, result.selected, specified_date)
     print('结果已保存到数据库')
-    
-    final_stock_codes = filtered_df7['code'].tolist()
+
+    final_stock_codes = result.selected['code'].tolist()
     return final_stock_codes
 
-def get_recent_selections(days=7):
+
+def run_stock_selection_range(start_date, end_date, save=True, params=None):
     """
-    获取最近N天的选股结果
-    
+    对一段时间内的每个交易日执行选股，结果与逐日调用 run_stock_selection 相同
+
+    整个区间（含60日均线所需的预热窗口）的日线只加载一次，SELECTION_STAGES
+    中的条件在 日期×股票 矩阵上一次性计算；估值数据按交易日各查询一次。
+
     Parameters:
     -----------
-    days : int, default 7
-        要查询的天数
-        
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    save : bool, default True
+        是否将每个交易日的结果保存到数据库
+    params : dict, optional
+        覆盖 SELECTION_PARAMS 中的部分阈值
+
     Returns:
     --------
-    DataFrame
-        包含日期和选股数量的DataFrame
+    dict
+        {交易日('%Y-%m-%d'): 选中的股票代码列表}
     """
-    conn = sqlite3.connect('daily_rs/stock_selection.db')
-    
-    query = '''
-    SELECT 
-        DATE(selection_time) as date,
-        COUNT(DISTINCT code) as stock_count
-    FROM comprehensive_selections 
-    WHERE DATE(selection_time) >= DATE('now', ?)
-    GROUP BY DATE(selection_time)
-    ORDER BY date DESC
-    '''
-    
-    date_condition = f'-{days} days'
-    df = pd.read_sql_query(query, conn, params=(date_condition,))
-    conn.close()
-    
-    # 重命名列
-    df.columns = ['日期', '股票数量']
-    
-    return df
+    data = load_selection_range(start_date, end_date)
+    if data is None:
+        return {}
+    params = dict(SELECTION_PARAMS, **(params or {}))
+    masks = evaluate_masks(SELECTION_STAGES, data, params, data['index'])
+    selected = combine_masks(masks.values())
+
+    ma_spread = ma_spread_matrix(data['close_history'])
+    excess_return = data['excess_return']
+
+    results = {}
+    conn = init_database() if save else None
+    for date in data['dates']:
+        day = pd.Timestamp(date)
+        row = selected.loc[day]
+        codes = row.index[row.to_numpy()].tolist()
+        pos = data['close_history'].index.get_loc(day)
+        panel = {field: frame[codes] for field, frame in data['panel'].items()}
+        df = snapshot_from_panel(panel, pos, data['valuations'][date])
+        df = score_selection(df, ma_spread.loc[day], excess_return.loc[day])
+        results[date] = df['code'].tolist()
+        print(f"{date} 选中股票数量: {len(results[date])} 只")
+        if save:
+            save_to_database(conn, df, date)
+    if save:
+        print('结果已保存到数据库')
+    return results
+
+
+def combine_masks(masks):
+    """对多个布尔矩阵取交集"""
+    masks = list(masks)
+    selected = masks[0]
+    for mask in masks[1:]:
+        selected = selected & mask
+    return selected
 
-def get_stocks_by_date(date):
+
+def load_selection_range(start_date, end_date):
     """
-    获取指定日期的所有选中股票代码
-    
-    Parameters:
-    -----------
-    date : str
-        指定的日期，格式为'%Y-%m-%d'
-        
+    加载多日选股所需的全部数据，供 evaluate_masks 使用
+
     Returns:
     --------
-    list
-        选中的股票代码列表
+    dict or None
+        选股条件用到的各列(日期×股票矩阵)，以及dates(交易日列表)、index(交易日索引)、
+        panel(后复权日线)、valuations({交易日: 估值数据})；区间内没有交易日时返回None
     """
-    conn = sqlite3.connect('daily_rs/stock_selection.db')
-    
-    query = '''
-    SELECT code
-    FROM comprehensive_selections 
-    WHERE selection_time = ?
-    ORDER BY total_score DESC
-    '''
-    
-    df = pd.read_sql_query(query, conn, params=(date,))
-    conn.close()
-    
-    return df['code'].tolist()
+    all_stocks = get_all_securities(types=['stock']).index.tolist()
+    provider = get_provider()
+    dates = provider.get_trade_days(start_date=start_date, end_date=end_date)
+    if not dates:
+        return None
+
+    # 向前多取 HISTORY_DAYS-1 个交易日，首日的均线窗口和前收盘价都落在其中
+    window = provider.get_trade_days(end_date=dates[-1], count=len(dates) + HISTORY_DAYS - 1)
+    panel = provider.history_range(all_stocks + [BENCHMARK_INDEX], window[0], window[-1],
+                                   SNAPSHOT_PRICE_FIELDS + ['factor'], fq='post')
+    benchmark_close = panel['close'][BENCHMARK_INDEX]
+    panel = {field: frame[all_stocks] for field, frame in panel.items()}
+    close, volume = panel['close'], panel['volume']
+
+    pre_close, pre_volume = close.shift(1), volume.shift(1)
+    increase = (close - pre_close) / pre_close * 100
+    benchmark_pre_close = benchmark_close.shift(1)
+    benchmark_increase = (benchmark_close - benchmark_pre_close) / benchmark_pre_close * 100
+
+    valuations = {date: fetch_valuation(all_stocks, date) for date in dates}
+    index = pd.DatetimeIndex(dates)
+
+    def stack(column):
+        frame = pd.DataFrame({date: valuations[date][column] for date in dates}).T
+        return frame.set_axis(index).reindex(columns=all_stocks)
+
+    return {
+        'dates': dates,
+        'index': index,
+        'panel': panel,
+        'valuations': valuations,
+        'increase': increase,
+        'volume_ratio': volume / pre_volume,
+        'turnover': stack('turnover_ratio'),
+        'circulating_market_cap': stack('circulating_market_cap'),
+        'close_history': close,
+        'volume_history': volume,
+        'excess_return': excess_return_matrix(close, benchmark_close),
+        'benchmark_increase': pd.DataFrame(np.repeat(benchmark_increase.to_numpy()[:, None],
+                                                     len(all_stocks), axis=1),
+                                           index=close.index, columns=all_stocks),
+    }
 
 if __name__ == '__main__':
     # 测试运行
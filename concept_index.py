@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class ConceptIndex(object):
+    def __init__(self, date, concepts, codes, membership):
+        """
+        某个交易日的 概念×股票 成分股稀疏矩阵
+
+        Parameters:
+        -----------
+        date : str
+            成分股对应的交易日，格式为'%Y-%m-%d'
+        concepts : list
+            概念代码，对应矩阵的行
+        codes : list
+            全部成分股代码，对应矩阵的列
+        membership : scipy.sparse.csr_matrix
+            (概念数, 股票数)，成分股为1
+        """
+        self.date = date
+        self.concepts = list(concepts)
+        self.codes = list(codes)
+        self.membership = membership
+
+    @classmethod
+    def build(cls, concepts, date):
+        """按概念逐个调用 get_concept_stocks 建立成分股矩阵，每个交易日只需建立一次"""
+        concepts = sorted(concepts)
+        members = [get_concept_stocks(concept_code=concept, date=date) or [] for concept in concepts]
+        codes = sorted({code for stock_list in members for code in stock_list})
+        pos = {code: i for i, code in enumerate(codes)}
+        indptr = np.cumsum([0] + [len(stock_list) for stock_list in members])
+        indices = np.array([pos[code] for stock_list in members for code in stock_list], dtype=int)
+        membership = sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                                       shape=(len(concepts), len(codes)))
+        # 同一概念中重复的股票只计一次
+        membership.sum_duplicates()
+        membership.data[:] = 1
+        return cls(date, concepts, codes, membership)
+
+    def average(self, values):
+        """
+        概念内成分股的平均值，缺失值不计入，与逐个概念求 mean() 一致
+
+        Parameters:
+        -----------
+        values : Series
+            以股票代码为index的全市场数值
+
+        Returns:
+        --------
+        Series
+            以概念代码为index，没有任何有效数据的概念不包含在内
+        """
+        vector = values.reindex(self.codes).to_numpy(dtype=float)
+        valid = ~np.isnan(vector)
+        total = self.membership @ np.where(valid, vector, 0.0)
+        count = self.membership @ valid.astype(float)
+        has_data = count > 0
+        return pd.Series(total[has_data] / count[has_data],
+                         index=np.asarray(self.concepts)[has_data])
+
+    def top(self, values, k):
+        """按成分股平均值从高到低取前k个概念"""
+        avg = self.average(values)
+        order = np.argsort(-avg.to_numpy(), kind='stable')[:k]
+        return avg.index[order].tolist()
+
+
+# 按交易日缓存的成分股矩阵，只保留最近一个交易日
+_indexes = {}
+
+
+def get_concept_index(concepts, date):
+    """
+    获取交易日date的概念成分股矩阵，同一交易日只建立一次
+
+    Parameters:
+    -----------
+    concepts : iterable
+        概念代码
+    date : str, datetime or Timestamp
+        交易日
+    """
+    day = pd.Timestamp(date).strftime('%Y-%m-%d')
+    key = (day, frozenset(concepts))
+    if key not in _indexes:
+        _indexes.clear()
+        _indexes[key] = ConceptIndex.build(key[1], day)
+    return _indexes[key]
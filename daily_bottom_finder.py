@@ -3,6 +3,10 @@ from jqdata import *
 from enum import Enum
 import pandas as pd
 
+from candle_stick_ananly import (LEVEL_COLUMNS, pivot_panel, low_and_high_from_bars,
+                                 IntradayLevelEstimator)
+from minute_store import get_minute_store
+
 # 用到回测API请加入下面的语句
 from kuanke.user_space_api import *
 
@@ -83,58 +87,33 @@ def buy_order(context):
 
 
 # 根据历史数据获取对应的最低价格区间&最高价格区间
+# 所有股票的日线和分钟线各只请求一次，计算逻辑与 candle_stick_ananly 共用
 def get_low_and_high(end_date, security_list):
-    cols = ['p_close','open','close','high','low','low_after_high', 'high_after_low',
-            'hc','hd','hx','ha','lc','ld','lx','la',
-            'no']
-    rs = pd.DataFrame({}, columns = cols, index = security_list,dtype=float)
-    rs = rs.fillna(0)
-    rs.index.name = 'security'
-#     #print(end_date)
-    for security in security_list:
-        line = rs.loc[security]
-
-        #获取到截止日期T-N交易日的数据
-        df = get_price(security, count=2, end_date= end_date,
-                   frequency='daily', fields=['open','close','high','low'])
-
-        #最后一个交易日K线中的最高价后的对低价，最低价后的最高价
-        td = get_price(security, count = 240 ,end_date=str("%s 16:00:00" % end_date),
-                   frequency='minute',fields=['high','low'])
-        #实际分钟K线的最高&最低价格
-        high = max(td.high)
-        low = min(td.low)
-
-        #最高&最低的分钟位置
-        #如果有多个最高价或最低价，则选择最后一个
-        high_line = (td[td.high == high]).tail(1)
-        low_line = (td[td.low == low]).tail(1)
-
-        high_after_low = max(td.loc[low_line.index[0]:, 'high'])
-        low_after_high = min(td.loc[high_line.index[0]:,'low'])
-
-        c = df.tail(1) #当日数据
-        p = df.head(1) #前一个交易日数据
-
-        line.p_close = p.close[0]
-        line.open, line.close, line.high, line.low = c.open, c.close, high, low
-        line.low_after_high = low_after_high
-        line.high_after_low = high_after_low
-
-        hc = (c.high[0]/p.close[0]) * c.close[0]
-        hd = (c.high[0]/c.open[0]) * c.close[0]
-        # hx =  (最低价后高点/最低价) * 当日收盘
-        hx = (high_after_low/c.low[0]) * c.close[0]
-        ha = (hc+hd+hx)/3
-
-
-        lc = (c.low[0]/ c.open[0]) * c.close[0]
-        ld = (c.low[0]/ p.close[0]) * c.close[0]
-        #lx =  (最高价后低点/当日最高) * 当日收盘
-        lx = (low_after_high/c.high[0] ) * c.close[0]
-        la = (lc+ld+lx)/3
-        #print('lc:¥ %.2f, ld: ¥%.2f, lx:¥%.2f, la:¥ %.2f' % (lc, ld, lx, la))
-        line.hc, line.hd, line.hx, line.ha = round(hc,2), round(hd,2), round(hx,2), round(ha,2)
-        line.lc, line.ld, line.lx, line.la = round(lc,2), round(ld,2), round(lx,2), round(la,2)
-        line.no = round((line.open/line.p_close)* line.close,2)
-    return(rs)
+    security_list = list(security_list)
+    if not security_list:
+        rs = pd.DataFrame({}, columns=LEVEL_COLUMNS, dtype=float)
+        rs.index.name = 'security'
+        return rs
+    #获取到截止日期T-N交易日的数据，前复权基准为end_date，当日价格即实际价格，与不复权的分钟线一致
+    df = get_price(security_list, count=2, end_date= end_date,
+                   frequency='daily', fields=['open','close','high','low'], fq='pre',
+                   pre_factor_ref_date=end_date, panel=False)
+    daily = pivot_panel(df, ['open','close','high','low'], security_list)
+
+    #最后一个交易日的分钟K线
+    return(low_and_high_from_bars(daily, get_minute_high_low(end_date, security_list), security_list))
+
+
+# 交易日end_date的分钟最高价&最低价
+# 有本地分钟线缓存时从缓存读取；研究环境等没有文件缓存时直接调用 get_price
+def get_minute_high_low(end_date, security_list):
+    store = get_minute_store()
+    if store.root is not None:
+        try:
+            return {field: store.window(security_list, end_date, field) for field in ['high','low']}
+        except OSError:
+            pass
+    td = get_price(security_list, count = 240 ,end_date=str("%s 16:00:00" % end_date),
+                   frequency='minute',fields=['high','low'], fq='pre',
+                   pre_factor_ref_date=end_date, panel=False)
+    return pivot_panel(td, ['high','low'], security_list)
@@ -0,0 +1,123 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import time
+
+import numpy as np
+import pandas as pd
+
+from candle_stick_ananly import compute_levels
+from market_data import get_provider
+from minute_store import get_minute_store
+from selection_db import ENTRY_LEVEL_FIELDS, init_database, save_entry_levels
+
+# 每批处理的交易日数，全市场时每个交易日的分钟线约占 240×5000×8 字节×2 个字段
+CHUNK_DAYS = 5
+
+
+def daily_level_inputs(codes, days):
+    """
+    计算价格区间需要的日线矩阵
+
+    当日价格为实际价格，前收盘价按当日复权因子换算，与 get_low_and_high 中
+    以当日为基准的前复权一致。
+
+    Returns:
+    --------
+    dict
+        {'p_close', 'open', 'close', 'high', 'low': DataFrame}，交易日×股票
+    """
+    provider = get_provider()
+    start = provider.get_trade_days(end_date=days[0], count=2)[0]
+    bars = provider.get_bars(codes, start, days[-1], ['open', 'close', 'high', 'low', 'factor'])
+    factor = bars['factor'].ffill()
+    inputs = {field: bars[field] / factor for field in ['open', 'close', 'high', 'low']}
+    inputs['p_close'] = bars['close'].shift(1) / factor
+    index = pd.DatetimeIndex(days)
+    return {field: frame.reindex(index) for field, frame in inputs.items()}
+
+
+def minute_cube(codes, days, field):
+    """从分钟线缓存读取 (240, 交易日数, 股票数) 的分钟线立方体"""
+    store = get_minute_store()
+    return np.stack([store.window(codes, day, field).to_numpy(dtype=float) for day in days],
+                    axis=1)
+
+
+def level_series_kernel(daily, minute_high, minute_low):
+    """
+    在整个 交易日×股票 区间上一次计算价格区间
+
+    把分钟线立方体展开为 (240, 交易日数×股票数)，每个(交易日, 股票)作为一列
+    交给 compute_levels，一次向量化完成。
+
+    Parameters:
+    -----------
+    daily : dict
+        daily_level_inputs 的返回值
+    minute_high, minute_low : ndarray
+        (240, 交易日数, 股票数) 的分钟线
+
+    Returns:
+    --------
+    DataFrame
+        trade_date, code 以及 ENTRY_LEVEL_FIELDS，只包含有分钟数据的行
+    """
+    n_minutes, n_days, n_codes = minute_high.shape
+    flat = {field: frame.to_numpy(dtype=float).ravel() for field, frame in daily.items()}
+    values, valid = compute_levels(flat['p_close'], flat['open'], flat['close'],
+                                   flat['high'], flat['low'],
+                                   minute_high.reshape(n_minutes, -1),
+                                   minute_low.reshape(n_minutes, -1))
+    frame = daily['close']
+    result = pd.DataFrame({column: values[column][valid] for column in ENTRY_LEVEL_FIELDS})
+    result.insert(0, 'code', np.tile(np.asarray(frame.columns), n_days)[valid])
+    result.insert(0, 'trade_date', np.repeat(frame.index.strftime('%Y-%m-%d'), n_codes)[valid])
+    return result
+
+
+def compute_level_series(start_date, end_date, codes=None, chunk_days=CHUNK_DAYS, save=True):
+    """
+    计算一段时间内全市场每只股票每个交易日的入场/离场价格
+
+    按chunk_days个交易日一批读取分钟线立方体并向量化计算，结果写入
+    entry_levels 表，供离线回测不同的入场规则。
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    codes : list, optional
+        股票代码列表，默认为end_date的全部上市股票
+    chunk_days : int
+        每批处理的交易日数
+    save : bool
+        是否写入数据库
+
+    Returns:
+    --------
+    DataFrame
+        trade_date, code 以及 ENTRY_LEVEL_FIELDS
+    """
+    if codes is None:
+        codes = get_all_securities(types=['stock'], date=end_date).index.tolist()
+    codes = list(codes)
+    days = get_provider().get_trade_days(start_date=start_date, end_date=end_date)
+    conn = init_database() if save else None
+
+    results = []
+    for i in range(0, len(days), chunk_days):
+        start_time = time.time()
+        chunk = days[i:i + chunk_days]
+        levels = level_series_kernel(daily_level_inputs(codes, chunk),
+                                     minute_cube(codes, chunk, 'high'),
+                                     minute_cube(codes, chunk, 'low'))
+        if conn is not None:
+            save_entry_levels(conn, levels)
+        results.append(levels)
+        print(f"{chunk[0]} ~ {chunk[-1]} 计算 {len(levels)} 行，耗时 {time.time() - start_time:.1f} 秒")
+
+    if not results:
+        return pd.DataFrame(columns=['trade_date', 'code'] + ENTRY_LEVEL_FIELDS)
+    return pd.concat(results, ignore_index=True)
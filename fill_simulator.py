@@ -0,0 +1,147 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+
+import numpy as np
+import pandas as pd
+
+from market_data import get_provider
+from minute_store import MINUTES_PER_DAY, get_minute_store, minute_offset, minute_time
+
+
+class TradeCost(object):
+    def __init__(self, open_tax=0, close_tax=0.001, open_commission=0.0003,
+                 close_commission=0.0003, min_commission=5):
+        """
+        交易费用，参数与聚宽 OrderCost 相同，默认值与策略中 set_order_cost 的设置一致：
+        买入佣金万分之三，卖出佣金万分之三加千分之一印花税，每笔佣金最低5元
+        """
+        self.open_tax = open_tax
+        self.close_tax = close_tax
+        self.open_commission = open_commission
+        self.close_commission = close_commission
+        self.min_commission = min_commission
+
+    def apply(self, value, is_buy):
+        """
+        按成交额计算佣金和税费
+
+        Parameters:
+        -----------
+        value : ndarray
+            成交额，未成交为0
+        is_buy : ndarray
+            是否买入
+
+        Returns:
+        --------
+        tuple
+            (佣金, 税费)，未成交的订单均为0
+        """
+        rate = np.where(is_buy, self.open_commission, self.close_commission)
+        commission = np.where(value > 0, np.maximum(value * rate, self.min_commission), 0.0)
+        tax = value * np.where(is_buy, self.open_tax, self.close_tax)
+        return commission, tax
+
+
+# 策略中 set_order_cost 使用的费用设置
+DEFAULT_COST = TradeCost()
+
+
+def rebase_prices(codes, prices, price_date, day):
+    """
+    把以price_date为前复权基准的价格换算为交易日day的实际价格，即乘以
+    factor[price_date] / factor[day]，与 backtest_engine.load_entry_prices 的换算相同
+
+    Parameters:
+    -----------
+    codes : list
+        每个价格对应的股票代码
+    prices : ndarray
+        以price_date为基准的前复权价格，例如 get_low_and_high(price_date) 的入场价
+    price_date, day : str
+        价格的复权基准日和成交日
+
+    Returns:
+    --------
+    ndarray
+        交易日day的实际价格，缺少复权因子的股票不做换算
+    """
+    unique = list(dict.fromkeys(codes))
+    factor = get_provider().get_bars(unique, price_date, day, ['factor'])['factor'].ffill()
+    if factor.empty:
+        return prices
+    ratio = (factor.iloc[0] / factor.iloc[-1]).reindex(unique).fillna(1.0)
+    return prices * ratio.reindex(codes).to_numpy(dtype=float)
+
+
+def simulate_limit_fills(day, orders, cost=DEFAULT_COST, price_date=None):
+    """
+    用分钟线模拟一个交易日内限价单的成交
+
+    从下单分钟开始，买单在第一根最低价不高于限价的分钟线成交，卖单在第一根最高价
+    不低于限价的分钟线成交。该分钟开盘价已经优于限价时按开盘价成交，否则按限价成交。
+    当日全部订单一次读取分钟线，按 (240, 订单数) 的数组一次计算。
+
+    分钟线为不复权价格。限价以其他交易日为前复权基准时（如前一交易日的入场价）须传入
+    price_date，先换算为当日实际价格再比较；不传时限价视为当日实际价格。
+
+    Parameters:
+    -----------
+    day : str
+        交易日，格式为'%Y-%m-%d'
+    orders : DataFrame
+        每行一个订单：code, side('buy'/'sell'), limit_price，以及 amount(股数)
+        或 value(下单金额，按限价换算为100股整数倍，同 order_value)；
+        可选 start 列为下单时间(如'09:31')，默认开盘即下单
+    cost : TradeCost
+        交易费用
+    price_date : str, optional
+        limit_price 的前复权基准日，默认为day（即实际价格）
+
+    Returns:
+    --------
+    DataFrame
+        orders 加上 amount, filled, fill_time, fill_price(当日实际价格), trade_value(成交额),
+        commission, tax, cash_flow(买入为负，卖出为正，已扣除费用)
+    """
+    orders = orders.reset_index(drop=True).copy()
+    limit = orders['limit_price'].to_numpy(dtype=float)
+    if price_date is not None and pd.Timestamp(price_date) != pd.Timestamp(day):
+        limit = rebase_prices(orders['code'].tolist(), limit, price_date, day)
+    is_buy = (orders['side'] == 'buy').to_numpy()
+    if 'amount' not in orders:
+        orders['amount'] = np.floor(orders['value'].to_numpy(dtype=float) / limit / 100) * 100
+    amount = orders['amount'].to_numpy(dtype=float)
+    start = (orders['start'].map(minute_offset).to_numpy(dtype=int) if 'start' in orders
+             else np.zeros(len(orders), dtype=int))
+
+    codes = list(dict.fromkeys(orders['code']))
+    store = get_minute_store()
+    cols = orders['code'].map({code: i for i, code in enumerate(codes)}).to_numpy(dtype=int)
+    bars = {field: store.window(codes, day, field).to_numpy(dtype=float)[:, cols]
+            for field in ['open', 'high', 'low']}
+
+    # (240, 订单数)：下单之后且价格触及限价的分钟
+    minutes = np.arange(MINUTES_PER_DAY)[:, None]
+    with np.errstate(invalid='ignore'):
+        touched = np.where(is_buy, bars['low'] <= limit, bars['high'] >= limit)
+    touched &= minutes >= start
+    filled = touched.any(axis=0) & (amount > 0)
+    first = np.argmax(touched, axis=0)
+
+    order_cols = np.arange(len(orders))
+    bar_open = bars['open'][first, order_cols]
+    with np.errstate(invalid='ignore'):
+        better = np.where(is_buy, bar_open < limit, bar_open > limit)
+    price = np.where(filled, np.where(better, bar_open, limit), np.nan)
+    trade_value = np.where(filled, price * amount, 0.0)
+    commission, tax = cost.apply(trade_value, is_buy)
+
+    orders['filled'] = filled
+    orders['fill_time'] = [minute_time(m) if f else None for m, f in zip(first, filled)]
+    orders['fill_price'] = price
+    orders['trade_value'] = trade_value
+    orders['commission'] = commission
+    orders['tax'] = tax
+    orders['cash_flow'] = np.where(is_buy, -trade_value, trade_value) - commission - tax
+    return orders
@@ -0,0 +1,170 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+
+import numpy as np
+import pandas as pd
+
+from minute_store import get_minute_store
+
+# 调仓时间，快照中的最新价取该分钟的收盘价
+SNAPSHOT_TIME = '14:50'
+
+# 拟合分时均价线（黄线）斜率的分钟数
+VWAP_WINDOW = 60
+# 温和向上：均价线每小时涨幅在(VWAP_MIN_SLOPE, VWAP_MAX_SLOPE]之间，且线性拟合的R²不低于VWAP_MIN_R2
+VWAP_MIN_SLOPE = 0.0
+VWAP_MAX_SLOPE = 0.02
+VWAP_MIN_R2 = 0.6
+
+# 快照字段
+SNAPSHOT_FIELDS = [
+    'open_0931',    # 09:31 开盘价
+    'close_now',    # 调仓时间的最新价
+    'volume_30m',   # 开盘后30分钟(09:31~10:00)累计成交量
+    'prev_volume',  # 日线成交量，与 get_price(end_date=交易日, count=1) 一致
+    'vwap',         # 调仓时间的分时均价（黄线）
+    'vwap_slope',   # 最近VWAP_WINDOW分钟均价线的斜率，每小时涨幅
+    'vwap_r2',      # 均价线线性拟合的R²，越接近1越平滑
+]
+
+
+def vwap_trend(money, volume, window=VWAP_WINDOW):
+    """
+    对全部股票计算分时均价线及其最近window分钟的斜率和平滑度
+
+    均价线为开盘以来累计成交额/累计成交量；对最近window分钟做最小二乘直线拟合，
+    斜率除以窗口内均价换算为每小时涨幅，R²衡量均价线贴近直线的程度。
+
+    Parameters:
+    -----------
+    money, volume : ndarray
+        (分钟数, 股票数)，从09:31开始的分钟成交额和成交量，缺失值视为无成交
+    window : int
+        拟合的分钟数，不足时使用全部分钟
+
+    Returns:
+    --------
+    tuple
+        (均价, 每小时涨幅, R²)，均为长度为股票数的ndarray，没有成交的股票为NaN
+    """
+    cum_money = np.nancumsum(money, axis=0)
+    cum_volume = np.nancumsum(volume, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        line = np.where(cum_volume > 0, cum_money / cum_volume, np.nan)
+    y = line[-window:]
+    if len(y) < 2:
+        nan = np.full(line.shape[1], np.nan)
+        return (line[-1] if len(line) else nan), nan, nan.copy()
+    x = np.arange(len(y)) - (len(y) - 1) / 2.
+    mean = y.mean(axis=0)
+    slope = x @ (y - mean) / (x @ x)
+    residual = y - mean - np.outer(x, slope)
+    ss_tot = ((y - mean) ** 2).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2 = np.where(ss_tot > 0, 1 - (residual ** 2).sum(axis=0) / ss_tot, 1.)
+        hourly = slope * 60 / mean
+    return line[-1], hourly, np.where(np.isnan(mean), np.nan, r2)
+
+
+def vwap_upward_mask(frame, min_slope=VWAP_MIN_SLOPE, max_slope=VWAP_MAX_SLOPE,
+                     min_r2=VWAP_MIN_R2):
+    """
+    分时均价线温和向上的股票
+
+    Parameters:
+    -----------
+    frame : DataFrame
+        IntradaySnapshot.frame 的返回值
+    min_slope, max_slope : float
+        每小时涨幅的下限（不含）和上限（含），超过上限视为拉升过快
+    min_r2 : float
+        R²下限
+
+    Returns:
+    --------
+    Series
+        以股票代码为index的布尔值
+    """
+    return ((frame['vwap_slope'] > min_slope) & (frame['vwap_slope'] <= max_slope)
+            & (frame['vwap_r2'] >= min_r2))
+
+
+class IntradaySnapshot(object):
+    def __init__(self, day, time=SNAPSHOT_TIME):
+        """
+        一个交易日调仓时间的盘中快照
+
+        持仓和候选股票一次加入，分钟线对全部股票只读取一次（09:31开盘价、10:00累计成交量、
+        调仓时间的最新价和分时均价线来自同一批分钟线），日线成交量也只调用一次 get_price；之后
+        逐只股票的判断直接读取快照，调仓耗时不随股票数量增加。
+
+        Parameters:
+        -----------
+        day : str
+            交易日，格式为'%Y-%m-%d'
+        time : str
+            调仓时间，如 '14:50'
+        """
+        self.day = day
+        self.time = time
+        self.rows = {}
+
+    def add(self, codes):
+        """把尚未在快照中的股票一次读取进来"""
+        missing = [code for code in dict.fromkeys(codes) if code not in self.rows]
+        if not missing:
+            return
+        store = get_minute_store()
+        # 先读取最晚的分钟，之后较早分钟的读取都落在同一批分钟线内
+        close_now = store.at(missing, self.day, 'close', self.time)
+        open_0931 = store.at(missing, self.day, 'open', '09:31')
+        volume_30m = store.window(missing, self.day, 'volume', '09:31', '10:00').sum()
+        volume = store.window(missing, self.day, 'volume', '09:31', self.time).to_numpy()
+        money = store.window(missing, self.day, 'money', '09:31', self.time).to_numpy()
+        # 回测中调仓分钟尚未走完时只使用已有的分钟
+        traded = np.flatnonzero(~np.isnan(volume).all(axis=1))
+        filled = traded[-1] + 1 if len(traded) else 0
+        vwap, vwap_slope, vwap_r2 = vwap_trend(money[:filled], volume[:filled])
+        daily = get_price(missing, end_date=self.day, count=1, frequency='1d', fields=['volume'],
+                          panel=False)
+        if daily is None or daily.empty:
+            prev_volume = pd.Series(np.nan, index=missing)
+        else:
+            prev_volume = daily.groupby('code')['volume'].last().reindex(missing)
+        frame = pd.DataFrame({'open_0931': open_0931, 'close_now': close_now,
+                              'volume_30m': volume_30m, 'prev_volume': prev_volume,
+                              'vwap': vwap, 'vwap_slope': vwap_slope, 'vwap_r2': vwap_r2},
+                             index=missing, columns=SNAPSHOT_FIELDS)
+        self.rows.update(frame.to_dict('index'))
+
+    def frame(self, codes):
+        """codes的快照，DataFrame，以股票代码为index，列为 SNAPSHOT_FIELDS"""
+        codes = list(codes)
+        self.add(codes)
+        return pd.DataFrame([self.rows[code] for code in codes], index=pd.Index(codes),
+                            columns=SNAPSHOT_FIELDS)
+
+    def get(self, code, field):
+        """读取一只股票的快照字段，股票不在快照中时先加入"""
+        if code not in self.rows:
+            self.add([code])
+        return self.rows[code][field]
+
+
+# 当前交易日的快照
+_snapshots = {}
+
+
+def get_intraday_snapshot(day, codes=(), time=SNAPSHOT_TIME):
+    """
+    获取交易日day调仓时间的盘中快照，并加入codes
+
+    同一交易日、同一时间共用一个快照，换日时丢弃之前的快照。
+    """
+    key = (pd.Timestamp(day).strftime('%Y-%m-%d'), time)
+    if key not in _snapshots:
+        _snapshots.clear()
+        _snapshots[key] = IntradaySnapshot(*key)
+    snapshot = _snapshots[key]
+    snapshot.add(codes)
+    return snapshot
@@ -0,0 +1,341 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# 本地缓存的日线字段。价格与成交量按后复权保存，后复权数据不会因为新的除权除息而改变
+BAR_FIELDS = ['open', 'close', 'high', 'low', 'volume', 'money', 'factor']
+PRICE_FIELDS = ['open', 'close', 'high', 'low']
+
+# 默认的日线缓存目录
+DEFAULT_CACHE_DIR = 'daily_rs/bar_cache'
+
+
+def _to_day(date):
+    """统一日期格式为'%Y-%m-%d'字符串"""
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def adjust_bars(bars, fields, fq='pre'):
+    """
+    将后复权日线转换为指定的复权方式
+
+    Parameters:
+    -----------
+    bars : dict
+        {字段: DataFrame}，后复权数据，须包含'factor'
+    fields : list
+        需要返回的字段
+    fq : str or None
+        'pre'前复权（以窗口最后一个交易日为基准），'post'后复权，None不复权
+
+    Returns:
+    --------
+    dict
+        {字段: DataFrame}
+    """
+    if fq == 'post':
+        return {field: bars[field] for field in fields}
+
+    factor = bars['factor'].ffill()
+    if fq == 'pre':
+        base = factor.iloc[-1] if len(factor) else factor.sum()
+    elif fq is None:
+        base = factor
+    else:
+        raise ValueError(f"不支持的复权方式: {fq}")
+
+    result = {}
+    for field in fields:
+        if field in PRICE_FIELDS:
+            result[field] = bars[field] / base
+        elif field == 'volume':
+            result[field] = bars[field] * base
+        elif field == 'factor':
+            result[field] = factor / base if fq == 'pre' else factor
+        else:
+            result[field] = bars[field]
+    return result
+
+
+class MarketDataProvider(object):
+    """
+    日线行情数据源接口
+
+    get_bars 返回后复权的原始缓存格式，history 在其上提供与 get_price 相近的复权视图。
+    所有矩阵均为 日期×股票，index为升序的交易日(Timestamp)，columns为股票代码。
+    """
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        raise NotImplementedError
+
+    def get_bars(self, codes, start_date, end_date, fields):
+        raise NotImplementedError
+
+    def history(self, codes, end_date, count, fields, fq='pre'):
+        """
+        获取截止end_date的最近count个交易日的日线矩阵
+
+        Parameters:
+        -----------
+        codes : list
+            股票代码列表
+        end_date : str
+            截止日期，格式为'%Y-%m-%d'
+        count : int
+            交易日数量
+        fields : list
+            行情字段
+        fq : str or None
+            复权方式，默认前复权
+
+        Returns:
+        --------
+        dict
+            {字段: DataFrame}
+        """
+        days = self.get_trade_days(end_date=end_date, count=count)
+        if not days:
+            return {field: pd.DataFrame(index=pd.DatetimeIndex([]), columns=list(codes),
+                                        dtype='float64')
+                    for field in fields}
+        return self.history_range(codes, days[0], days[-1], fields, fq)
+
+    def history_range(self, codes, start_date, end_date, fields, fq='pre'):
+        """获取[start_date, end_date]区间内的日线矩阵，参数同history"""
+        need = list(fields) if fq == 'post' else sorted(set(fields) | {'factor'})
+        bars = self.get_bars(codes, start_date, end_date, need)
+        return adjust_bars(bars, fields, fq)
+
+
+class JQDataProvider(MarketDataProvider):
+    """直接调用聚宽 jqdata 接口的数据源"""
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        days = get_trade_days(start_date=start_date, end_date=end_date, count=count)
+        return [_to_day(day) for day in days]
+
+    def get_bars(self, codes, start_date, end_date, fields):
+        index = pd.DatetimeIndex(self.get_trade_days(start_date=start_date, end_date=end_date))
+        if len(codes) == 0 or len(index) == 0:
+            return {field: pd.DataFrame(index=index, columns=codes, dtype='float64')
+                    for field in fields}
+        df = get_price(list(codes), start_date=start_date, end_date=end_date, frequency='daily',
+                       fields=list(fields), skip_paused=False, fq='post', panel=False)
+        df['time'] = pd.to_datetime(df['time'])
+        return {field: df.pivot(index='time', columns='code', values=field)
+                         .reindex(index=index, columns=codes).astype('float64')
+                for field in fields}
+
+
+class LocalBarStore(MarketDataProvider):
+    """
+    本地列式日线缓存
+
+    目录结构：
+    - meta.json    股票代码列表与交易日列表
+    - <字段>.f8    float64 矩阵，行为交易日、列为股票代码，按行顺序存放
+
+    读取时使用内存映射，只有被访问的行列会被加载；新的交易日直接追加到文件末尾。
+    不依赖任何网络接口，可以离线使用。
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+        self._memmaps = {}
+        meta_path = os.path.join(root, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = {'codes': [], 'dates': []}
+        self._set_meta(meta['codes'], meta['dates'])
+
+    def _set_meta(self, codes, dates):
+        self.codes = list(codes)
+        self.dates = list(dates)
+        self._code_pos = {code: i for i, code in enumerate(self.codes)}
+        self._memmaps = {}
+
+    def _save_meta(self):
+        meta_path = os.path.join(self.root, 'meta.json')
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'codes': self.codes, 'dates': self.dates}, f)
+        os.replace(tmp_path, meta_path)
+
+    def _path(self, field):
+        return os.path.join(self.root, field + '.f8')
+
+    def read(self, field):
+        """以内存映射方式读取字段矩阵，形状为 (交易日数, 股票数)"""
+        if field not in self._memmaps:
+            shape = (len(self.dates), len(self.codes))
+            if shape[0] == 0 or shape[1] == 0 or not os.path.exists(self._path(field)):
+                self._memmaps[field] = np.full(shape, np.nan)
+            else:
+                self._memmaps[field] = np.memmap(self._path(field), dtype='<f8', mode='r',
+                                                 shape=shape)
+        return self._memmaps[field]
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        days = self.dates
+        if end_date is not None:
+            days = days[:np.searchsorted(days, _to_day(end_date), side='right')]
+        if start_date is not None:
+            days = days[np.searchsorted(days, _to_day(start_date), side='left'):]
+        if count is not None:
+            days = days[-count:] if end_date is not None or start_date is None else days[:count]
+        return list(days)
+
+    def get_bars(self, codes, start_date, end_date, fields):
+        lo = int(np.searchsorted(self.dates, _to_day(start_date), side='left'))
+        hi = int(np.searchsorted(self.dates, _to_day(end_date), side='right'))
+        index = pd.DatetimeIndex(self.dates[lo:hi])
+        pos = np.array([self._code_pos.get(code, -1) for code in codes], dtype=int)
+        known = pos >= 0
+        result = {}
+        for field in fields:
+            values = np.full((hi - lo, len(codes)), np.nan)
+            if known.any() and hi > lo:
+                values[:, known] = self.read(field)[lo:hi][:, pos[known]]
+            result[field] = pd.DataFrame(values, index=index, columns=list(codes))
+        return result
+
+    def write(self, bars):
+        """
+        写入日线数据
+
+        新交易日全部晚于已有数据且没有新股票时直接追加到文件末尾，否则重写整个矩阵。
+
+        Parameters:
+        -----------
+        bars : dict
+            {字段: DataFrame}，须包含BAR_FIELDS全部字段，后复权数据
+        """
+        os.makedirs(self.root, exist_ok=True)
+        frame = bars[BAR_FIELDS[0]]
+        new_dates = [_to_day(day) for day in frame.index]
+        new_codes = [code for code in frame.columns if code not in self._code_pos]
+        if not new_dates:
+            return
+
+        if not new_codes and (not self.dates or new_dates[0] > self.dates[-1]):
+            self._append(bars, new_dates)
+        else:
+            self._rewrite(bars, new_dates, new_codes)
+
+    def _append(self, bars, new_dates):
+        codes = self.codes or list(bars[BAR_FIELDS[0]].columns)
+        expected = len(self.dates) * len(codes) * 8
+        for field in BAR_FIELDS:
+            values = bars[field].reindex(columns=codes).to_numpy(dtype='<f8')
+            path = self._path(field)
+            with open(path, 'ab') as f:
+                # 丢弃上次中断写入时残留的尾部数据
+                f.truncate(expected)
+                f.write(np.ascontiguousarray(values).tobytes())
+        self._set_meta(codes, self.dates + new_dates)
+        self._save_meta()
+
+    def _rewrite(self, bars, new_dates, new_codes):
+        codes = self.codes + new_codes
+        dates = sorted(set(self.dates) | set(new_dates))
+        index = pd.DatetimeIndex(dates)
+        for field in BAR_FIELDS:
+            merged = pd.DataFrame(np.array(self.read(field)), index=pd.DatetimeIndex(self.dates),
+                                  columns=self.codes).reindex(index=index, columns=codes)
+            incoming = bars[field].copy()
+            incoming.index = pd.DatetimeIndex(new_dates)
+            merged.update(incoming)
+            tmp_path = self._path(field) + '.tmp'
+            merged.to_numpy(dtype='<f8').tofile(tmp_path)
+            self._memmaps.pop(field, None)
+            os.replace(tmp_path, self._path(field))
+        self._set_meta(codes, dates)
+        self._save_meta()
+
+
+class CachedProvider(MarketDataProvider):
+    """
+    带本地缓存的数据源
+
+    请求先在本地缓存中查找，只向上游补取缓存中缺失的交易日或股票。
+    当日收盘数据落定(16:00)之前的交易日不写入缓存，直接从上游读取。
+    """
+
+    def __init__(self, upstream, store):
+        self.upstream = upstream
+        self.store = store
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        return self.upstream.get_trade_days(start_date=start_date, end_date=end_date, count=count)
+
+    def get_bars(self, codes, start_date, end_date, fields):
+        days = self.get_trade_days(start_date=start_date, end_date=end_date)
+        settled = [day for day in days if self._is_settled(day)]
+        if settled:
+            self._ensure(codes, settled[0], settled[-1])
+            bars = self.store.get_bars(codes, settled[0], settled[-1], fields)
+        else:
+            bars = None
+
+        unsettled = days[len(settled):]
+        if unsettled:
+            live = self.upstream.get_bars(codes, unsettled[0], unsettled[-1], fields)
+            bars = live if bars is None else {field: pd.concat([bars[field], live[field]])
+                                              for field in fields}
+        return bars
+
+    def _is_settled(self, day):
+        now = datetime.datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        return day < today or (day == today and now.hour >= 16)
+
+    def _ensure(self, codes, start_date, end_date):
+        """补齐缓存中[start_date, end_date]区间内缺失的股票和交易日"""
+        store = self.store
+        new_codes = [code for code in dict.fromkeys(codes) if code not in store._code_pos]
+        if new_codes and store.dates:
+            # 新股票只补取缓存已有的交易日；缓存的交易日不连续时，上游返回的空缺交易日
+            # 缺少已缓存股票的数据，写入后会被当作已缓存而不再补取
+            bars = self.upstream.get_bars(new_codes, store.dates[0], store.dates[-1], BAR_FIELDS)
+            index = pd.DatetimeIndex(store.dates)
+            store.write({field: frame.reindex(index=index) for field, frame in bars.items()})
+
+        days = self.get_trade_days(start_date=start_date, end_date=end_date)
+        cached = set(store.dates)
+        missing = [day for day in days if day not in cached]
+        if missing:
+            # 缓存保持 交易日×股票 满矩阵，补取交易日时同时补齐已缓存的全部股票
+            all_codes = store.codes + [code for code in new_codes if code not in store._code_pos]
+            store.write(self.upstream.get_bars(all_codes or list(codes), missing[0], missing[-1],
+                                               BAR_FIELDS))
+
+
+_provider = None
+
+
+def get_provider():
+    """
+    获取全局数据源，默认使用 daily_rs/bar_cache 下的本地缓存。
+    运行环境不允许写本地文件时退回到直接调用 jqdata。
+    """
+    global _provider
+    if _provider is None:
+        try:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            _provider = CachedProvider(JQDataProvider(), LocalBarStore(DEFAULT_CACHE_DIR))
+        except OSError:
+            _provider = JQDataProvider()
+    return _provider
+
+
+def set_provider(provider):
+    """替换全局数据源，例如使用离线的 LocalBarStore"""
+    global _provider
+    _provider = provider
@@ -0,0 +1,261 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# 本地缓存的分钟线字段，使用不复权价格（同一交易日内复权因子不变）
+MINUTE_FIELDS = ['open', 'close', 'high', 'low', 'volume', 'money']
+
+# 每个交易日的分钟数：上午 09:31~11:30，下午 13:01~15:00
+MINUTES_PER_DAY = 240
+MORNING_MINUTES = 120
+
+# 默认的分钟线缓存目录
+DEFAULT_MINUTE_DIR = 'daily_rs/minute_cache'
+
+# 内存中保留的交易日数（当日和前一交易日），更早的交易日从磁盘重新映射
+MAX_CACHED_DAYS = 2
+
+
+def _to_day(date):
+    """统一日期格式为'%Y-%m-%d'字符串"""
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def _minute_of_day(hour, minute):
+    # 上午 09:31 为第0分钟，下午 13:01 为第120分钟
+    total = hour * 60 + minute
+    return np.where(total <= 11 * 60 + 30, total - (9 * 60 + 31),
+                    total - (13 * 60 + 1) + MORNING_MINUTES)
+
+
+def minute_offset(time):
+    """
+    分钟K线时间在当日 240 根K线中的位置
+
+    Parameters:
+    -----------
+    time : str, datetime or Timestamp
+        如 '09:31'、'14:50:00' 或 '2024-01-02 10:00:00'
+
+    Returns:
+    --------
+    int
+        0~239，'09:31'为0，'10:00'为29，'14:50'为229，'15:00'为239
+    """
+    if isinstance(time, str) and len(time) <= 8:
+        time = '2000-01-01 ' + time
+    ts = pd.Timestamp(time)
+    return int(_minute_of_day(ts.hour, ts.minute))
+
+
+def minute_time(offset):
+    """minute_offset 的逆运算，返回'%H:%M'格式的分钟K线时间"""
+    total = (9 * 60 + 31 + offset if offset < MORNING_MINUTES
+             else 13 * 60 + 1 + offset - MORNING_MINUTES)
+    return f"{total // 60:02d}:{total % 60:02d}"
+
+
+def fetch_minute_bars(codes, day):
+    """
+    从 jqdata 获取一个交易日的全部分钟线
+
+    回测中 get_price 不会返回当前时间之后的数据，此时只返回到当前时间为止的部分K线。
+
+    Returns:
+    --------
+    tuple
+        ({字段: ndarray (240, 股票数)}, 已有数据的分钟数)
+    """
+    arrays = {field: np.full((MINUTES_PER_DAY, len(codes)), np.nan) for field in MINUTE_FIELDS}
+    df = get_price(list(codes), start_date=day + ' 09:30:00', end_date=day + ' 15:00:00',
+                   frequency='1m', fields=MINUTE_FIELDS, skip_paused=False, fq=None, panel=False)
+    if df is None or df.empty:
+        return arrays, 0
+    times = pd.DatetimeIndex(df['time'])
+    rows = _minute_of_day(times.hour.to_numpy(), times.minute.to_numpy())
+    pos = {code: i for i, code in enumerate(codes)}
+    cols = df['code'].map(pos).to_numpy()
+    keep = (rows >= 0) & (rows < MINUTES_PER_DAY) & ~np.isnan(cols.astype(float))
+    rows, cols = rows[keep], cols[keep].astype(int)
+    for field in MINUTE_FIELDS:
+        arrays[field][rows, cols] = df[field].to_numpy(dtype=float)[keep]
+    return arrays, int(rows.max()) + 1 if len(rows) else 0
+
+
+class _MinuteDay(object):
+    # 一个交易日的分钟线矩阵，filled 为已有数据的分钟数
+    # horizon 为已经按其获取过的最晚分钟数，同一分钟内重复请求不再重新获取
+    def __init__(self, codes, arrays, filled, horizon=MINUTES_PER_DAY):
+        self.codes = list(codes)
+        self.pos = {code: i for i, code in enumerate(self.codes)}
+        self.arrays = arrays
+        self.filled = filled
+        self.horizon = max(filled, horizon)
+
+    @property
+    def complete(self):
+        return self.filled >= MINUTES_PER_DAY
+
+
+class MinuteBarStore(object):
+    """
+    按交易日保存的分钟线缓存
+
+    目录结构：
+    - <交易日>/codes.json    当日已缓存的股票代码列表
+    - <交易日>/<字段>.f8     float64 矩阵 (240, 股票数)，一行一分钟，按行顺序存放
+
+    读取时使用内存映射，按分钟位置切片只访问对应的行。只有完整的交易日才会写入磁盘，
+    回测当日只有部分K线时保存在内存中，请求更晚的分钟时重新获取。
+    root为None或目录不可写时只使用内存缓存。
+
+    内存中只保留最近使用的max_days个交易日，淘汰的交易日再次访问时从磁盘重新映射
+    （只在内存中的交易日重新获取）。
+    """
+
+    def __init__(self, root=DEFAULT_MINUTE_DIR, max_days=MAX_CACHED_DAYS):
+        self.root = root
+        self.max_days = max_days
+        self._days = OrderedDict()
+
+    def _dir(self, day):
+        return os.path.join(self.root, day)
+
+    def _load(self, day):
+        """从磁盘加载已缓存的交易日，不存在时返回None"""
+        if self.root is None:
+            return None
+        meta_path = os.path.join(self._dir(day), 'codes.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            codes = json.load(f)
+        shape = (MINUTES_PER_DAY, len(codes))
+        arrays = {field: np.memmap(os.path.join(self._dir(day), field + '.f8'), dtype='<f8',
+                                   mode='r', shape=shape)
+                  for field in MINUTE_FIELDS}
+        return _MinuteDay(codes, arrays, MINUTES_PER_DAY)
+
+    def _save(self, day, minute_day):
+        if self.root is None:
+            return minute_day
+        try:
+            os.makedirs(self._dir(day), exist_ok=True)
+            for field in MINUTE_FIELDS:
+                path = os.path.join(self._dir(day), field + '.f8')
+                np.ascontiguousarray(minute_day.arrays[field], dtype='<f8').tofile(path + '.tmp')
+                os.replace(path + '.tmp', path)
+            # 股票列表最后写入，没有codes.json的目录视为未缓存
+            meta_path = os.path.join(self._dir(day), 'codes.json')
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump(minute_day.codes, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        except OSError:
+            return minute_day
+        return self._load(day)
+
+    def _ensure(self, day, codes, minutes=MINUTES_PER_DAY):
+        """保证交易日day包含codes的前minutes分钟数据，缺失时向 jqdata 补取"""
+        minute_day = self._days.get(day)
+        if minute_day is None:
+            minute_day = self._load(day)
+
+        if minute_day is not None and not minute_day.complete and minute_day.horizon < minutes:
+            # 请求更晚的分钟，部分K线已经过时，整日重新获取
+            codes = minute_day.codes + [code for code in codes if code not in minute_day.pos]
+            minute_day = None
+
+        missing = list(dict.fromkeys(codes if minute_day is None else
+                                     [code for code in codes if code not in minute_day.pos]))
+        if missing:
+            arrays, filled = fetch_minute_bars(missing, day)
+            if minute_day is not None:
+                arrays = {field: np.hstack([minute_day.arrays[field], arrays[field]])
+                          for field in MINUTE_FIELDS}
+                filled = min(filled, minute_day.filled)
+                missing = minute_day.codes + missing
+            minute_day = _MinuteDay(missing, arrays, filled, minutes)
+            if minute_day.complete:
+                minute_day = self._save(day, minute_day)
+        self._days[day] = minute_day
+        self._days.move_to_end(day)
+        while len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+        return minute_day
+
+    def window(self, codes, day, field, start='09:31', end='15:00'):
+        """
+        获取[start, end]分钟区间内的分钟线矩阵
+
+        Parameters:
+        -----------
+        codes : list
+            股票代码列表
+        day : str
+            交易日，格式为'%Y-%m-%d'
+        field : str
+            MINUTE_FIELDS 中的字段
+        start : str
+            开始分钟（含），如 '09:31'
+        end : str
+            结束分钟（含），如 '10:00'
+
+        Returns:
+        --------
+        DataFrame
+            分钟位置×股票，index为 0~239 的分钟位置
+        """
+        codes = list(codes)
+        lo, hi = minute_offset(start), minute_offset(end) + 1
+        minute_day = self._ensure(_to_day(day), codes, hi)
+        pos = np.array([minute_day.pos[code] for code in codes], dtype=int)
+        values = minute_day.arrays[field][lo:hi][:, pos]
+        return pd.DataFrame(values, index=pd.RangeIndex(lo, lo + len(values)), columns=codes)
+
+    def at(self, codes, day, field, time):
+        """
+        获取截止某一分钟的最新一根K线字段值，与 get_price(end_date=time, count=1) 一致，
+        回测中该分钟尚未走完时返回上一分钟的值
+
+        Returns:
+        --------
+        Series
+            以股票代码为index
+        """
+        codes = list(codes)
+        offset = minute_offset(time)
+        minute_day = self._ensure(_to_day(day), codes, offset + 1)
+        offset = max(0, min(offset, minute_day.filled - 1))
+        pos = np.array([minute_day.pos[code] for code in codes], dtype=int)
+        return pd.Series(minute_day.arrays[field][offset, pos], index=codes, name=field)
+
+    def prefetch(self, codes, days):
+        """预先把多个交易日的分钟线写入缓存，例如在研究环境中为回测准备数据"""
+        for day in days:
+            self._ensure(_to_day(day), list(codes))
+
+
+_minute_store = None
+
+
+def get_minute_store():
+    """获取全局分钟线缓存，默认使用 daily_rs/minute_cache，目录不可写时只使用内存"""
+    global _minute_store
+    if _minute_store is None:
+        try:
+            os.makedirs(DEFAULT_MINUTE_DIR, exist_ok=True)
+            _minute_store = MinuteBarStore(DEFAULT_MINUTE_DIR)
+        except OSError:
+            _minute_store = MinuteBarStore(None)
+    return _minute_store
+
+
+def set_minute_store(store):
+    """替换全局分钟线缓存"""
+    global _minute_store
+    _minute_store = store
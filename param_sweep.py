@@ -0,0 +1,286 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from backtest_engine import (HOLD_DAYS, STOP_RATE, TARGET_RATE, BacktestEngine,
+                             backtest_days, load_backtest_bars, load_entry_prices)
+from comprehensive_selection import (SELECTION_PARAMS, SELECTION_STAGES, combine_masks,
+                                     load_selection_range, ma_spread_matrix)
+from market_data import DEFAULT_CACHE_DIR, LocalBarStore, set_provider
+from selection_db import init_database
+from selection_scoring import score_candidates
+
+# 回测引擎参数的默认值，与选股阈值 SELECTION_PARAMS 一起构成可扫描的参数
+ENGINE_PARAMS = {
+    'max_stock_num': 5,         # 最大持仓数量
+    'hold_days': HOLD_DAYS,     # 买入后第几个交易日清仓
+    'target_rate': TARGET_RATE, # 目标价 = max(la*target_rate, 次日最高价)
+    'stop_rate': STOP_RATE,     # 清仓日止损倍数
+    'limit_fill': False,        # True时次日最低价触及入场价才成交
+    'top_k': None,              # 每个交易日只考虑总分最高的前K只
+}
+
+# 结果表中的绩效指标列
+METRIC_COLUMNS = ['total_return', 'annualized_return', 'max_drawdown', 'sharpe', 'win_rate',
+                  'turnover', 'avg_holding_days']
+
+
+class EarlyStop(object):
+    def __init__(self, max_drawdown=0.3, min_return=-0.2, min_days=20):
+        """
+        明显亏损的参数组合提前终止
+
+        Parameters:
+        -----------
+        max_drawdown : float
+            回撤超过该比例时终止
+        min_return : float
+            运行min_days个交易日后累计收益低于该值时终止
+        min_days : int
+            收益条件的最少观察交易日数
+        """
+        self.max_drawdown = max_drawdown
+        self.min_return = min_return
+        self.min_days = min_days
+
+    def __call__(self, tracker):
+        if tracker.max_drawdown > self.max_drawdown:
+            return True
+        if tracker.return_count >= self.min_days:
+            return tracker.values[-1] / tracker.init_cash - 1 < self.min_return
+        return False
+
+
+def expand_grid(grid):
+    """把 {参数: 取值列表} 展开为参数组合列表"""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+class SelectionCache(object):
+    def __init__(self, data, stages=SELECTION_STAGES):
+        """
+        多组选股阈值共用的选股条件缓存
+
+        每个条件的结果以(条件名称, 它用到的参数值)为key缓存，扫描中不涉及的条件
+        (如均线、成交量趋势)只计算一次；打分因子矩阵也只计算一次。
+
+        Parameters:
+        -----------
+        data : dict
+            load_selection_range 的返回值
+        stages : list
+            选股条件，默认 SELECTION_STAGES
+        """
+        self.data = data
+        self.stages = stages
+        self.masks = {}
+        self.selections = {}
+        index = data['index']
+        self.factors = {
+            'increase': data['increase'].loc[index],
+            'volume_ratio': data['volume_ratio'].loc[index],
+            'turnover': data['turnover'],
+            'ma_spread': ma_spread_matrix(data['close_history']).loc[index],
+            'excess_return': data['excess_return'].loc[index],
+        }
+
+    def mask(self, stage, params):
+        key = (stage.name,) + tuple(params[name] for name in stage.params)
+        if key not in self.masks:
+            mask = stage.predicate(self.data, params)
+            self.masks[key] = mask.loc[self.data['index']].to_numpy(dtype=bool)
+        return self.masks[key]
+
+    def select(self, params):
+        """
+        某组阈值下每个交易日的选股结果
+
+        Returns:
+        --------
+        dict
+            {交易日: 按总分从高到低的股票代码列表}，与 run_stock_selection_range 一致
+        """
+        params = dict(SELECTION_PARAMS, **params)
+        key = tuple(params[name] for name in sorted(SELECTION_PARAMS))
+        if key not in self.selections:
+            selected = combine_masks(self.mask(stage, params) for stage in self.stages)
+            rows, cols = np.nonzero(selected)
+            df = pd.DataFrame({name: frame.to_numpy(dtype=float)[rows, cols]
+                               for name, frame in self.factors.items()})
+            df['trade_date'] = np.asarray(self.data['dates'])[rows]
+            df['code'] = np.asarray(self.data['increase'].columns)[cols]
+            df['total_score'] = score_candidates(df, by='trade_date')
+            df = df.sort_values(['trade_date', 'total_score'], ascending=[True, False],
+                                kind='mergesort')
+            self.selections[key] = {date: group['code'].tolist()
+                                    for date, group in df.groupby('trade_date', sort=False)}
+        return self.selections[key]
+
+
+def _truncate(selections, top_k):
+    if top_k is None:
+        return selections
+    return {date: codes[:top_k] for date, codes in selections.items()}
+
+
+# 子进程中共享的只读回测数据
+_shared = {}
+
+
+def _init_worker(cache_dir, codes, days, levels):
+    # 子进程只读本地日线缓存
+    provider = LocalBarStore(cache_dir)
+    set_provider(provider)
+    _shared['days'] = days
+    _shared['levels'] = levels
+    _shared['bars'] = load_backtest_bars(codes, days, provider)
+
+
+def _run_config(config_id, engine_params, selections, init_cash, stop):
+    """子进程中执行：一组参数的回测"""
+    engine = BacktestEngine(init_cash, engine_params['max_stock_num'],
+                            hold_days=engine_params['hold_days'],
+                            limit_fill=engine_params['limit_fill'],
+                            target_rate=engine_params['target_rate'],
+                            stop_rate=engine_params['stop_rate'])
+    result = engine.run(_shared['days'], selections, _shared['levels'], _shared['bars'], stop)
+    metrics = result.metrics()
+    metrics['trades'] = len(result.trades)
+    metrics['stopped_at'] = result.stopped_at
+    return config_id, metrics
+
+
+def init_sweep_results(conn):
+    """创建参数扫描结果表"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sweep_results (
+            run_id TEXT NOT NULL,         -- 扫描批次
+            rank INTEGER,                 -- 按排序指标的名次
+            params TEXT,                  -- 参数组合(JSON)
+            total_return REAL,
+            annualized_return REAL,
+            max_drawdown REAL,
+            sharpe REAL,
+            win_rate REAL,
+            turnover REAL,
+            avg_holding_days REAL,
+            trades INTEGER,               -- 成交笔数
+            stopped_at TEXT,              -- 提前终止的交易日
+            PRIMARY KEY (run_id, rank)
+        )
+    ''')
+    conn.commit()
+
+
+def save_sweep_results(conn, run_id, results):
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO sweep_results
+            (run_id, rank, params, total_return, annualized_return, max_drawdown, sharpe,
+             win_rate, turnover, avg_holding_days, trades, stopped_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(run_id, int(row['rank']), row['params'])
+              + tuple(float(row[name]) for name in METRIC_COLUMNS)
+              + (int(row['trades']), row['stopped_at'] if row['_stopped'] else None)
+              for _, row in results.iterrows()])
+
+
+def run_param_sweep(start_date, end_date, grid, init_cash=1000000, workers=None,
+                    rank_by='sharpe', early_stop=None, save=True):
+    """
+    并行扫描选股阈值和交易参数
+
+    主进程一次加载区间内的选股数据并补齐本地日线缓存，按参数组合计算选股结果
+    (与扫描参数无关的条件只计算一次)；回测分发到进程池，各子进程以只读方式共享
+    本地日线缓存。
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    grid : dict
+        {参数名: 取值列表}，参数名为 SELECTION_PARAMS 或 ENGINE_PARAMS 中的key
+    init_cash : float
+        初始资金
+    workers : int, optional
+        进程数，默认为CPU核数
+    rank_by : str
+        排序指标，METRIC_COLUMNS 之一，越大越靠前(max_drawdown越小越靠前)
+    early_stop : EarlyStop, optional
+        提前终止规则，默认 EarlyStop()；传入False时不提前终止
+    save : bool
+        是否写入 sweep_results 表
+
+    Returns:
+    --------
+    DataFrame
+        每个参数组合一行，按rank_by排序，包含参数列、METRIC_COLUMNS、trades和stopped_at
+    """
+    unknown = set(grid) - set(SELECTION_PARAMS) - set(ENGINE_PARAMS)
+    if unknown:
+        raise ValueError(f"未知的参数: {sorted(unknown)}")
+    stop = EarlyStop() if early_stop is None else (early_stop or None)
+
+    start_time = time.time()
+    data = load_selection_range(start_date, end_date)
+    if data is None:
+        return pd.DataFrame()
+    cache = SelectionCache(data)
+    configs = expand_grid(grid)
+    jobs = []
+    for config in configs:
+        selection_params = {k: v for k, v in config.items() if k in SELECTION_PARAMS}
+        engine_params = dict(ENGINE_PARAMS, **{k: v for k, v in config.items() if k in ENGINE_PARAMS})
+        jobs.append((engine_params, _truncate(cache.select(selection_params), engine_params['top_k'])))
+    print(f"{len(configs)} 组参数，缓存选股条件 {len(cache.masks)} 个，"
+          f"耗时 {time.time() - start_time:.1f} 秒")
+
+    # 全部参数组合选中过的股票的日线和入场价，在主进程补齐缓存后交给子进程只读共享
+    merged = {}
+    for _, selections in jobs:
+        for date, codes in selections.items():
+            merged.setdefault(date, set()).update(codes)
+    merged = {date: sorted(codes) for date, codes in merged.items()}
+    codes = sorted({code for day_codes in merged.values() for code in day_codes})
+    days = backtest_days(start_date, end_date)
+    levels = load_entry_prices(merged, load_backtest_bars(codes, days)['factor'])
+
+    records = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(DEFAULT_CACHE_DIR, codes, days, levels)) as pool:
+        futures = [pool.submit(_run_config, i, engine_params, selections, init_cash, stop)
+                   for i, (engine_params, selections) in enumerate(jobs)]
+        for done, future in enumerate(as_completed(futures), 1):
+            config_id, metrics = future.result()
+            records[config_id] = dict(configs[config_id], **metrics)
+            print(f"[{done}/{len(configs)}] {configs[config_id]} {rank_by}={metrics[rank_by]:.3f}"
+                  + (f"，{metrics['stopped_at']} 提前终止" if metrics['stopped_at'] else ''))
+
+    results = pd.DataFrame([records[i] for i in range(len(configs))])
+    results['params'] = [json.dumps(config, ensure_ascii=False) for config in configs]
+    # 提前终止的组合排在完整跑完的组合之后
+    results['_stopped'] = results['stopped_at'].notna()
+    results = results.sort_values(['_stopped', rank_by],
+                                  ascending=[True, rank_by == 'max_drawdown'],
+                                  kind='mergesort').reset_index(drop=True)
+    results.insert(0, 'rank', np.arange(1, len(results) + 1))
+
+    if save:
+        os.makedirs('daily_rs', exist_ok=True)
+        conn = init_database()
+        init_sweep_results(conn)
+        save_sweep_results(conn, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), results)
+    results = results.drop(columns='_stopped')
+    print(f"参数扫描完成，耗时 {time.time() - start_time:.1f} 秒")
+    return results
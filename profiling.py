@@ -0,0 +1,195 @@
+#-*- coding: utf-8 -*-
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+
+# 耗时直方图各桶的上界（毫秒）：0.125ms起按2的幂递增到约2分钟，超出的计入最后一个桶
+HISTOGRAM_BOUNDS = 0.125 * 2.0 ** np.arange(21)
+
+# summary 的列
+SUMMARY_COLUMNS = ['stage', 'calls', 'total_ms', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+                   'rows']
+
+
+class _StageStats(object):
+    # 一个阶段的调用次数、耗时直方图和数据获取行数
+    def __init__(self):
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.histogram = np.zeros(len(HISTOGRAM_BOUNDS) + 1, dtype=int)
+
+    def percentile(self, q):
+        # 以所在桶的上界近似分位数，不超过最大值
+        rank = np.searchsorted(np.cumsum(self.histogram), q * self.calls, side='left')
+        if rank >= len(HISTOGRAM_BOUNDS):
+            return self.max_ms
+        return min(float(HISTOGRAM_BOUNDS[rank]), self.max_ms)
+
+
+class Profiler(object):
+    def __init__(self, enabled=False):
+        """
+        按阶段汇总的耗时统计
+
+        关闭时 stage() 返回共用的空上下文，被 profiled 装饰的函数直接调用原函数，
+        只多一次布尔判断，可以在正式运行中保留埋点。
+
+        Parameters:
+        -----------
+        enabled : bool
+            是否记录
+        """
+        self.enabled = enabled
+        self.stats = {}
+
+    def _stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = _StageStats()
+        return stats
+
+    def record(self, name, seconds, rows=0):
+        """记录阶段name的一次调用"""
+        stats = self._stats(name)
+        ms = seconds * 1000
+        stats.calls += 1
+        stats.total_ms += ms
+        stats.max_ms = max(stats.max_ms, ms)
+        stats.rows += rows
+        stats.histogram[np.searchsorted(HISTOGRAM_BOUNDS, ms)] += 1
+
+    def add_rows(self, name, rows):
+        """累计阶段name获取的数据行数"""
+        if self.enabled:
+            self._stats(name).rows += rows
+
+    def reset(self):
+        self.stats = {}
+
+    def summary(self):
+        """
+        各阶段的调用次数、耗时分布和数据获取行数
+
+        Returns:
+        --------
+        DataFrame
+            列为 SUMMARY_COLUMNS，按总耗时从高到低排序
+        """
+        records = [{'stage': name, 'calls': stats.calls, 'total_ms': stats.total_ms,
+                    'mean_ms': stats.total_ms / stats.calls if stats.calls else np.nan,
+                    'p50_ms': stats.percentile(0.5), 'p90_ms': stats.percentile(0.9),
+                    'p99_ms': stats.percentile(0.99), 'max_ms': stats.max_ms, 'rows': stats.rows}
+                   for name, stats in self.stats.items()]
+        return (pd.DataFrame(records, columns=SUMMARY_COLUMNS)
+                .sort_values('total_ms', ascending=False, kind='mergesort')
+                .reset_index(drop=True))
+
+    def format_summary(self):
+        """summary 的文本形式，用于回测结束时输出到日志"""
+        summary = self.summary()
+        if summary.empty:
+            return '没有记录到耗时统计'
+        return '各阶段耗时统计（毫秒，分位数为直方图近似）：\n' + summary.to_string(
+            index=False, float_format=lambda value: f'{value:.1f}')
+
+
+class _Stage(object):
+    # 计时上下文，退出时记入Profiler
+    __slots__ = ('profiler', 'name', 'rows', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = 0
+
+    def add_rows(self, rows):
+        self.rows += rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.rows)
+        return False
+
+
+class _NullStage(object):
+    # 关闭统计时共用的空上下文
+    __slots__ = ()
+
+    def add_rows(self, rows):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+_profiler = Profiler()
+
+
+def get_profiler():
+    """获取全局Profiler"""
+    return _profiler
+
+
+def enable_profiling(enabled=True, reset=True):
+    """
+    打开或关闭全局耗时统计
+
+    Parameters:
+    -----------
+    enabled : bool
+        是否记录
+    reset : bool
+        是否清空之前的统计
+    """
+    _profiler.enabled = enabled
+    if reset:
+        _profiler.reset()
+
+
+def stage(name):
+    """
+    阶段计时上下文，用法：
+
+        with stage('open_position.concepts') as s:
+            ...
+            s.add_rows(len(codes))
+    """
+    return _Stage(_profiler, name) if _profiler.enabled else _NULL_STAGE
+
+
+def add_rows(name, rows):
+    """累计阶段name获取的数据行数，在被 profiled 装饰的函数内部调用"""
+    if _profiler.enabled:
+        _profiler.add_rows(name, rows)
+
+
+def profiled(name=None):
+    """
+    函数计时装饰器，阶段名默认为函数名
+
+        @profiled()
+        def open_position(context):
+            ...
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _profiler.enabled:
+                return func(*args, **kwargs)
+            with _Stage(_profiler, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
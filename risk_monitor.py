@@ -0,0 +1,132 @@
+#-*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+# 单只股票止损：最新价低于持仓成本的该比例时清仓
+STOP_RATE = 0.92
+
+# 清仓原因
+ACCOUNT_STOP = 'account_drawdown'   # 账户总浮动盈亏低于最大回撤金额，全部清仓
+POSITION_STOP = 'position_stop'     # 单只股票亏损超过止损比例
+
+
+class RiskMonitor(object):
+    def __init__(self, max_loss_amount, stop_rate=STOP_RATE):
+        """
+        增量更新的盘中持仓风控
+
+        持仓数量、成本和最新价保存为数组，账户总浮动盈亏随价格增量更新，每次行情只处理
+        价格变化的股票；账户回撤和单只股票止损都是数组上的向量化比较，可以每分钟运行。
+
+        Parameters:
+        -----------
+        max_loss_amount : float
+            账户最大回撤金额（负数），总浮动盈亏低于该值时全部清仓
+        stop_rate : float
+            单只股票止损比例
+        """
+        self.max_loss_amount = max_loss_amount
+        self.stop_rate = stop_rate
+        self.codes = []
+        self.pos = {}
+        self.amount = np.zeros(0)
+        self.cost = np.zeros(0)
+        self.price = np.zeros(0)
+        self.total_pnl = 0.0
+        # 与codes对齐：已经发出清仓委托、委托仍未完成的股票，不重复下单
+        self.liquidating = np.zeros(0, dtype=bool)
+        # 持仓是否可能已经变化（下单、成交、换日），为True时下次sync重建数组
+        self.dirty = True
+
+    def mark_dirty(self):
+        """下单或收到成交回报后调用，下次 sync 重建持仓数组"""
+        self.dirty = True
+
+    def start_day(self):
+        """每个交易日开盘前调用：前一日未成交的清仓委托已经失效，持仓成本也可能变化"""
+        self.liquidating[:] = False
+        self.dirty = True
+
+    def release(self, open_codes):
+        """
+        不再有未完成委托的股票移出 liquidating，委托被拒绝、撤销或过期后下次检查会重新清仓
+
+        Parameters:
+        -----------
+        open_codes : set
+            有未完成委托的股票，如 get_open_orders() 中各委托的 security
+        """
+        for i in np.flatnonzero(self.liquidating):
+            if self.codes[i] not in open_codes:
+                self.liquidating[i] = False
+
+    def sync(self, positions):
+        """
+        持仓可能变化（mark_dirty 之后）时重建数组，否则直接返回
+
+        Parameters:
+        -----------
+        positions : dict
+            {股票代码: Position}，如 context.portfolio.positions，使用 total_amount、
+            hold_cost（每股持仓成本）和 price
+
+        Returns:
+        --------
+        bool
+            是否重建了数组
+        """
+        if not self.dirty:
+            return False
+        self.dirty = False
+        liquidating = {self.codes[i] for i in np.flatnonzero(self.liquidating)}
+        self.codes = list(positions.keys())
+        self.liquidating = np.array([code in liquidating for code in self.codes], dtype=bool)
+        self.pos = {code: i for i, code in enumerate(self.codes)}
+        self.amount = np.array([positions[code].total_amount for code in self.codes], dtype=float)
+        self.cost = np.array([positions[code].hold_cost for code in self.codes], dtype=float)
+        self.price = np.array([positions[code].price for code in self.codes], dtype=float)
+        self.total_pnl = float(np.nansum((self.price - self.cost) * self.amount))
+        return True
+
+    def update(self, prices):
+        """
+        用最新价增量更新浮动盈亏
+
+        Parameters:
+        -----------
+        prices : dict
+            {股票代码: 最新价}，只需包含价格变化的股票，不在持仓中的股票和NaN忽略
+        """
+        idx = [self.pos[code] for code in prices if code in self.pos]
+        if not idx:
+            return
+        idx = np.array(idx, dtype=int)
+        new = np.array([prices[self.codes[i]] for i in idx], dtype=float)
+        valid = ~np.isnan(new)
+        idx, new = idx[valid], new[valid]
+        self.total_pnl += float(((new - self.price[idx]) * self.amount[idx]).sum())
+        self.price[idx] = new
+
+    def check(self):
+        """
+        检查账户回撤和单只股票止损，返回需要清仓的股票
+
+        账户回撤触发时返回全部持仓；已经返回过的股票在委托完成或失效（release、start_day）
+        之前不再返回。
+
+        Returns:
+        --------
+        DataFrame
+            code, reason(ACCOUNT_STOP / POSITION_STOP), price, cost
+        """
+        pending = ~self.liquidating
+        if self.total_pnl < self.max_loss_amount:
+            mask, reason = pending, ACCOUNT_STOP
+        else:
+            mask, reason = pending & (self.price < self.cost * self.stop_rate), POSITION_STOP
+        rows = np.flatnonzero(mask)
+        orders = pd.DataFrame({'code': [self.codes[i] for i in rows], 'reason': reason,
+                               'price': self.price[rows], 'cost': self.cost[rows]},
+                              columns=['code', 'reason', 'price', 'cost'])
+        self.liquidating[rows] = True
+        return orders
@@ -0,0 +1,398 @@
+#-*- coding: utf-8 -*-
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+# 选股结果数据库
+DB_PATH = 'daily_rs/stock_selection.db'
+
+# entry_levels 表中的价格列
+ENTRY_LEVEL_FIELDS = ['hc', 'hd', 'hx', 'ha', 'lc', 'ld', 'lx', 'la', 'no']
+
+# 按(进程, 数据库路径)复用的连接
+_connections = {}
+
+
+def to_trade_date(date=None):
+    """
+    统一交易日格式为'%Y-%m-%d'字符串
+
+    Parameters:
+    -----------
+    date : str, datetime.date, Timestamp or None
+        为None时使用当前日期
+    """
+    if date is None:
+        return datetime.now().strftime('%Y-%m-%d')
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def _is_open(conn):
+    try:
+        conn.execute('SELECT 1')
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+def get_connection(db_path=DB_PATH):
+    """
+    获取数据库连接
+
+    同一进程内对同一数据库复用一个连接，建表和索引只在打开连接时执行一次。
+    连接由本模块管理，调用方不要关闭；连接启用WAL模式：写入时不阻塞读取，
+    批量写入只需一次fsync。
+
+    Parameters:
+    -----------
+    db_path : str
+        数据库文件路径
+
+    Returns:
+    --------
+    sqlite3.Connection
+    """
+    key = (os.getpid(), db_path)
+    conn = _connections.get(key)
+    if conn is None or not _is_open(conn):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _create_schema(conn)
+        _connections[key] = conn
+    return conn
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _create_schema(conn):
+    """
+    建表和索引
+
+    两张表都以trade_date('%Y-%m-%d')作为日期键并建立索引；旧库缺少该列时
+    自动补列并按selection_time回填。
+    """
+    cursor = conn.cursor()
+
+    # 创建表（如果不存在）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS comprehensive_selections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,           -- 股票代码
+            name TEXT,                    -- 股票名称
+            price REAL,                   -- 最新价
+            change_percent REAL,          -- 涨跌幅
+            turnover_rate REAL,           -- 换手率
+            volume_ratio REAL,            -- 量比
+            total_score REAL,             -- 总分
+            selection_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- 选股时间
+            trade_date TEXT               -- 交易日
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outperform_stocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,           -- 股票代码
+            selection_time TIMESTAMP,     -- 选股时间
+            lc REAL,                      -- LC值
+            ld REAL,                      -- LD值
+            lx REAL,                      -- LX值
+            la REAL,                      -- LA值
+            trade_date TEXT,              -- 交易日
+            UNIQUE(code, selection_time)  -- 确保每个股票在同一天只有一条记录
+        )
+    ''')
+
+    # 全市场每日入场/离场价格，(trade_date, code)为主键，不额外保存rowid
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS entry_levels (
+            trade_date TEXT NOT NULL,     -- 交易日
+            code TEXT NOT NULL,           -- 股票代码
+            hc REAL, hd REAL, hx REAL, ha REAL,
+            lc REAL, ld REAL, lx REAL, la REAL,
+            no REAL,
+            PRIMARY KEY (trade_date, code)
+        ) WITHOUT ROWID
+    ''')
+
+    # 旧库迁移：补充trade_date列
+    for table in ['comprehensive_selections', 'outperform_stocks']:
+        if 'trade_date' not in _columns(conn, table):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN trade_date TEXT')
+            cursor.execute(f'UPDATE {table} SET trade_date = DATE(selection_time)')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_selections_date_score
+        ON comprehensive_selections (trade_date, total_score DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_selections_code
+        ON comprehensive_selections (code, trade_date)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outperform_date
+        ON outperform_stocks (trade_date, code)
+    ''')
+
+    conn.commit()
+
+
+def init_database(db_path=DB_PATH):
+    """
+    初始化数据库，返回复用的连接（见 get_connection），调用方不要关闭
+    """
+    return get_connection(db_path)
+
+
+def _column(df, name, default=None):
+    """按列取值，列不存在时返回默认值"""
+    if name in df.columns:
+        return df[name].astype(object).where(df[name].notna(), None).tolist()
+    return [default] * len(df)
+
+
+def save_low_and_high(conn, result_df, date=None):
+    """
+    保存低位和高位数据到数据库
+
+    Parameters:
+    -----------
+    conn : sqlite3.Connection
+        数据库连接对象
+    result_df : DataFrame
+        以股票代码为index，包含lc,ld,lx,la等数据的DataFrame
+    date : str, optional
+        指定的日期，格式为'%Y-%m-%d'。如果为None则使用当前日期
+    """
+    date = to_trade_date(date)
+    n = len(result_df)
+    data = zip(result_df.index.tolist(),
+               [date] * n,
+               _column(result_df, 'lc'),
+               _column(result_df, 'ld'),
+               _column(result_df, 'lx'),
+               _column(result_df, 'la'),
+               [date] * n)
+
+    with conn:
+        # 删除同一天的数据
+        conn.execute('DELETE FROM outperform_stocks WHERE trade_date = ?', (date,))
+        conn.executemany('''
+            INSERT INTO outperform_stocks
+            (code, selection_time, lc, ld, lx, la, trade_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', data)
+
+
+def save_to_database(conn, result_df, date=None):
+    """
+    保存结果到数据库
+
+    Parameters:
+    -----------
+    conn : sqlite3.Connection
+        数据库连接对象
+    result_df : DataFrame
+        选股结果数据
+    date : str, optional
+        指定的日期，格式为'%Y-%m-%d'。如果为None则使用当前日期
+    """
+    date = to_trade_date(date)
+    n = len(result_df)
+    data = zip(_column(result_df, 'code'),
+               _column(result_df, 'name'),
+               _column(result_df, 'close'),
+               _column(result_df, 'increase'),
+               _column(result_df, 'turnover'),
+               _column(result_df, 'volume_ratio'),
+               _column(result_df, 'total_score', 0),
+               [date] * n,
+               [date] * n)
+
+    with conn:
+        # 删除同一天的数据
+        conn.execute('DELETE FROM comprehensive_selections WHERE trade_date = ?', (date,))
+        conn.executemany('''
+            INSERT INTO comprehensive_selections
+            (code, name, price, change_percent, turnover_rate, volume_ratio, total_score,
+             selection_time, trade_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', data)
+
+
+def save_entry_levels(conn, levels_df):
+    """
+    保存全市场入场/离场价格，同一(交易日, 股票)的旧数据被覆盖
+
+    Parameters:
+    -----------
+    conn : sqlite3.Connection
+        数据库连接对象
+    levels_df : DataFrame
+        包含trade_date, code和hc,hd,hx,ha,lc,ld,lx,la,no列
+    """
+    data = zip(_column(levels_df, 'trade_date'), _column(levels_df, 'code'),
+               *[_column(levels_df, name) for name in ENTRY_LEVEL_FIELDS])
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO entry_levels
+            (trade_date, code, hc, hd, hx, ha, lc, ld, lx, la, no)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', data)
+
+
+def get_recent_selections(days=7):
+    """
+    获取最近N天的选股结果
+
+    Parameters:
+    -----------
+    days : int, default 7
+        要查询的天数
+
+    Returns:
+    --------
+    DataFrame
+        包含日期和选股数量的DataFrame
+    """
+    conn = get_connection()
+
+    sql = '''
+    SELECT
+        trade_date as date,
+        COUNT(DISTINCT code) as stock_count
+    FROM comprehensive_selections
+    WHERE trade_date >= DATE('now', ?)
+    GROUP BY trade_date
+    ORDER BY trade_date DESC
+    '''
+
+    df = pd.read_sql_query(sql, conn, params=(f'-{days} days',))
+
+    # 重命名列
+    df.columns = ['日期', '股票数量']
+
+    return df
+
+
+def get_stocks_by_date(date, top_k=None):
+    """
+    获取指定日期的所有选中股票代码
+
+    Parameters:
+    -----------
+    date : str
+        指定的日期，格式为'%Y-%m-%d'
+    top_k : int, optional
+        只返回总分最高的前K只，默认返回全部
+
+    Returns:
+    --------
+    list
+        选中的股票代码列表，按总分从高到低
+    """
+    conn = get_connection()
+
+    cursor = conn.execute('''
+        SELECT code
+        FROM comprehensive_selections
+        WHERE trade_date = ?
+        ORDER BY total_score DESC, id
+        LIMIT ?
+    ''', (to_trade_date(date), -1 if top_k is None else top_k))
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_selections_between(start_date, end_date, top_k=None):
+    """
+    获取一段时间内每个交易日的选中股票
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    top_k : int, optional
+        每个交易日只返回总分最高的前K只，默认返回全部
+
+    Returns:
+    --------
+    dict
+        {交易日: 按总分从高到低的股票代码列表}
+    """
+    conn = get_connection()
+    limit = -1 if top_k is None else top_k
+    cursor = conn.execute('''
+        SELECT trade_date, code
+        FROM (
+            SELECT trade_date, code,
+                   ROW_NUMBER() OVER (PARTITION BY trade_date
+                                      ORDER BY total_score DESC, id) AS score_rank
+            FROM comprehensive_selections
+            WHERE trade_date BETWEEN ? AND ?
+        )
+        WHERE ? < 0 OR score_rank <= ?
+        ORDER BY trade_date, score_rank
+    ''', (to_trade_date(start_date), to_trade_date(end_date), limit, limit))
+
+    result = {}
+    for trade_date, code in cursor.fetchall():
+        result.setdefault(trade_date, []).append(code)
+    return result
+
+
+def get_levels_between(start_date, end_date):
+    """
+    获取一段时间内保存的入场价格(lc/ld/lx/la)
+
+    Returns:
+    --------
+    DataFrame
+        以(trade_date, code)为index
+    """
+    conn = get_connection()
+    return pd.read_sql_query('''
+        SELECT trade_date, code, lc, ld, lx, la
+        FROM outperform_stocks
+        WHERE trade_date BETWEEN ? AND ?
+    ''', conn, params=(to_trade_date(start_date), to_trade_date(end_date)),
+        index_col=['trade_date', 'code'])
+
+
+def get_entry_levels(start_date, end_date, codes=None):
+    """
+    获取一段时间内全市场的入场/离场价格
+
+    Parameters:
+    -----------
+    start_date : str
+        开始日期，格式为'%Y-%m-%d'
+    end_date : str
+        结束日期，格式为'%Y-%m-%d'
+    codes : list, optional
+        只返回这些股票，默认返回全部
+
+    Returns:
+    --------
+    DataFrame
+        以(trade_date, code)为index
+    """
+    conn = get_connection()
+    df = pd.read_sql_query('''
+        SELECT trade_date, code, hc, hd, hx, ha, lc, ld, lx, la, no
+        FROM entry_levels
+        WHERE trade_date BETWEEN ? AND ?
+    ''', conn, params=(to_trade_date(start_date), to_trade_date(end_date)),
+        index_col=['trade_date', 'code'])
+    if codes is not None:
+        df = df[df.index.get_level_values('code').isin(list(codes))]
+    return df
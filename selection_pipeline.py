@@ -0,0 +1,171 @@
+#-*- coding: utf-8 -*-
+import time
+
+import pandas as pd
+
+# 筛选条件的数据依赖，按获取代价从低到高排列
+SNAPSHOT = 'snapshot'     # 只依赖当日行情快照，无需额外请求
+BENCHMARK = 'benchmark'   # 依赖基准指数，一次很小的请求
+HISTORY = 'history'       # 依赖候选股票的历史日线，请求量随候选数量增长
+
+COST_CLASSES = {SNAPSHOT: 0, BENCHMARK: 1, HISTORY: 2}
+
+# 指标表中记录快照构建情况的行
+SOURCE_STAGE = 'snapshot'
+
+
+class Stage(object):
+    def __init__(self, name, label, predicate, requires=SNAPSHOT, params=()):
+        """
+        选股流水线中的一个筛选条件
+
+        Parameters:
+        -----------
+        name : str
+            条件名称，用作指标和缓存的key
+        label : str
+            输出时的说明文字，可以用{参数名}引用参数值
+        predicate : callable
+            predicate(data, params) -> 布尔Series/DataFrame。
+            data为{列名: Series或DataFrame}，快照列与依赖数据合并在一起；
+            HISTORY条件返回 日期×股票 矩阵
+        requires : str
+            数据依赖，SNAPSHOT / BENCHMARK / HISTORY 之一
+        params : tuple
+            条件使用到的参数名，参数不变时条件结果可以复用
+        """
+        self.name = name
+        self.label = label
+        self.predicate = predicate
+        self.requires = requires
+        self.cost = COST_CLASSES[requires]
+        self.params = tuple(params)
+
+    def describe(self, params):
+        return self.label.format(**params)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, requires={self.requires!r})"
+
+
+class PipelineResult(object):
+    def __init__(self, selected, metrics, data=None):
+        """
+        流水线执行结果
+
+        Parameters:
+        -----------
+        selected : DataFrame
+            通过全部条件的快照行
+        metrics : DataFrame
+            每个条件一行，按执行顺序：stage, label, requires, rows_in, rows_out,
+            seconds(含数据获取), rows_fetched
+        data : dict, optional
+            执行过程中加载的依赖数据，可供后续计算复用
+        """
+        self.selected = selected
+        self.metrics = metrics
+        self.data = data or {}
+
+    def summary(self):
+        """各条件的执行情况，格式同原先逐步输出的筛选日志"""
+        lines = []
+        stages = self.metrics[self.metrics['stage'] != SOURCE_STAGE]
+        for i, row in enumerate(stages.itertuples(), 1):
+            lines.append(f"{i}. {row.label}: {row.rows_out} 只"
+                         f"（耗时 {row.seconds * 1000:.0f} 毫秒，获取 {row.rows_fetched} 行）")
+        return '\n'.join(lines)
+
+
+def order_stages(stages):
+    """按代价排序，同一代价内保持声明顺序"""
+    return sorted(stages, key=lambda stage: stage.cost)
+
+
+def run_pipeline(stages, frame, loaders, params, source=None):
+    """
+    按代价从低到高依次执行筛选条件
+
+    只依赖快照的条件最先执行，需要历史数据的条件只为前面留下的股票获取数据；
+    同一依赖只加载一次，后续条件共用。
+
+    Parameters:
+    -----------
+    stages : list
+        Stage列表
+    frame : DataFrame
+        行情快照，须包含code列
+    loaders : dict
+        {依赖名: loader(codes) -> (数据dict, 获取的行数)}
+    params : dict
+        筛选参数
+    source : dict, optional
+        快照的构建情况{rows_in, seconds, rows_fetched}，记入指标表第一行
+
+    Returns:
+    --------
+    PipelineResult
+    """
+    frame = frame.set_index('code', drop=False)
+    loaded = {}
+    records = []
+    if source is not None:
+        records.append(dict(source, stage=SOURCE_STAGE, label='初始股票池数量',
+                            requires=SNAPSHOT, rows_out=len(frame)))
+    for stage in order_stages(stages):
+        start_time = time.time()
+        rows_in = len(frame)
+        rows_fetched = 0
+        data = {column: frame[column] for column in frame.columns}
+        if stage.requires != SNAPSHOT and rows_in:
+            if stage.requires not in loaded:
+                loaded[stage.requires], rows_fetched = loaders[stage.requires](frame['code'].tolist())
+            data.update(loaded[stage.requires])
+
+        if rows_in:
+            mask = stage.predicate(data, params)
+            if isinstance(mask, pd.DataFrame):
+                mask = mask.iloc[-1]
+            mask = mask.reindex(frame.index, fill_value=False).astype(bool)
+            frame = frame[mask.to_numpy()]
+
+        records.append({
+            'stage': stage.name,
+            'label': stage.describe(params),
+            'requires': stage.requires,
+            'rows_in': rows_in,
+            'rows_out': len(frame),
+            'seconds': time.time() - start_time,
+            'rows_fetched': rows_fetched,
+        })
+    data = {}
+    for values in loaded.values():
+        data.update(values)
+    return PipelineResult(frame.reset_index(drop=True), pd.DataFrame(records), data)
+
+
+def evaluate_masks(stages, data, params, index=None):
+    """
+    在 日期×股票 矩阵上一次性计算全部条件，用于多日模式
+
+    Parameters:
+    -----------
+    stages : list
+        Stage列表
+    data : dict
+        {列名: DataFrame}，快照列与全部依赖数据
+    params : dict
+        筛选参数
+    index : DatetimeIndex, optional
+        只保留这些交易日的结果
+
+    Returns:
+    --------
+    dict
+        {条件名称: 布尔DataFrame}
+    """
+    masks = {}
+    for stage in stages:
+        mask = stage.predicate(data, params)
+        masks[stage.name] = mask.loc[index] if index is not None else mask
+    return masks
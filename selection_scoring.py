@@ -0,0 +1,49 @@
+#-*- coding: utf-8 -*-
+import pandas as pd
+
+# 各因子权重，因子值越大排名越靠前
+SCORE_WEIGHTS = {
+    'increase': 0.2,        # 当日涨幅
+    'volume_ratio': 0.2,    # 量比
+    'turnover': 0.2,        # 换手率
+    'ma_spread': 0.2,       # 均线发散程度 MA5/MA60-1
+    'excess_return': 0.2,   # 近20日相对沪深300的超额收益
+}
+
+
+def score_candidates(df, weights=None, by=None):
+    """
+    计算横截面多因子总分
+
+    每个因子在同一横截面内按百分位排名归一化到(0, 1]，按权重加权后乘以100，
+    一次向量化计算全部候选股票。缺失的因子按0分计。
+
+    Parameters:
+    -----------
+    df : DataFrame
+        候选股票，须包含weights中的全部因子列
+    weights : dict, optional
+        {因子列名: 权重}，默认 SCORE_WEIGHTS
+    by : str, optional
+        横截面分组列（如多日结果中的交易日列），为None时整个df视为一个横截面
+
+    Returns:
+    --------
+    Series
+        与df同index的总分，范围[0, 100]
+    """
+    weights = SCORE_WEIGHTS if weights is None else weights
+    factors = df[list(weights)]
+    if by is None:
+        ranks = factors.rank(pct=True)
+    else:
+        ranks = factors.groupby(df[by]).rank(pct=True)
+    total_weight = sum(weights.values())
+    score = ranks.fillna(0).mul(pd.Series(weights)).sum(axis=1) / total_weight * 100
+    return score.rename('total_score')
+
+
+def top_k(df, k, score_column='total_score'):
+    """取总分最高的k行，k为None时按总分排序返回全部"""
+    ranked = df.sort_values(score_column, ascending=False, kind='mergesort')
+    return ranked if k is None else ranked.head(k)
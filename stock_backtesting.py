@@ -1,6 +1,132 @@
 #-*- coding: utf-8 -*-
+import math
+
+import pandas as pd
+
+from trade_ledger import TradeLedger
+
+# 每年交易日数，用于年化
+TRADING_DAYS_PER_YEAR = 252
+
+
+class PerformanceTracker:
+    def __init__(self, init_cash, trading_days=TRADING_DAYS_PER_YEAR):
+        """
+        流式绩效统计
+
+        每个交易日记录一次总资产，每笔平仓记录一次收益，全部指标都是O(1)增量更新，
+        任意时刻调用 metrics() 都不需要重新扫描资金曲线或成交记录。
+
+        Parameters:
+        -----------
+        init_cash : float
+            初始资金
+        trading_days : int
+            每年交易日数，默认252
+        """
+        self.init_cash = init_cash
+        self.trading_days = trading_days
+
+        # 只追加的资金曲线
+        self.dates = []
+        self.values = []
+
+        # 最大回撤
+        self.peak = init_cash
+        self.max_drawdown = 0.0
+
+        # 日收益率的均值和方差(Welford)
+        self.return_count = 0
+        self.return_mean = 0.0
+        self.return_m2 = 0.0
+
+        # 成交与平仓统计
+        self.traded_value = 0.0
+        self.assets_sum = 0.0
+        self.closed_trades = 0
+        self.winning_trades = 0
+        self.holding_days_sum = 0
+
+    def record_day(self, date, total_assets):
+        """记录一个交易日收盘后的总资产"""
+        last = self.values[-1] if self.values else self.init_cash
+        self.dates.append(date)
+        self.values.append(total_assets)
+        self.assets_sum += total_assets
+
+        self.peak = max(self.peak, total_assets)
+        self.max_drawdown = max(self.max_drawdown, 1 - total_assets / self.peak)
+
+        daily_return = total_assets / last - 1
+        self.return_count += 1
+        delta = daily_return - self.return_mean
+        self.return_mean += delta / self.return_count
+        self.return_m2 += delta * (daily_return - self.return_mean)
+
+    def record_trade(self, value):
+        """记录一笔买入或卖出的成交额"""
+        self.traded_value += value
+
+    def record_close(self, profit_rate, holding_days):
+        """记录一次平仓的收益率(%)和持有交易日数"""
+        self.closed_trades += 1
+        self.winning_trades += profit_rate > 0
+        self.holding_days_sum += holding_days
+
+    # 可以保存到检查点的标量状态
+    STATE_FIELDS = ['peak', 'max_drawdown', 'return_count', 'return_mean', 'return_m2',
+                    'traded_value', 'assets_sum', 'closed_trades', 'winning_trades',
+                    'holding_days_sum']
+
+    def get_state(self):
+        """全部累计状态，标量为dict，资金曲线为 (交易日列表, 总资产列表)"""
+        scalars = {name: getattr(self, name) for name in self.STATE_FIELDS}
+        scalars = {name: int(value) if name in ('return_count', 'closed_trades', 'winning_trades',
+                                                 'holding_days_sum') else float(value)
+                   for name, value in scalars.items()}
+        return scalars, list(self.dates), list(self.values)
+
+    def set_state(self, scalars, dates, values):
+        """从 get_state 的结果恢复，之后的统计与未中断时完全相同"""
+        for name in self.STATE_FIELDS:
+            setattr(self, name, scalars[name])
+        self.dates = list(dates)
+        self.values = [float(value) for value in values]
+
+    def equity_curve(self):
+        """资金曲线，以交易日为index"""
+        return pd.Series(self.values, index=self.dates, name='total_assets', dtype=float)
+
+    def metrics(self):
+        """
+        当前的绩效指标
+
+        Returns:
+        --------
+        dict
+            total_return/annualized_return/max_drawdown/win_rate 为小数，
+            sharpe 为年化夏普比率(无风险利率按0计)，turnover 为累计成交额/平均总资产，
+            avg_holding_days 为平均持有交易日数
+        """
+        days = self.return_count
+        value = self.values[-1] if self.values else self.init_cash
+        total_return = value / self.init_cash - 1
+        std = math.sqrt(self.return_m2 / (days - 1)) if days > 1 else 0.0
+        return {
+            'total_return': total_return,
+            'annualized_return': ((1 + total_return) ** (self.trading_days / days) - 1
+                                  if days and total_return > -1 else 0.0),
+            'max_drawdown': self.max_drawdown,
+            'sharpe': self.return_mean / std * math.sqrt(self.trading_days) if std > 0 else 0.0,
+            'win_rate': self.winning_trades / self.closed_trades if self.closed_trades else 0.0,
+            'turnover': self.traded_value / (self.assets_sum / days) if days else 0.0,
+            'avg_holding_days': (self.holding_days_sum / self.closed_trades
+                                 if self.closed_trades else 0.0),
+        }
+
+
 class StockBacktesting:
-    def __init__(self, init_cash=1000000, max_stock_num=5):
+    def __init__(self, init_cash=1000000, max_stock_num=5, ledger=None, verbose=True):
         """
         初始化回测系统
         
@@ -10,12 +136,17 @@ class StockBacktesting:
             初始资金，默认1000000
         max_stock_num : int 
             最大持仓数量，默认5只
+        ledger : TradeLedger, optional
+            交易台账，默认使用内存台账
+        verbose : bool
+            未指定ledger时，是否逐条输出成交和拒绝信息
         """
         self.init_cash = init_cash
         self.max_stock_num = max_stock_num
         
-        # 当前现金和持仓市值
+        # 当前现金、持仓成本和持仓市值，随买卖和价格更新增量维护
         self.current_cash = init_cash
+        self.current_cost = 0
         self.current_market_value = 0
         
         # 持仓股票字典，key为股票代码
@@ -23,8 +154,18 @@ class StockBacktesting:
         
         # 单次最大可用资金
         self.max_single_position = init_cash / max_stock_num
+
+        # 已经盯市的交易日数，用于计算持有天数
+        self.current_day = 0
+
+        # 资金曲线和绩效指标
+        self.tracker = PerformanceTracker(init_cash)
+
+        # 成交、拒绝和每日快照台账；current_date 为最近一次盯市的交易日
+        self.ledger = ledger if ledger is not None else TradeLedger(console=verbose)
+        self.current_date = None
         
-    def buy_stock(self, stock_code, price, clear_date, target_price):
+    def buy_stock(self, stock_code, price, clear_date, target_price, buy_date=None):
         """
         买入股票
         
@@ -38,21 +179,26 @@ class StockBacktesting:
             清仓日期
         target_price : float
             目标价格
+        buy_date : str, optional
+            买入日期，默认为最近一次盯市的交易日
             
         Returns:
         --------
         bool
             买入是否成功
         """
+        buy_date = buy_date or self.current_date
         # 检查是否可以买入新的股票
         if len(self.holding_stocks) >= self.max_stock_num:
-            print(f"已达到最大持仓数量 {self.max_stock_num}")
+            self.ledger.record_rejection(buy_date, stock_code, 'max_holdings', price,
+                                         max_stock_num=self.max_stock_num)
             return False
             
         # 计算本次可用资金
         available_cash = min(self.current_cash, self.max_single_position)
         if available_cash < price * 100:  # 至少要能买100股
-            print(f"可用资金不足，当前可用: ¥{available_cash:.2f}")
+            self.ledger.record_rejection(buy_date, stock_code, 'insufficient_cash', price,
+                                         available_cash=available_cash)
             return False
         
         # 计算可买股数(向下取整到100的倍数)
@@ -60,15 +206,17 @@ class StockBacktesting:
         shares = (max_shares // 100) * 100
         
         if shares == 0:
-            print("可买股数为0")
+            self.ledger.record_rejection(buy_date, stock_code, 'zero_shares', price)
             return False
             
         # 计算实际花费
         cost = shares * price
         
-        # 更新现金和市值
+        # 更新现金、成本和市值
         self.current_cash -= cost
+        self.current_cost += cost
         self.current_market_value += cost
+        self.tracker.record_trade(cost)
         
         # 添加到持仓字典
         self.holding_stocks[stock_code] = {
@@ -78,9 +226,10 @@ class StockBacktesting:
             'cost': cost,
             'clear_date': clear_date,
             'market_price': price,
-            'target_price': target_price
+            'target_price': target_price,
+            'open_day': self.current_day
         }
-        print(f"买入 {stock_code}: {shares}股，价格 ¥{price:.2f}，总花费 ¥{cost:.2f}")
+        self.ledger.record_trade(buy_date, stock_code, 'buy', price, shares)
         return True
 
     def is_stock_in_holdings(self, stock_code):
@@ -124,21 +273,71 @@ class StockBacktesting:
             sell_income = price * stock['shares']
             profit_rate = (sell_income - buy_cost) / buy_cost * 100
             
-            # 更新现金和市值
+            # 更新现金、成本和市值，市值按该持仓当前的盯市价值扣除
             self.current_cash += sell_income
-            self.current_market_value -= sell_income
+            self.current_cost -= stock['cost']
+            self.current_market_value -= stock['market_price'] * stock['shares']
+            self.tracker.record_trade(sell_income)
+            self.tracker.record_close(profit_rate, self.current_day - stock['open_day'])
             
             # 从持仓字典中移除
             del self.holding_stocks[stock_code]
             
-            print(f"卖出 {stock_code}: {stock['shares']}股，价格 ¥{price:.2f}，"
-                f"总收入 ¥{sell_income:.2f}，收益率 {profit_rate:.2f}%")
+            self.ledger.record_trade(sell_date, stock_code, 'sell', price, stock['shares'],
+                                     profit_rate)
             
             return profit_rate
                 
-        print(f"未找到股票 {stock_code} 的持仓记录")
+        self.ledger.record_rejection(sell_date, stock_code, 'not_holding', price)
         return None
     
+    def update_market_price(self, stock_code, price):
+        """
+        更新持仓股票的最新价格，持仓市值按差额增量更新
+
+        Parameters:
+        -----------
+        stock_code : str
+            股票代码
+        price : float
+            最新价格
+        """
+        stock = self.holding_stocks.get(stock_code)
+        if stock is None:
+            return
+        self.current_market_value += (price - stock['market_price']) * stock['shares']
+        stock['market_price'] = price
+
+    def mark_to_market(self, date, prices=None):
+        """
+        每个交易日收盘后盯市，记录资金曲线并更新绩效指标
+
+        Parameters:
+        -----------
+        date : str
+            交易日
+        prices : dict, optional
+            {股票代码: 收盘价}，缺失的股票沿用上次的价格
+
+        Returns:
+        --------
+        float
+            当日总资产
+        """
+        for stock_code, price in (prices or {}).items():
+            self.update_market_price(stock_code, price)
+        self.current_day += 1
+        self.current_date = date
+        total_assets = self.current_cash + self.current_market_value
+        self.tracker.record_day(date, total_assets)
+        self.ledger.record_snapshot(date, self.current_cash, self.current_market_value,
+                                    len(self.holding_stocks))
+        return total_assets
+
+    def get_metrics(self):
+        """当前的绩效指标，见 PerformanceTracker.metrics"""
+        return self.tracker.metrics()
+
     def get_holdings(self):
         """
         获取当前所有持仓数据
@@ -146,24 +345,21 @@ class StockBacktesting:
         Returns:
         --------
         list
-            持仓股票信息列表
+            持仓股票信息列表，为持仓字典的副本；修改其中的 market_price 不会影响持仓市值，
+            更新价格请使用 update_market_price
         """
-        return list(self.holding_stocks.values())
+        return [dict(stock) for stock in self.holding_stocks.values()]
 
     def summary_status(self):
         """
-        生成账户状态信息的字符串摘要，包括收益率和资金利用率
+        生成账户状态信息的字符串摘要，包括持仓浮动盈亏、收益率和资金利用率
         
         Returns:
         --------
         str
             账户状态信息的字符串摘要
         """
-        # 根据持仓字典计算持仓市值
-        self.current_market_value = sum([stock['market_price'] * stock['shares'] 
-                                       for stock in self.holding_stocks.values()])
-        
-        # 计算总资产(现金 + 持仓市值)
+        # 计算总资产(现金 + 增量维护的持仓市值)
         total_assets = self.current_cash + self.current_market_value
         
         # 计算收益率
@@ -171,14 +367,21 @@ class StockBacktesting:
         
         # 计算资金利用率
         cash_utilization = (self.current_cash / total_assets) * 100
+        metrics = self.get_metrics()
         
         status_summary = (
             "\n=== 账户状态 ===\n"
             f"总资产: ¥{total_assets:,.2f}\n"
             f"现金余额: ¥{self.current_cash:,.2f}\n"
             f"持仓市值: ¥{self.current_market_value:,.2f}\n"
+            f"持仓成本: ¥{self.current_cost:,.2f}\n"
+            f"浮动盈亏: ¥{self.current_market_value - self.current_cost:,.2f}\n"
             f"收益率: {return_rate:.2f}%\n"
-            f"资金空置率: {cash_utilization:.2f}%"
+            f"资金空置率: {cash_utilization:.2f}%\n"
+            f"最大回撤: {metrics['max_drawdown'] * 100:.2f}%\n"
+            f"年化收益率: {metrics['annualized_return'] * 100:.2f}%\n"
+            f"夏普比率: {metrics['sharpe']:.2f}\n"
+            f"胜率: {metrics['win_rate'] * 100:.2f}%"
         )
         
         return status_summary
@@ -0,0 +1,380 @@
+#-*- coding: utf-8 -*-
+from jqdata import *
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# 买入过滤条件需要的最长日线窗口（MACD使用35个交易日）
+INDICATOR_WINDOW = 35
+# 均线和均量的窗口
+MA_WINDOW = 20
+VOLUME_WINDOW = 3
+# 指数移动平均的跨度
+EMA_SPANS = {'ema12': 12, 'ema26': 26, 'dea': 9}
+
+
+def _to_day(date):
+    """统一日期格式为'%Y-%m-%d'字符串"""
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def fetch_indicator_panel(codes, date, count=INDICATOR_WINDOW, fq='pre'):
+    """
+    一次获取全部候选股票截止date的收盘价和成交量
+
+    Returns:
+    --------
+    dict
+        {'close', 'volume': DataFrame}，交易日×股票，缺少数据的股票整列为NaN
+    """
+    codes = list(codes)
+    df = get_price(codes, end_date=date, count=count, frequency='1d', fields=['close', 'volume'],
+                   fq=fq, panel=False) if codes else None
+    if df is None or df.empty:
+        empty = pd.DataFrame(np.nan, index=pd.RangeIndex(0), columns=codes)
+        return {'close': empty, 'volume': empty.copy()}
+    return {field: df.pivot(index='time', columns='code', values=field)
+                     .reindex(columns=codes).astype('float64')
+            for field in ['close', 'volume']}
+
+
+def compute_indicators(panel):
+    """
+    在 交易日×股票 的面板上按列计算买入过滤指标
+
+    与逐只股票计算的结果一致：
+    - above_ma20: 收盘价高于最近20个交易日的收盘均价
+    - volume_increased: 当日成交量超过最近3个交易日均量的1.5倍
+    - macd_gold_cross: DIFF由下向上穿越DEA（EMA12/EMA26/DEA9，adjust=False）
+
+    Parameters:
+    -----------
+    panel : dict
+        fetch_indicator_panel 的返回值
+
+    Returns:
+    --------
+    DataFrame
+        以股票代码为index，包含指标列和三个布尔过滤列
+    """
+    close, volume = panel['close'], panel['volume']
+    result = pd.DataFrame(index=close.columns)
+    if len(close) == 0:
+        for column in ['above_ma20', 'volume_increased', 'macd_gold_cross']:
+            result[column] = False
+        return result
+
+    result['close'] = close.iloc[-1]
+    result['ma20'] = close.iloc[-20:].mean(skipna=False) if len(close) >= 20 else np.nan
+    result['volume'] = volume.iloc[-1]
+    result['volume_ma3'] = volume.iloc[-3:].mean(skipna=False) if len(volume) >= 3 else np.nan
+    result['volume_ratio'] = result['volume'] / result['volume_ma3']
+
+    ema12 = close.ewm(span=12, adjust=False).mean()
+    ema26 = close.ewm(span=26, adjust=False).mean()
+    diff = ema12 - ema26
+    dea = diff.ewm(span=9, adjust=False).mean()
+    result['ema12'] = ema12.iloc[-1]
+    result['ema26'] = ema26.iloc[-1]
+    result['diff'] = diff.iloc[-1]
+    result['dea'] = dea.iloc[-1]
+
+    result['above_ma20'] = result['close'] > result['ma20']
+    result['volume_increased'] = result['volume'] > result['volume_ma3'] * 1.5
+    if len(close) >= INDICATOR_WINDOW:
+        result['macd_gold_cross'] = (diff.iloc[-2] < dea.iloc[-2]) & (diff.iloc[-1] > dea.iloc[-1])
+    else:
+        result['macd_gold_cross'] = False
+    return result
+
+
+def indicator_filters(codes, date):
+    """
+    一次数据调用计算全部候选股票的买入过滤条件
+
+    Parameters:
+    -----------
+    codes : list
+        股票代码列表
+    date : str
+        交易日，格式为'%Y-%m-%d'
+
+    Returns:
+    --------
+    DataFrame
+        以股票代码为index，above_ma20、volume_increased、macd_gold_cross 为布尔列
+    """
+    return compute_indicators(fetch_indicator_panel(codes, date))
+
+
+def _ewm_alpha(span):
+    # 与 pandas 相同的计算顺序，保证结果逐位一致
+    return 1. / (1. + (span - 1) / 2.)
+
+
+def _ewm_step(mean, weight, value, alpha):
+    """
+    pandas ewm(adjust=False) 的单步递推，对全部股票向量化
+
+    mean为NaN表示还没有观测值；value为NaN时均值不变、旧权重继续衰减，与 ignore_na=False 一致。
+
+    Returns:
+    --------
+    tuple
+        (新的均值, 新的旧权重)
+    """
+    observed = ~np.isnan(value)
+    started = ~np.isnan(mean)
+    weight = np.where(started, weight * (1. - alpha), weight)
+    changed = started & observed & (mean != value)
+    with np.errstate(invalid='ignore'):
+        updated = (weight * mean + alpha * value) / (weight + alpha)
+    mean = np.where(changed, updated, np.where(~started & observed, value, mean))
+    weight = np.where(started & observed, 1., weight)
+    return mean, weight
+
+
+class IndicatorState(object):
+    """
+    按股票保存的流式指标状态
+
+    保存EMA12/EMA26/DEA的递推值和权重、收盘价与成交量的滚动窗口及其累计和。每个交易日
+    用当日收盘价和成交量更新一次，每只股票O(1)且对全部股票向量化，不再需要每次读取35日
+    窗口重新计算。EMA从预热的第一个交易日起连续递推，与对同一段序列调用
+    ewm(adjust=False).mean() 的结果一致。
+
+    价格使用后复权，除权除息不会打断递推；均线、MACD金叉和量比的判断不受复权基准影响。
+    """
+
+    # 每只股票一个值的状态：(名称, 初始值)
+    ARRAYS = [('bars', 0), ('close', np.nan), ('volume', np.nan),
+              ('ema12', np.nan), ('ema12_wt', 1.), ('ema26', np.nan), ('ema26_wt', 1.),
+              ('dea', np.nan), ('dea_wt', 1.), ('diff', np.nan),
+              ('prev_diff', np.nan), ('prev_dea', np.nan),
+              ('close_sum', 0.), ('close_nan', MA_WINDOW),
+              ('volume_sum', 0.), ('volume_nan', VOLUME_WINDOW)]
+    # 滚动窗口：(名称, 行数)，按 cursor % 行数 循环写入
+    WINDOWS = [('close', MA_WINDOW), ('volume', VOLUME_WINDOW)]
+
+    def __init__(self, codes=()):
+        self.codes = []
+        self.pos = {}
+        self.last_date = None
+        self.cursor = 0
+        self.arrays = {name: np.full(0, init, dtype=int if name == 'bars' else float)
+                       for name, init in self.ARRAYS}
+        self.windows = {name: np.full((rows, 0), np.nan) for name, rows in self.WINDOWS}
+        self.add_codes(codes)
+
+    def add_codes(self, codes):
+        """加入新的股票，状态为空，滚动窗口在积累满之前均线为NaN"""
+        new = [code for code in dict.fromkeys(codes) if code not in self.pos]
+        if not new:
+            return
+        for code in new:
+            self.pos[code] = len(self.codes)
+            self.codes.append(code)
+        for name, init in self.ARRAYS:
+            self.arrays[name] = np.concatenate([self.arrays[name],
+                                                np.full(len(new), init, dtype=self.arrays[name].dtype)])
+        for name, rows in self.WINDOWS:
+            self.windows[name] = np.hstack([self.windows[name], np.full((rows, len(new)), np.nan)])
+
+    def update(self, date, close, volume):
+        """
+        用一个交易日的收盘价和成交量更新状态
+
+        Parameters:
+        -----------
+        date : str
+            交易日，格式为'%Y-%m-%d'
+        close, volume : Series
+            以股票代码为index，状态中没有出现的股票视为缺失值
+        """
+        self.add_codes(close.index)
+        c = close.reindex(self.codes).to_numpy(dtype=float)
+        v = volume.reindex(self.codes).to_numpy(dtype=float)
+        a = self.arrays
+        for name in ['ema12', 'ema26']:
+            a[name], a[name + '_wt'] = _ewm_step(a[name], a[name + '_wt'], c,
+                                                 _ewm_alpha(EMA_SPANS[name]))
+        a['prev_diff'], a['prev_dea'] = a['diff'], a['dea']
+        a['diff'] = a['ema12'] - a['ema26']
+        a['dea'], a['dea_wt'] = _ewm_step(a['dea'], a['dea_wt'], a['diff'],
+                                          _ewm_alpha(EMA_SPANS['dea']))
+
+        for name, value in [('close', c), ('volume', v)]:
+            window = self.windows[name]
+            row = self.cursor % len(window)
+            old = window[row]
+            a[name + '_sum'] = a[name + '_sum'] + np.nan_to_num(value) - np.nan_to_num(old)
+            a[name + '_nan'] = a[name + '_nan'] + np.isnan(value) - np.isnan(old)
+            window[row] = value
+            if row == len(window) - 1:
+                # 每轮重新求和，消除累计误差
+                a[name + '_sum'] = np.nansum(window, axis=0)
+        a['close'], a['volume'] = c, v
+        a['bars'] = a['bars'] + 1
+        self.cursor += 1
+        self.last_date = _to_day(date)
+
+    def replay(self, codes, days, fq='post'):
+        """一次读取codes在days上的日线，逐日更新状态"""
+        if not days:
+            return
+        self.add_codes(codes)
+        panel = fetch_indicator_panel(self.codes, days[-1], count=len(days), fq=fq)
+        index = pd.DatetimeIndex(days)
+        close = panel['close'].reindex(index)
+        volume = panel['volume'].reindex(index)
+        for day, (_, c), (_, v) in zip(days, close.iterrows(), volume.iterrows()):
+            self.update(day, c, v)
+
+    def sync(self, codes, end_date, fq='post'):
+        """
+        把状态补齐到end_date（含）
+
+        没有状态、last_date不在最近 INDICATOR_WINDOW 个交易日内（中断过久，或状态晚于
+        end_date，例如对更早的区间重新回测）时，丢弃状态并用最近 INDICATOR_WINDOW 个交易日
+        重新预热，避免使用end_date之后的数据；新出现的股票用截止last_date的
+        INDICATOR_WINDOW 个交易日单独预热后合并；已有股票只补上last_date之后的交易日。
+        """
+        days = [_to_day(day) for day in get_trade_days(end_date=end_date, count=INDICATOR_WINDOW)]
+        if self.last_date is not None and not days[0] <= self.last_date <= days[-1]:
+            self.__init__(self.codes)
+        new = [code for code in dict.fromkeys(codes) if code not in self.pos]
+        if new and self.last_date is not None:
+            warm = IndicatorState()
+            warm.replay(new, [_to_day(day) for day in
+                              get_trade_days(end_date=self.last_date, count=INDICATOR_WINDOW)], fq)
+            self._merge(warm)
+        self.replay(list(codes), [day for day in days
+                                  if self.last_date is None or day > self.last_date], fq)
+
+    def _merge(self, other):
+        # 合并同一last_date的另一份状态（只包含本状态没有的股票），滚动窗口按cursor对齐
+        for code in other.codes:
+            self.pos[code] = len(self.codes)
+            self.codes.append(code)
+        for name, _ in self.ARRAYS:
+            self.arrays[name] = np.concatenate([self.arrays[name], other.arrays[name]])
+        for name, _ in self.WINDOWS:
+            window = np.roll(other.windows[name], self.cursor - other.cursor, axis=0)
+            self.windows[name] = np.hstack([self.windows[name], window])
+
+    def copy(self):
+        state = IndicatorState()
+        state.codes = list(self.codes)
+        state.pos = dict(self.pos)
+        state.last_date = self.last_date
+        state.cursor = self.cursor
+        state.arrays = {name: values.copy() for name, values in self.arrays.items()}
+        state.windows = {name: values.copy() for name, values in self.windows.items()}
+        return state
+
+    def preview(self, date, close, volume):
+        """在状态的副本上加入date的（盘中）数据，不改变当前状态"""
+        state = self.copy()
+        state.update(date, close, volume)
+        return state
+
+    def frame(self):
+        """
+        当前状态下的指标和买入过滤条件，列与 compute_indicators 相同
+
+        Returns:
+        --------
+        DataFrame
+            以股票代码为index
+        """
+        a = self.arrays
+        result = pd.DataFrame(index=pd.Index(self.codes))
+        result['close'] = a['close']
+        result['ma20'] = np.where(a['close_nan'] == 0, a['close_sum'] / MA_WINDOW, np.nan)
+        result['volume'] = a['volume']
+        result['volume_ma3'] = np.where(a['volume_nan'] == 0, a['volume_sum'] / VOLUME_WINDOW, np.nan)
+        result['volume_ratio'] = result['volume'] / result['volume_ma3']
+        for name in ['ema12', 'ema26', 'diff', 'dea']:
+            result[name] = a[name]
+        result['above_ma20'] = result['close'] > result['ma20']
+        result['volume_increased'] = result['volume'] > result['volume_ma3'] * 1.5
+        result['macd_gold_cross'] = ((a['bars'] >= INDICATOR_WINDOW)
+                                     & (a['prev_diff'] < a['prev_dea']) & (a['diff'] > a['dea']))
+        return result
+
+    def save(self, path):
+        """
+        写入.npz文件，先写临时文件再替换
+
+        不同的回测和实盘应使用各自的路径（例如按运行编号或回测起始日区分），避免互相覆盖。
+
+        Returns:
+        --------
+        bool
+            是否写入成功，目录不可写时返回False，不抛出异常
+        """
+        meta = {'last_date': self.last_date, 'cursor': self.cursor}
+        tmp_path = path + '.tmp.npz'
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            np.savez(tmp_path, meta=np.array(json.dumps(meta)),
+                     codes=np.array(self.codes, dtype=str), **self.arrays,
+                     **{name + '_window': values for name, values in self.windows.items()})
+            os.replace(tmp_path, path)
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """读取save保存的状态，文件不存在或无法读取时返回空状态"""
+        state = cls()
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data['meta']))
+                codes = data['codes'].tolist()
+                arrays = {name: data[name] for name, _ in cls.ARRAYS}
+                windows = {name: data[name + '_window'] for name, _ in cls.WINDOWS}
+        except (OSError, KeyError, ValueError):
+            return state
+        state.codes = codes
+        state.pos = {code: i for i, code in enumerate(codes)}
+        state.arrays = arrays
+        state.windows = windows
+        state.last_date = meta['last_date']
+        state.cursor = meta['cursor']
+        return state
+
+
+def streaming_filters(state, codes, date):
+    """
+    用流式指标状态计算买入过滤条件
+
+    状态补齐到date的前一个交易日（只读取缺少的交易日），date当天只读取一根日线，
+    在状态的副本上预览，盘中的数据不会写入状态。
+
+    Parameters:
+    -----------
+    state : IndicatorState
+        流式指标状态，会被补齐
+    codes : list
+        股票代码列表
+    date : str
+        交易日，格式为'%Y-%m-%d'
+
+    Returns:
+    --------
+    DataFrame
+        以股票代码为index，列与 indicator_filters 相同
+    """
+    codes = list(codes)
+    if not codes:
+        return compute_indicators(fetch_indicator_panel(codes, date))
+    previous = get_trade_days(end_date=date, count=2)[0]
+    state.sync(codes, previous)
+    today = fetch_indicator_panel(codes, date, count=1, fq='post')
+    if len(today['close']) and _to_day(today['close'].index[-1]) > state.last_date:
+        state = state.preview(date, today['close'].iloc[-1], today['volume'].iloc[-1])
+    return state.frame().reindex(codes)
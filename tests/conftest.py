@@ -0,0 +1,12 @@
+#-*- coding: utf-8 -*-
+# 离线测试：仓库根目录加入搜索路径，没有聚宽环境时用空的 jqdata 模块代替
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import jqdata  # noqa: F401
+except ImportError:
+    sys.modules['jqdata'] = types.ModuleType('jqdata')
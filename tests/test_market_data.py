@@ -0,0 +1,67 @@
+#-*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from market_data import BAR_FIELDS, CachedProvider, LocalBarStore, MarketDataProvider, _to_day
+
+
+class StubUpstream(MarketDataProvider):
+    """离线上游：第i个交易日、第j只股票的各字段值为 100*i + j，复权因子为1"""
+
+    def __init__(self, codes, days):
+        self.codes = list(codes)
+        self.days = [_to_day(day) for day in days]
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        days = self.days
+        if end_date is not None:
+            days = [day for day in days if day <= _to_day(end_date)]
+        if start_date is not None:
+            days = [day for day in days if day >= _to_day(start_date)]
+        if count is not None:
+            days = days[-count:] if end_date is not None or start_date is None else days[:count]
+        return days
+
+    def get_bars(self, codes, start_date, end_date, fields):
+        days = self.get_trade_days(start_date=start_date, end_date=end_date)
+        rows = np.array([self.days.index(day) for day in days], dtype=float)
+        cols = np.array([self.codes.index(code) for code in codes], dtype=float)
+        values = 100 * rows[:, None] + cols[None, :]
+        return {field: pd.DataFrame(np.ones_like(values) if field == 'factor' else values,
+                                    index=pd.DatetimeIndex(days), columns=list(codes))
+                for field in fields}
+
+
+def make_provider(tmp_path):
+    upstream = StubUpstream(['A', 'B'], pd.bdate_range('2024-01-01', periods=40))
+    return upstream, CachedProvider(upstream, LocalBarStore(str(tmp_path / 'bar_cache')))
+
+
+def test_new_code_does_not_mark_gap_days_as_cached(tmp_path):
+    upstream, provider = make_provider(tmp_path)
+    days = upstream.days
+    provider.get_bars(['A'], days[0], days[4], BAR_FIELDS)
+    provider.get_bars(['A'], days[30], days[35], BAR_FIELDS)
+    provider.get_bars(['B'], days[0], days[35], BAR_FIELDS)
+
+    close = provider.get_bars(['A', 'B'], days[10], days[12], ['close'])['close']
+    expected = upstream.get_bars(['A', 'B'], days[10], days[12], ['close'])['close']
+    pd.testing.assert_frame_equal(close, expected)
+
+
+def test_cache_survives_reopen(tmp_path):
+    upstream, provider = make_provider(tmp_path)
+    days = upstream.days
+    provider.get_bars(['A', 'B'], days[0], days[9], BAR_FIELDS)
+
+    store = LocalBarStore(str(tmp_path / 'bar_cache'))
+    close = store.get_bars(['B', 'A'], days[2], days[5], ['close'])['close']
+    expected = upstream.get_bars(['B', 'A'], days[2], days[5], ['close'])['close']
+    pd.testing.assert_frame_equal(close, expected)
+
+
+def test_history_without_trade_days_is_empty(tmp_path):
+    upstream, provider = make_provider(tmp_path)
+    bars = provider.history(['A', 'B'], '2023-01-01', 5, ['close', 'volume'])
+    assert set(bars) == {'close', 'volume'}
+    assert bars['close'].empty and list(bars['close'].columns) == ['A', 'B']
@@ -0,0 +1,43 @@
+#-*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from comprehensive_selection import EXCESS_RETURN_DAYS, excess_return_matrix
+from selection_scoring import score_candidates
+
+
+def make_history():
+    """当日涨幅 A > B > C，区间涨幅 C > A > B；基准指数区间上涨10%"""
+    index = pd.bdate_range('2024-01-01', periods=EXCESS_RETURN_DAYS + 1)
+    start = pd.Series({'A': 10.0, 'B': 10.0, 'C': 10.0})
+    end = pd.Series({'A': 12.0, 'B': 10.5, 'C': 14.0})
+    close = pd.DataFrame(np.linspace(start, end, len(index)), index=index, columns=start.index)
+    close.iloc[-2] = close.iloc[-1] / pd.Series({'A': 1.05, 'B': 1.04, 'C': 1.03})
+    benchmark = pd.Series(np.linspace(100.0, 110.0, len(index)), index=index)
+    return close, benchmark
+
+
+def test_excess_return_is_window_return_over_benchmark():
+    close, benchmark = make_history()
+    excess = excess_return_matrix(close, benchmark).iloc[-1]
+    np.testing.assert_allclose(excess.to_numpy(), [20 - 10, 5 - 10, 40 - 10])
+    assert excess_return_matrix(close, benchmark).iloc[:EXCESS_RETURN_DAYS].isna().all().all()
+
+
+def test_excess_return_changes_ranking():
+    close, benchmark = make_history()
+    df = pd.DataFrame({'code': ['A', 'B', 'C'],
+                       'increase': (close.iloc[-1] / close.iloc[-2] - 1).to_numpy() * 100,
+                       'volume_ratio': 1.0, 'turnover': 1.0, 'ma_spread': 0.0})
+
+    def ranking(frame):
+        return frame.assign(score=score_candidates(frame)).sort_values('score', ascending=False)['code'].tolist()
+
+    # 当日超额涨幅只是平移当日涨幅，排名与只按涨幅打分相同
+    same_day = df.assign(excess_return=df['increase'] - 1.0)
+    assert same_day['excess_return'].rank().equals(same_day['increase'].rank())
+    assert ranking(same_day) == ['A', 'B', 'C']
+
+    # 区间超额收益因股票而异，改变了总分排名
+    excess = excess_return_matrix(close, benchmark).iloc[-1]
+    assert ranking(df.assign(excess_return=df['code'].map(excess))) == ['A', 'C', 'B']
@@ -0,0 +1,180 @@
+#-*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+
+# 各类记录的列，(列名, dtype)
+LEDGER_SCHEMAS = {
+    'trades': [('date', object), ('code', object), ('side', object), ('price', float),
+               ('shares', float), ('value', float), ('profit_rate', float), ('reason', object)],
+    'rejections': [('date', object), ('code', object), ('price', float), ('reason', object)],
+    'snapshots': [('date', object), ('cash', float), ('market_value', float),
+                  ('total_assets', float), ('holdings', int)],
+}
+
+# 拒绝原因对应的控制台输出
+REJECTION_MESSAGES = {
+    'max_holdings': "已达到最大持仓数量 {max_stock_num}",
+    'insufficient_cash': "可用资金不足，当前可用: ¥{available_cash:.2f}",
+    'zero_shares': "可买股数为0",
+    'not_holding': "未找到股票 {code} 的持仓记录",
+}
+
+
+class ConsoleSink(object):
+    """逐条输出到控制台，格式同原先 StockBacktesting 的 print"""
+
+    def trade(self, record):
+        if record['side'] == 'buy':
+            print(f"买入 {record['code']}: {record['shares']:.0f}股，价格 ¥{record['price']:.2f}，"
+                  f"总花费 ¥{record['value']:.2f}")
+        else:
+            print(f"卖出 {record['code']}: {record['shares']:.0f}股，价格 ¥{record['price']:.2f}，"
+                  f"总收入 ¥{record['value']:.2f}，收益率 {record['profit_rate']:.2f}%")
+
+    def rejection(self, record, **context):
+        print(REJECTION_MESSAGES[record['reason']].format(code=record['code'], **context))
+
+    def snapshot(self, record):
+        pass
+
+    def write(self, table, frame):
+        pass
+
+
+class SQLiteSink(object):
+    def __init__(self, conn, run_id):
+        """
+        批量写入SQLite，每类记录一张 ledger_<类型> 表，以run_id区分不同的回测
+
+        Parameters:
+        -----------
+        conn : sqlite3.Connection
+            数据库连接，例如 selection_db.get_connection()
+        run_id : str
+            回测批次
+        """
+        self.conn = conn
+        self.run_id = run_id
+        for table, schema in LEDGER_SCHEMAS.items():
+            columns = ', '.join(f"{name} {'REAL' if dtype in (float, int) else 'TEXT'}"
+                                for name, dtype in schema)
+            conn.execute(f'CREATE TABLE IF NOT EXISTS ledger_{table} (run_id TEXT, {columns})')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_ledger_{table} ON ledger_{table} (run_id, date)')
+        conn.commit()
+
+    def write(self, table, frame):
+        columns = ['run_id'] + list(frame.columns)
+        values = frame.astype(object).where(frame.notna(), None)
+        values.insert(0, 'run_id', self.run_id)
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO ledger_{table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                values.itertuples(index=False, name=None))
+
+
+class ParquetSink(object):
+    def __init__(self, root):
+        """
+        批量写入Parquet，每批一个文件：<root>/<类型>/part-<序号>.parquet。
+        需要安装 pyarrow 或 fastparquet。
+        """
+        self.root = root
+        self.parts = {}
+
+    def write(self, table, frame):
+        directory = os.path.join(self.root, table)
+        os.makedirs(directory, exist_ok=True)
+        part = self.parts.get(table, 0)
+        frame.to_parquet(os.path.join(directory, f'part-{part:05d}.parquet'), index=False)
+        self.parts[table] = part + 1
+
+
+class TradeLedger(object):
+    def __init__(self, sinks=None, console=False, capacity=4096):
+        """
+        列式交易台账
+
+        成交、拒绝和每日快照追加到预分配的列缓冲区，缓冲区写满或调用 flush() 时
+        成批写入各个sink；没有持久化sink时批次保留在内存中，可以用 frame() 读取。
+        控制台输出是可选的sink，关闭后回测不产生任何输出。
+
+        Parameters:
+        -----------
+        sinks : list, optional
+            批量写入目标，如 SQLiteSink、ParquetSink
+        console : bool
+            是否逐条输出到控制台
+        capacity : int
+            每类记录的缓冲区行数
+        """
+        self.sinks = list(sinks or [])
+        self.console = ConsoleSink() if console else None
+        self.capacity = capacity
+        self._buffers = {table: {name: np.empty(capacity, dtype=dtype) for name, dtype in schema}
+                         for table, schema in LEDGER_SCHEMAS.items()}
+        self._sizes = dict.fromkeys(LEDGER_SCHEMAS, 0)
+        self._batches = {table: [] for table in LEDGER_SCHEMAS}
+
+    def _append(self, table, record):
+        size = self._sizes[table]
+        columns = self._buffers[table]
+        for name in columns:
+            columns[name][size] = record[name]
+        self._sizes[table] = size + 1
+        if size + 1 == self.capacity:
+            self._flush_table(table)
+
+    def record_trade(self, date, code, side, price, shares, profit_rate=np.nan, reason=''):
+        record = {'date': date, 'code': code, 'side': side, 'price': price, 'shares': shares,
+                  'value': price * shares, 'profit_rate': profit_rate, 'reason': reason}
+        if self.console is not None:
+            self.console.trade(record)
+        self._append('trades', record)
+
+    def record_rejection(self, date, code, reason, price=np.nan, **context):
+        """记录被拒绝的委托，reason 为 REJECTION_MESSAGES 中的key，context 用于控制台输出"""
+        record = {'date': date, 'code': code, 'price': price, 'reason': reason}
+        if self.console is not None:
+            self.console.rejection(record, **context)
+        self._append('rejections', record)
+
+    def record_snapshot(self, date, cash, market_value, holdings):
+        self._append('snapshots', {'date': date, 'cash': cash, 'market_value': market_value,
+                                   'total_assets': cash + market_value, 'holdings': holdings})
+
+    def _flush_table(self, table):
+        size = self._sizes[table]
+        if size == 0:
+            return
+        frame = pd.DataFrame({name: values[:size].copy()
+                              for name, values in self._buffers[table].items()})
+        self._sizes[table] = 0
+        if self.sinks:
+            for sink in self.sinks:
+                sink.write(table, frame)
+        else:
+            self._batches[table].append(frame)
+
+    def flush(self):
+        """把缓冲区中的全部记录写入sink"""
+        for table in LEDGER_SCHEMAS:
+            self._flush_table(table)
+
+    def frame(self, table):
+        """
+        读取内存中的全部记录（没有持久化sink时）
+
+        Parameters:
+        -----------
+        table : str
+            'trades'、'rejections' 或 'snapshots'
+        """
+        self._flush_table(table)
+        batches = self._batches[table]
+        if not batches:
+            return pd.DataFrame({name: pd.Series(dtype=dtype)
+                                 for name, dtype in LEDGER_SCHEMAS[table]})
+        return pd.concat(batches, ignore_index=True)
@@ -2,6 +2,7 @@ from jqdata import *
 from six import BytesIO
 from daily_bottom_finder import *
 import os
+import numpy as np
 
 # 初始化函数，设定基准等等
 def initialize(context):
@@ -36,6 +37,14 @@ def initialize(context):
     #根据context.portfolio.starting_cash和最大股票只数计算每次买入股票的金额
     g.max_single_position = context.portfolio.starting_cash / g.max_stock_num
     g.today_sell_orders = []
+    #盘中是否根据实时估计的入场价(la)调整未成交的限价买单
+    g.adjust_limit_price = False
+    #估计入场价与挂单价偏离超过该比例才重新挂单
+    g.adjust_threshold = 0.01
+    #当日候选股票的盘中入场价估计器，{股票代码: IntradayLevelEstimator}
+    g.intraday_levels = {}
+    #当日限价买单，{股票代码: (订单号, 挂单价)}
+    g.buy_orders = {}
 
     ### 股票相关设定 ###
     # 股票类每笔交易时的手续费是：买入时佣金万分之三，卖出时佣金万分之三加千分之一印花税, 每笔交易佣金最低扣5块钱
@@ -51,6 +60,8 @@ def initialize(context):
     
 ## 开盘前运行函数     
 def before_market_open(context):
+    g.intraday_levels = {}
+    g.buy_orders = {}
     # 获取前一个交易日
     yesterday = context.previous_date.strftime('%Y-%m-%d')
     # 检查g.selected_stocks字典中是否存在昨天日期
@@ -111,11 +122,44 @@ def before_market_open(context):
                 #通过order_value买入股票
                 order = order_value(stock, g.max_single_position, LimitOrderStyle(buy_price))
                 log.info(f"下入限价单:{stock}，价格为{buy_price}，数量为{g.max_single_position}")
+                #盘中逐分钟更新入场价估计，前收盘价即昨日收盘价
+                g.intraday_levels[stock] = IntradayLevelEstimator(data.loc[stock]['close'])
+                if order is not None:
+                    g.buy_orders[stock] = (order.order_id, buy_price)
     else:
         log.debug(f"{yesterday}没有选中的股票")
     
             
     
+## 盘中每分钟运行函数：更新候选股票的入场价估计，按需调整未成交的限价买单
+def handle_data(context, data):
+    if not g.intraday_levels:
+        return
+    for stock, estimator in g.intraday_levels.items():
+        bar = data[stock]
+        estimator.update(bar.high, bar.low, bar.close, bar.open)
+    if not g.adjust_limit_price:
+        return
+
+    open_orders = get_open_orders()
+    for stock, (order_id, limit_price) in list(g.buy_orders.items()):
+        open_order = open_orders.get(order_id)
+        if open_order is None:
+            continue
+        levels = g.intraday_levels[stock].levels()
+        if levels is None or np.isnan(levels['la']):
+            continue
+        new_price = levels['la']
+        if abs(new_price - limit_price) / limit_price < g.adjust_threshold:
+            continue
+        #撤掉原限价单，剩余未成交数量按新的入场价重新挂单
+        remaining = open_order.amount - open_order.filled
+        cancel_order(open_order)
+        new_order = order(stock, remaining, LimitOrderStyle(new_price))
+        if new_order is not None:
+            g.buy_orders[stock] = (new_order.order_id, new_price)
+        log.info(f"调整限价单:{stock}，价格由{limit_price}调整为{new_price}")
+
 ## 收盘前运行函数
 def before_market_close(context):
     #向前计算第5个交易日
@@ -7,6 +7,14 @@ import re
 from collections import defaultdict
 import math
 
+import numpy as np
+
+from concept_index import get_concept_index
+from intraday_snapshot import get_intraday_snapshot, vwap_upward_mask
+from profiling import enable_profiling, get_profiler, profiled, stage
+from risk_monitor import ACCOUNT_STOP, RiskMonitor
+from technical_indicators import IndicatorState, indicator_filters, streaming_filters
+
 # 初始化函数，设定基准等等
 def initialize(context):
     # 开发环境
@@ -53,10 +61,23 @@ def initialize(context):
     g.max_loss_amount = int(context.portfolio.starting_cash * 0.1 // 100) * 100 * -1
     # 记录建仓股票的可被交易次数
     g.trade_times = {}
+    # 按股票保存的均线、成交量和MACD递推状态，随g跨交易日保存
+    # 需要额外写入文件时设为本次运行专用的路径，如 'daily_rs/indicator_state_<运行编号>.npz'
+    g.indicator_state_path = None
+    g.indicator_state = IndicatorState.load(g.indicator_state_path) if g.indicator_state_path else IndicatorState()
+    # 盘中风控：账户回撤和单只股票8%止损
+    g.risk_monitor = RiskMonitor(g.max_loss_amount, stop_rate=0.92)
+    # 是否统计各阶段耗时，回测结束时输出汇总；关闭时埋点几乎没有开销
+    g.profiling = False
+    enable_profiling(g.profiling)
 
     ## 运行函数（reference_security为运行时间的参考标的；传入的标的只做种类区分，因此传入'000300.XSHG'或'510300.XSHG'是一样的）
     run_daily(frash_freezed_days, time = 'before_open')
-    run_daily(sell_loss, time='14:50:00')
+    run_daily(prepare_concept_index, time='before_open')
+    run_daily(reset_risk_monitor, time='before_open')
+    run_daily(prepare_intraday_snapshot, time='14:50:00')
+    # 每分钟检查一次止损
+    run_daily(sell_loss, time='every_bar')
     run_daily(sell_profit, time='14:50:00')
     run_daily(open_position, time='14:50:00')
       # 收盘后运行
@@ -66,7 +87,33 @@ def initialize(context):
 def frash_freezed_days(context):
     g.freezed_days = max(0, g.freezed_days - 1) 
 
+#开盘前重置风控：前一日未成交的止损委托已失效，需要时重新下单
+def reset_risk_monitor(context):
+    g.risk_monitor.start_day()
+
+#成交回报：持仓变化，下次风控检查时重建持仓数组
+def on_trade_response(context, trade):
+    g.risk_monitor.mark_dirty()
+
+#开盘前建立当日的概念成分股索引，14:50的板块排名直接使用
+def prepare_concept_index(context):
+    get_concept_index(g.concepts, context.current_dt)
+
+#14:50调仓前，持仓和全部候选股票一次读取盘中快照
+def prepare_intraday_snapshot(context):
+    codes = list(context.portfolio.positions.keys()) + list(g.dragon_equity_map.keys())
+    with stage('prepare_intraday_snapshot') as timer:
+        get_intraday_snapshot(context.current_dt, codes)
+        timer.add_rows(len(codes))
+    log.debug("盘中快照："+str(len(codes))+"只股票")
+
+#回测结束时输出各阶段耗时汇总
+def on_strategy_end(context):
+    if get_profiler().enabled:
+        log.info(get_profiler().format_summary())
+
 #开仓买入
+@profiled()
 def open_position(context):
     #获得当前日期，如果不是周1,3,5，则不买入
     if context.current_dt.weekday() not in [0,2,4]:
@@ -88,12 +135,11 @@ def open_position(context):
         for concept in concepts:
             concept_equity_map[concept].append(code)  
     #log.debug("概念股票列表："+str(concept_equity_map))
-    #方法计时,输出用取整毫秒做单位
-    start_time = time.time()
-    #调用get_top3_concepts_increase函数，获取前3的概念
-    top3_concepts = get_top3_concepts_increase(g.concepts, context.current_dt)
-    start_time = time.time()
-    log.debug("前3的概念："+str(top3_concepts) + "，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    #各阶段耗时记入 profiling 的统计，g.profiling 打开时回测结束输出汇总
+    with stage('open_position.top3_concepts'):
+        #调用get_top3_concepts_increase函数，获取前3的概念
+        top3_concepts = get_top3_concepts_increase(g.concepts, context.current_dt)
+    log.debug("前3的概念："+str(top3_concepts))
     #筛选not_in_position的股票对应的concept在top3_concepts中的股票，加入到代买入buy_list
     buy_list = []
     for concept in top3_concepts:
@@ -102,29 +148,33 @@ def open_position(context):
         buy_list.extend(equity_list)
     # 去重
     buy_list = list(set(buy_list))
-    log.debug("在板块涨幅top3，待买入的股票："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    log.debug("在板块涨幅top3，待买入的股票："+str(buy_list))
 
     trade_dt = context.current_dt.strftime('%Y-%m-%d')
+    #用流式指标状态计算20天线、成交量和MACD过滤条件，只读取缺少的交易日和当日的一根日线
+    with stage('open_position.indicators') as timer:
+        signals = streaming_filters(g.indicator_state, buy_list, trade_dt)
+        if g.indicator_state_path and not g.indicator_state.save(g.indicator_state_path):
+            log.warning("指标状态写入失败："+g.indicator_state_path)
+        timer.add_rows(len(buy_list))
     #过滤掉股价没有站上20天线的股票
-    start_time = time.time()
-    buy_list = [code for code in buy_list if is_above_20_day_line(code, trade_dt)]
-    log.debug("20天线的股票，待买入的股票："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    buy_list = [code for code in buy_list if signals.at[code, 'above_ma20']]
+    log.debug("20天线的股票，待买入的股票："+str(buy_list))
     #过滤掉最近3天成交量没有放大至1.5倍以上的股票
-    start_time = time.time()
-    buy_list = [code for code in buy_list if is_volume_increased_150(code, trade_dt)]
-    log.debug("1.5倍交易量，待买入的股票："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    buy_list = [code for code in buy_list if signals.at[code, 'volume_increased']]
+    log.debug("1.5倍交易量，待买入的股票："+str(buy_list))
     #过滤掉MACD没有出现金叉的股票
-    start_time = time.time()
-    buy_list = [code for code in buy_list if is_macd_gold_cross(code, trade_dt)]
-    log.debug("MACD金叉，待买入的股票："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    buy_list = [code for code in buy_list if signals.at[code, 'macd_gold_cross']]
+    log.debug("MACD金叉，待买入的股票："+str(buy_list))
     #过滤掉开盘后30分钟~1小时内，成交量没有达到昨日全天成交量的50%甚至更高的股票
-    start_time = time.time()
-    buy_list = [code for code in buy_list if is_volume_increased_50(code, trade_dt)]
-    log.debug("开盘30分钟交易量："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    with stage('open_position.volume_50'):
+        buy_list = [code for code in buy_list if is_volume_increased_50(code, trade_dt)]
+    log.debug("开盘30分钟交易量："+str(buy_list))
     #过滤掉分时图中的黄色均价线（即当日成交均线）没有呈现温和向上的趋势的股票
-    start_time = time.time()
-    buy_list = [code for code in buy_list if is_yellow_average_line_upward(code, trade_dt)]
-    log.debug("温和向上："+str(buy_list)+"，耗时："+str(int((time.time() - start_time) * 1000)) + "毫秒")
+    with stage('open_position.vwap_upward'):
+        upward = vwap_upward_mask(get_intraday_snapshot(trade_dt).frame(buy_list))
+        buy_list = [code for code in buy_list if upward[code]]
+    log.debug("温和向上："+str(buy_list))
     
     #循环buy_list，买入，如果持仓大于g.max_equity_num，则不买入
     for code in buy_list:
@@ -135,10 +185,12 @@ def open_position(context):
         o = order_value(code, order_amount)
         if o is not None:
             g.trade_times[code] = 2
+            g.risk_monitor.mark_dirty()
         log.info("买入："+code+"，金额："+str(order_amount))
 
 
 #获利卖出    
+@profiled()
 def sell_profit(context):
     #获取当前时间，如果不是周1,3,5，则不卖出
     if context.current_dt.weekday() not in [0,2,4]:
@@ -147,7 +199,8 @@ def sell_profit(context):
         return
     trade_dt = context.current_dt.strftime('%Y-%m-%d')
     # 获取前5的概念
-    top5_concepts = top5_concept_monitor(g.concepts, trade_dt)
+    with stage('sell_profit.top5_concepts'):
+        top5_concepts = top5_concept_monitor(g.concepts, trade_dt)
     # 判断持仓股票对应的板块是否在top5_concepts中，如果不在则全部卖出
     for position in context.portfolio.positions:
         #dragon_equity_map 获取股票对应的板块
@@ -155,6 +208,7 @@ def sell_profit(context):
         if concept not in top5_concepts:
             order_target(position.security, 0)
             g.trade_times[position.security] = 0
+            g.risk_monitor.mark_dirty()
             log.info("持仓股票对应的板块不在top5_concepts中，卖出")
     
     #循环持仓列表，判断跌幅是否超过5%。如果满足条件则卖出50%
@@ -170,141 +224,107 @@ def sell_profit(context):
             #如果trade_times ==2 则卖出50%，如果==1 则卖出份额
             order(position.security, amount)
             g.trade_times[position.security]  = g.trade_times[position.security] - 1
+            g.risk_monitor.mark_dirty()
             log.info("单只股票跌幅超过5%，卖出")
         elif is_above_target_price(position.security, trade_dt, sell_profit_price):
             order(position.security, amount)
             g.trade_times[position.security]  = g.trade_times[position.security] - 1
+            g.risk_monitor.mark_dirty()
             log.info("单只股票涨幅超过20%，卖出")
         
 
-#止损卖出
+#止损卖出，每分钟运行
+@profiled()
 def sell_loss(context):
-    #获取当前的所有持仓
+    #持仓变化（下单、成交回报、换日）后重建风控数组，否则只用价格变化的股票增量更新持仓收益
+    #这里是每分钟唯一一次遍历持仓，check 只做数组运算
     current_positions = context.portfolio.positions
-    #计算所有的持仓收益
-    total_profit = sum(position.value - position.hold_cost for position in current_positions.values())
-    #如果总收益小于最大回撤金额，则卖出所有持仓
-    if total_profit < g.max_loss_amount:
-        for position in current_positions:
-            order_target(position.security, 0)
+    monitor = g.risk_monitor
+    if not monitor.sync(current_positions):
+        changed = {code: current_positions[code].price
+                   for code, last in zip(monitor.codes, monitor.price)
+                   if current_positions[code].price != last}
+        monitor.update(changed)
+    #止损委托已经完成或失效的股票，允许重新下单
+    g.risk_monitor.release({o.security for o in get_open_orders().values()})
+    #总收益小于最大回撤金额时返回全部持仓，否则返回亏损超过8%的股票
+    orders = g.risk_monitor.check()
+    if orders.empty:
+        return
+    for code in orders['code']:
+        order_target(code, 0)
+    g.risk_monitor.mark_dirty()
+    if orders['reason'].iloc[0] == ACCOUNT_STOP:
         log.warning("总账户回撤超过10%暂停交易一周")
         g.freezed_days = 7
         # 清空交易次数
         g.trade_times = {}
     else:
-        #遍历持仓，如果单只股票亏损超过8%，则清仓卖出该只股票
-        for position in current_positions:
-            if position.value < position.hold_cost * 0.92:
-                order_target(position.security, 0)
-                g.trade_times[position.security] = 0 
-                log.info("单只股票亏损超过8%，清仓卖出")
+        for code in orders['code']:
+            g.trade_times[code] = 0
+        log.info("单只股票亏损超过8%，清仓卖出："+str(orders['code'].tolist()))
 
 def get_top3_concepts_increase(concepts, date):
-    concept_avg_increase = {}
-    for concept in concepts:
-        stock_list = get_concept_stocks(concept_code=concept, date=date)
-        if not stock_list:
-            continue
-        # 获取开盘价和最高价
-        price_df = get_price(stock_list, end_date=date, count=1, frequency='1d', fields=['open', 'high'], panel=False)
-        if price_df is None or price_df.empty:
-            continue
-        # 计算涨幅 (最高-开盘)/开盘
-        price_df = price_df.reset_index()
-        price_df['increase'] = (price_df['high'] - price_df['open']) / price_df['open'] * 100
-        avg_increase = price_df['increase'].mean()
-        concept_avg_increase[concept] = avg_increase
-    # 按平均涨幅排序，取前3
-    top3 = sorted(concept_avg_increase.items(), key=lambda x: x[1], reverse=True)[:3]
-    return [c[0] for c in top3]
+    index = get_concept_index(concepts, date)
+    # 全部成分股一次获取开盘价和最高价
+    price_df = get_price(index.codes, end_date=date, count=1, frequency='1d', fields=['open', 'high'], panel=False)
+    if price_df is None or price_df.empty:
+        return []
+    # 计算涨幅 (最高-开盘)/开盘
+    price_df = price_df.set_index('code')
+    increase = (price_df['high'] - price_df['open']) / price_df['open'] * 100
+    # 按概念平均涨幅排序，取前3
+    return index.top(increase, 3)
 
 #股价站上20天线
 def is_above_20_day_line(code, date):
-  #获取20天线
-  price_df = get_price(code, end_date=date, count=20, frequency='1d', fields=['close'], panel=False)
-  if price_df is None or price_df.empty:
-    return False
-  # 计算20天线
-  price_df['20_day_line'] = price_df['close'].rolling(window=20).mean()
-  return price_df['close'].iloc[-1] > price_df['20_day_line'].iloc[-1]
+  return bool(indicator_filters([code], date).at[code, 'above_ma20'])
 
 #最近3天成交量放大至1.5倍以上
 def is_volume_increased_150(code, date):
-  #获取最近3天成交量
-  price_df = get_price(code, end_date=date, count=3, frequency='1d', fields=['volume'], panel=False)
-  if price_df is None or price_df.empty:
-    return False
-  # 计算3天成交量
-  price_df['volume_increased'] = price_df['volume'].rolling(window=3).mean()
-  return price_df['volume'].iloc[-1] > price_df['volume_increased'].iloc[-1] * 1.5  
+  return bool(indicator_filters([code], date).at[code, 'volume_increased'])
 
 #MACD出现金叉（白线上穿黄线）
 def is_macd_gold_cross(code, date):
-    # 获取最近35天的收盘价
-    price_df = get_price(code, end_date=date, count=35, frequency='1d', fields=['close'], panel=False)
-    if price_df is None or price_df.empty or len(price_df) < 35:
-        return False
-    close = price_df['close']
-    # 计算EMA12和EMA26
-    ema12 = close.ewm(span=12, adjust=False).mean()
-    ema26 = close.ewm(span=26, adjust=False).mean()
-    # 计算DIFF
-    diff = ema12 - ema26
-    # 计算DEA
-    dea = diff.ewm(span=9, adjust=False).mean()
-    # 判断金叉：DIFF从下向上穿越DEA
-    if diff.iloc[-2] < dea.iloc[-2] and diff.iloc[-1] > dea.iloc[-1]:
-        return True
-    return False  
+  return bool(indicator_filters([code], date).at[code, 'macd_gold_cross'])
 
 #开盘后30分钟~1小时内，成交量已达到昨日全天成交量的50%甚至更高
 def is_volume_increased_50(code, date):
-  #获取昨日成交量
-  yesterday_volume = get_price(code, end_date=date, count=1, frequency='1d', fields=['volume'], panel=False)
-  min_time = date + ' 10:00:00'
-  today_volume = get_price(code, end_date=min_time, count=30, frequency='1m', fields=['volume'], panel=False)
-  today_volume = today_volume['volume'].sum()
-  #log.debug(code+ ":今日成交量："+str(today_volume)+ "昨日成交量："+str(yesterday_volume['volume'].iloc[-1]))
-  if yesterday_volume is None or yesterday_volume.empty:
-    return False
-  return today_volume >= yesterday_volume['volume'].iloc[-1] * 0.5  
-  #return True
+  snapshot = get_intraday_snapshot(date)
+  #昨日成交量
+  yesterday_volume = snapshot.get(code, 'prev_volume')
+  #开盘后30分钟(09:31~10:00)的分钟成交量
+  today_volume = snapshot.get(code, 'volume_30m')
+  #log.debug(code+ ":今日成交量："+str(today_volume)+ "昨日成交量："+str(yesterday_volume))
+  return today_volume >= yesterday_volume * 0.5
 
 
 #分时图中的黄色均价线（即当日成交均线）呈现温和向上的趋势
 def is_yellow_average_line_upward(code, date):
-  return True
+  return bool(vwap_upward_mask(get_intraday_snapshot(date).frame([code]))[code])
 
 
 # 判断当日股票跌幅是否超过5%
 def is_stock_down_5(code, date):
-  start_time = date + ' 09:31:00'
-  end_time = date + ' 14:50:00'
-  price_start = get_price(code, end_date=start_time, count=1, frequency='1m', fields=['open'], panel=False)
-  price_end = get_price(code, end_date=end_time, count=1, frequency='1m', fields=['close'], panel=False)
+  snapshot = get_intraday_snapshot(date)
+  price_start = snapshot.get(code, 'open_0931')
+  price_end = snapshot.get(code, 'close_now')
   #判断price_end/price_start是否小于0.95
-  return price_end['close'].iloc[-1] / price_start['open'].iloc[-1] <= 0.95
+  return price_end / price_start <= 0.95
 
 #top5概念板块,以平均涨跌幅计算
 def top5_concept_monitor(concepts, date):
-  concept_avg_change_pct = {}
-  for concept in concepts:
-        stock_list = get_concept_stocks(concept_code=concept, date=date)
-        #调用get_money_flow得到上一个交易日的涨跌幅 change_pct字段。求平均值为概念板块的涨跌幅 
-        money_flow = get_money_flow(stock_list, end_date=date, count=1, fields=['change_pct'])
-        if money_flow is None or money_flow.empty:
-            continue
-        avg_change_pct = money_flow['change_pct'].mean()
-        concept_avg_change_pct[concept] = avg_change_pct
-  # 按平均涨幅排序，取前5 
-  top5 = sorted(concept_avg_change_pct.items(), key=lambda x: x[1], reverse=True)[:5]
-  # 返回对应的板块代码
-  return [c[0] for c in top5]
+  index = get_concept_index(concepts, date)
+  #全部成分股一次调用get_money_flow得到上一个交易日的涨跌幅 change_pct字段。概念内求平均值为概念板块的涨跌幅
+  money_flow = get_money_flow(index.codes, end_date=date, count=1, fields=['sec_code', 'change_pct'])
+  if money_flow is None or money_flow.empty:
+    return []
+  # 按平均涨幅排序，取前5，返回对应的板块代码
+  return index.top(money_flow.set_index('sec_code')['change_pct'], 5)
 
 # 判断股票当前价格是否超过目标价格
 def is_above_target_price(code, date, target_price):
-  curt_time = date + ' 14:50:00'
-  price_df = get_price(code, end_date=curt_time, count=1, frequency='1m', fields=['close'], panel=False)
-  if price_df is None or price_df.empty:
+  price = get_intraday_snapshot(date).get(code, 'close_now')
+  if np.isnan(price):
     return False
-  return price_df['close'].iloc[-1] >= target_price
+  return price >= target_price